@@ -1,12 +1,16 @@
 import numpy as np
 import netCDF4, datetime, copy
-from paegan.cdm.timevar import Timevar
+from paegan.cdm.timevar import Timevar, date2epoch
 from paegan.cdm.depthvar import Depthvar
 from paegan.cdm.gridvar import Gridobj
 from paegan.cdm.variable import Coordinates as cachevar
 from paegan.cdm.variable import SubCoordinates as subs
+from paegan.cdm.variable import AxisLayout
+from paegan.cdm.readplan import ReadPlanner
 from paegan.location4d import Location4D
 from paegan.utils.asainterpolate import CfGeoInterpolator
+import paegan.cdm.writer as pw
+from collections import OrderedDict
 
 from paegan.logger import logger
 
@@ -65,9 +69,8 @@ def _sub_by_nan(data, ind):
             preserve the lazy data access on the full array's in the backend.
         """
         if len(ind) > 0:
-            xtmp = -1 * np.ones_like(data)
-            xtmp[ind[0]:ind[-1]+1] = ind
-            xbool = range(len(data)) != xtmp
+            xbool = np.ones(len(data), dtype=bool)
+            xbool[ind] = False
             data[xbool] = np.nan
         else:
             data = np.nan * np.ones_like(data)
@@ -81,18 +84,22 @@ def _sub_by_nan2(data, ind):
             preserve the lazy data access on the full array's in the backend.
         """
         if (len(ind[0]) > 0) & (len(ind[1]) > 0):
-            xtmp = -1 * np.ones_like(data[1, :])
-            xtmp[ind[1][0]:ind[1][-1]+1] = ind[1]
-            xbool = range(len(data[1])) != xtmp
-            ytmp = -1 * np.ones_like(data[:, 1])
-            ytmp[ind[0][0]:ind[0][-1]+1] = ind[0]
-            ybool = range(len(data[0])) != ytmp
-            data[ybool, xbool] = np.nan
+            xybool = np.ones(data.shape, dtype=bool)
+            xybool[np.ix_(ind[0], ind[1])] = False
+            data[xybool] = np.nan
         else:
             data = np.nan * np.ones_like(data)
         return data
 
 
+def _is_remote(filepath):
+    """
+        True when a dataset is read from a server (OPeNDAP/THREDDS), where
+        every read is a round trip.
+    """
+    return isinstance(filepath, basestring) and filepath.split('://')[0].lower() in ('http', 'https')
+
+
 class CommonDataset(object):
 
     @staticmethod
@@ -141,6 +148,7 @@ class CommonDataset(object):
         >> dataset = CommonDataset.open(ncfile)
         >> dataset = CommonDataset.open(url, "lon_rho", "lat_rho", "s_rho", "ocean_time")
         >> dataset = CommonDataset.open(url, dataset_type="cgrid")
+        >> dataset = CommonDataset.open(url, read_gap=10, max_slabs=8)
         """
 
         nc = CommonDataset.nc_object(ncfile)
@@ -166,7 +174,9 @@ class CommonDataset(object):
         # Test the shapes of the coordinate variables to determine the grid type
         datasettype = kwargs.get('dataset_type', None)
         if datasettype is None:
-            if testvary is None or testvarx is None:
+            if any(getattr(v, 'cf_role', None) == 'mesh_topology' for v in nc.variables.values()):
+                datasettype = "ugrid"
+            elif testvary is None or testvarx is None:
                 datasettype = "ncell"
             elif testvary.ndim > 1:
                 datasettype = "cgrid"
@@ -183,6 +193,9 @@ class CommonDataset(object):
                         datasettype = "ncell"
         nc.close()
 
+        # How index requests are turned into reads, see Dataset
+        planner = dict((k, kwargs[k]) for k in ('read_gap', 'max_slabs') if k in kwargs)
+
         # Return appropriate dataset subclass based on datasettype
         from paegan.cdm.grids.c_grid import CGridDataset
         from paegan.cdm.grids.n_cell import NCellDataset
@@ -191,23 +204,58 @@ class CommonDataset(object):
 
         if datasettype == 'ncell':
             dataobj = NCellDataset(filepath, datasettype,
-                                   zname=zname, tname=tname, xname=xname, yname=yname)
+                                   zname=zname, tname=tname, xname=xname, yname=yname, **planner)
         elif datasettype == 'rgrid':
             dataobj = RGridDataset(filepath, datasettype,
-                                   zname=zname, tname=tname, xname=xname, yname=yname)
+                                   zname=zname, tname=tname, xname=xname, yname=yname, **planner)
         elif datasettype == 'cgrid':
             dataobj = CGridDataset(filepath, datasettype,
-                                   zname=zname, tname=tname, xname=xname, yname=yname)
+                                   zname=zname, tname=tname, xname=xname, yname=yname, **planner)
+        elif datasettype == 'ugrid':
+            dataobj = UGridDataset(filepath, datasettype,
+                                   zname=zname, tname=tname, xname=xname, yname=yname, **planner)
         else:
             dataobj = None
 
         return dataobj
 
 
+def _readonly(coord):
+    """
+        Lock the arrays of a cached coordinate object.  They are shared
+        by every variable (and every copy of the dataset) that uses the
+        same coordinate variables, so restrictions have to work on copies.
+    """
+    if isinstance(coord, Gridobj):
+        coord._xarray.flags.writeable = False
+        coord._yarray.flags.writeable = False
+    elif coord is not None:
+        coord.flags.writeable = False
+    return coord
+
+
 class Dataset(object):
+    # Slab reads per index request, for local files and for servers where
+    # every read is a round trip.  Subclasses with scattered selections
+    # can allow more local reads.
+    max_slabs = 64
+    remote_max_slabs = 64
+
     def __init__(self, filepath, datasettype, xname='lon', yname='lat',
-                 zname='z', tname='time'):
+                 zname='z', tname='time', read_gap=0, max_slabs=None):
+        # Per data variable, a Coordinates holding references into _coordvars
         self._coordcache = dict()
+        # Coordinate objects keyed by the coordinate variable names
+        self._coordvars = dict()
+        # AxisLayout per data variable
+        self._layoutcache = dict()
+        # Turns index requests into hyperslab reads, its gap and max_slabs
+        # can be tuned and it keeps count of the requests and bytes read
+        if max_slabs is None:
+            max_slabs = self.remote_max_slabs if _is_remote(filepath) else self.max_slabs
+        self.readplanner = ReadPlanner(gap=read_gap, max_slabs=max_slabs)
+        # InterpolationWeights used by get_values_on_grid
+        self._interpcache = dict()
         self._datasettype = datasettype
 
         self._possiblet = _possiblet
@@ -262,6 +310,9 @@ class Dataset(object):
     def get_xyind_from_point(self, var, point, **kwargs):
         raise NotImplementedError
 
+    def get_xyind_from_points(self, var, lons, lats):
+        raise NotImplementedError
+
     def opennc(self):
         try:
             # Open if if it None
@@ -271,6 +322,8 @@ class Dataset(object):
         except StandardError:
             self.nc = CommonDataset.nc_object(self._filepath)
             self.metadata = self.nc.__dict__
+            # Dimension sizes can change between opens of an aggregation
+            self._layoutcache = dict()
 
     def closenc(self):
         try:
@@ -295,7 +348,8 @@ class Dataset(object):
             bounds = (netCDF4.num2date(np.min(time[np.isnan(time)==False]),units=u),
                       netCDF4.num2date(np.max(time[np.isnan(time)==False]),units=u))
         else:
-            bounds = (np.min(time[np.isnan(time)==False].dates), np.max(time[np.isnan(time)==False].dates))
+            valid = time[np.isnan(time)==False]
+            bounds = tuple(valid[[np.argmin(valid), np.argmax(valid)]].dates)
         return bounds
 
     def getdepthbounds(self, var=None, **kwargs):
@@ -320,6 +374,26 @@ class Dataset(object):
         grid = self.getgridobj(var)
         return grid.boundingpolygon
 
+    def _domain_grid(self, var=None):
+        if var is None:
+            for v in self._current_variables:
+                if self.getgridobj(v) is not None:
+                    return self.getgridobj(v)
+            raise ValueError("No variables with horizontal coordinates")
+        assert var in self._current_variables
+        return self.getgridobj(var)
+
+    def contains_points(self, lons, lats, var=None):
+        """
+            Boolean array, True where the position is inside of the domain
+            (the bounding polygon) of var, or of the first variable with
+            horizontal coordinates when var is None.  The domain geometry is
+            prepared once and kept with the coordinate objects.
+
+            >> inside = dataset.contains_points(lons, lats)
+        """
+        return self._domain_grid(var).contains_points(lons, lats)
+
     def _checkcache(self, var):
         assert var in self._current_variables
         test = var in self._coordcache
@@ -337,7 +411,13 @@ class Dataset(object):
         if timevar is None:
             names = self.get_coord_names(var)
             if names['tname'] is not None:
-                timevar = Timevar(self.nc, names["tname"])
+                key = ('time', names['tname'])
+                if use_cache is True and key in self._coordvars:
+                    timevar = self._coordvars[key]
+                else:
+                    timevar = Timevar(self.nc, names["tname"])
+                    if use_cache is True:
+                        self._coordvars[key] = _readonly(timevar)
             else:
                 timevar = None
             if use_cache is True:
@@ -356,7 +436,13 @@ class Dataset(object):
         if depthvar is None:
             names = self.get_coord_names(var)
             if names['zname'] is not None:
-                depthvar = Depthvar(self.nc, names["zname"])
+                key = ('z', names['zname'])
+                if use_cache is True and key in self._coordvars:
+                    depthvar = self._coordvars[key]
+                else:
+                    depthvar = Depthvar(self.nc, names["zname"])
+                    if use_cache is True:
+                        self._coordvars[key] = _readonly(depthvar)
             else:
                 depthvar = None
             if use_cache is True:
@@ -374,19 +460,58 @@ class Dataset(object):
         if gridobj is None:
             names = self.get_coord_names(var)
             if names['xname'] is not None and names['yname'] is not None:
-                gridobj = Gridobj(self.nc, names["xname"], names["yname"])
+                key = ('xy', names['xname'], names['yname'])
+                gridobj = self._coordvars.get(key)
+                if gridobj is None:
+                    gridobj = _readonly(Gridobj(self.nc, names["xname"], names["yname"]))
+                    self._coordvars[key] = gridobj
             else:
                 gridobj = None
             self._coordcache[var].add_xy(gridobj)
         return gridobj
 
+    def _copycache(self, new):
+        """
+            Give a copy of this dataset its own Coordinates containers.
+            The coordinate objects inside them stay shared.
+        """
+        new._coordcache = dict((var, copy.copy(coords)) for var, coords in self._coordcache.iteritems())
+        new._coordvars = copy.copy(self._coordvars)
+        new._layoutcache = copy.copy(self._layoutcache)
+        new.readplanner = self.readplanner
+        new._interpcache = self._interpcache
+        return new
+
+    def _restrict_coords(self, kind, restrict):
+        """
+            Replace the `kind` ('xy', 'z' or 'time') coordinate object of
+            every current variable with restrict(var, coord), which must
+            return a new object.  Variables that shared a coordinate object
+            share the restricted one, and the object is restricted once.
+        """
+        getter = {'xy' : self.getgridobj, 'z' : self.getdepthvar, 'time' : self.gettimevar}[kind]
+        done = {}
+        for var in self._current_variables:
+            coord = getter(var)
+            if coord is None:
+                continue
+            if id(coord) not in done:
+                done[id(coord)] = (coord, _readonly(restrict(var, coord)))
+            setattr(self._coordcache[var], kind, done[id(coord)][1])
+        for key, coord in self._coordvars.items():
+            if id(coord) in done and done[id(coord)][0] is coord:
+                self._coordvars[key] = done[id(coord)][1]
+
     def get_tind_from_bounds(self, var, bounds, convert=False, use_cache=True):
         assert var in self._current_variables
         time = self.gettimevar(var, use_cache)
-        if convert:
-            bounds = netCDF4.date2num(bounds, time._units + " since " + time.origin.isoformat())
-        inds = np.where(np.logical_and(time.dates >= bounds[0].replace(tzinfo=time.dates[0].tzinfo), time.dates <= bounds[1].replace(tzinfo=time.dates[0].tzinfo)))
-        return inds
+        # The bounds are converted once and searched on the numeric axis,
+        # as wall times in the variable's timezone
+        start, end = [b.replace(tzinfo=time._tzinfo) for b in bounds]
+        inds = time.bounds_index(start, end)
+        if isinstance(inds, slice):
+            inds = np.arange(inds.start, inds.stop)
+        return (inds,)
 
     def get_zind_from_bounds(self, var, bounds, use_cache=True):
         assert var in self._current_variables
@@ -418,8 +543,44 @@ class Dataset(object):
 ]]"""
         return out
 
+    def get_axis_layout(self, var=None):
+        """
+            The AxisLayout of a variable: its coordinate names and which of
+            its dimensions each of them indexes.  Worked out once per
+            variable and kept until restrict_vars or the file is reopened.
+        """
+        assert var in self._current_variables
+        layout = self._layoutcache.get(var)
+        if layout is None:
+            names = self._find_coord_names(var)
+            ncvar = self.nc.variables[var]
+            dims = tuple(ncvar.dimensions)
+            positions = dict()
+            for key, common_name in (("tname", "time"), ("zname", "z"), ("xname", "x"), ("yname", "y")):
+                positions[common_name] = None
+                if names[key] is not None:
+                    cdims = self.nc.variables[names[key]].dimensions
+                    positions[common_name] = tuple(dims.index(cdim) for cdim in cdims if cdim in dims)
+            # A dimension belongs to one coordinate only.  Horizontal ones
+            # win over time and time over depth, so sigma layers defined on
+            # the nodes of a mesh only claim their vertical dimension.
+            claimed = set((positions["x"] or ()) + (positions["y"] or ()))
+            for common_name in ("time", "z"):
+                if positions[common_name] is not None:
+                    positions[common_name] = tuple(p for p in positions[common_name] if p not in claimed)
+                    claimed.update(positions[common_name])
+            positions.update(names)
+            layout = AxisLayout(dims=dims, shape=tuple(ncvar.shape), **positions)
+            self._layoutcache[var] = layout
+        return layout
+
     def get_coord_names(self, var=None, **kwargs):
         assert var in self._current_variables
+        if len(kwargs) == 0:
+            return self.get_axis_layout(var).names
+        return self._find_coord_names(var, **kwargs)
+
+    def _find_coord_names(self, var=None, **kwargs):
         ncvar = self.nc.variables[var]
         try:
             coordinates = ncvar.coordinates.split()
@@ -535,47 +696,24 @@ class Dataset(object):
 
     def sub_coords(self, var, zbounds=None, bbox=None, timebounds=None, zinds=None, timeinds=None):
         assert var in self._current_variables
-        ncvar = self.nc.variables[var]
         coord_dict = self.get_coord_dict(var)
-        names = self.get_coord_names(var)
-        dims = ncvar.dimensions
+        layout = self.get_axis_layout(var)
+        names = layout.names
+        positions = layout.positions
         x, y, z, time = None, None, None, None
-        positions = dict()
-        for i in names:
-            name = names[i]
-            if i == "tname":
-                common_name = "time"
-            elif i == "zname":
-                common_name = "z"
-            elif i == "xname":
-                common_name = "x"
-            elif i == "yname":
-                common_name = "y"
-            else:
-                common_name = None
-            if common_name is not None:
-                positions[common_name] = None
-                if name is not None:
-                    positions[common_name] = []
-                    cdims = self.nc.variables[name].dimensions
-                    for cdim in cdims:
-                        try:
-                            positions[common_name].append(dims.index(cdim))
-                        except StandardError:
-                            pass
         if names['tname'] is not None:
             #tname = names['tname']
             if timebounds is not None:
                 timeinds = self.get_tind_from_bounds(var, timebounds)[0]
             elif timeinds is None:
-                timeinds = np.arange(0, ncvar.shape[positions["time"][0]]+1)
+                timeinds = np.arange(0, layout.shape[positions["time"][0]])
             time = coord_dict['time'][timeinds[0]:timeinds[-1]+1]
         if names['zname'] is not None:
             #zname = names['zname']
             if zbounds is not None:
                 zinds = self.get_zind_from_bounds(var, zbounds)[0]
             elif zinds is None:
-                zinds = np.arange(0, ncvar.shape[positions["z"][0]]+1)
+                zinds = np.arange(0, layout.shape[positions["z"][0]])
             z = coord_dict['z'][zinds[0]:zinds[-1]+1]
         xinds, yinds = self.get_xyind_from_bbox(var, bbox)
         xy = coord_dict['xy']
@@ -603,36 +741,9 @@ class Dataset(object):
 
         """
         assert var in self._current_variables
-        ncvar = self.nc.variables[var]
-        names = self.get_coord_names(var)
-        # find how the shapes match up to var
-        # (should i use dim names or just sizes to figure out?)
-        # I'm going to use dim names
-        dims = ncvar.dimensions
-        positions = dict()
-        ndim = ncvar.ndim
-        for i in names:
-            name = names[i]
-            if i == "tname":
-                common_name = "time"
-            elif i == "zname":
-                common_name = "z"
-            elif i == "xname":
-                common_name = "x"
-            elif i == "yname":
-                common_name = "y"
-            else:
-                common_name = None
-            if common_name is not None:
-                positions[common_name] = None
-                if name is not None:
-                    positions[common_name] = []
-                    cdims = self.nc.variables[name].dimensions
-                    for cdim in cdims:
-                        try:
-                            positions[common_name].append(dims.index(cdim))
-                        except StandardError:
-                            pass
+        layout = self.get_axis_layout(var)
+        positions = layout.positions
+        ndim = len(layout.dims)
 
         if positions["time"] is not None:
             if timebounds is not None:
@@ -642,7 +753,7 @@ class Dataset(object):
                     if point is not None:
                         tinds = np.asarray([self.get_nearest_tind(var, point)])
                     else:
-                        tinds = np.asarray([np.arange(0, ncvar.shape[positions["time"][0]]+1)])
+                        tinds = np.asarray([np.arange(0, layout.shape[positions["time"][0]])])
                 else:
                     tinds = timeinds
         if positions["z"] is not None:
@@ -653,20 +764,18 @@ class Dataset(object):
                     if point is not None:
                         zinds = np.asarray([self.get_nearest_zind(var, point)])
                     else:
-                        zinds = np.asarray([np.arange(0, ncvar.shape[positions["z"][0]]+1)])
+                        zinds = np.asarray([np.arange(0, layout.shape[positions["z"][0]])])
                 else:
                     pass
         if bbox is not None:
             xinds, yinds = self.get_xyind_from_bbox(var, bbox)
-            xinds = xinds[0]
-            yinds = yinds[0]
         else:
             if point is not None:
                 num = kwargs.get("num", 1)
                 xinds, yinds = self.get_xyind_from_point(var, point, num=num)
             else:
-                xinds = np.asarray([np.arange(0, ncvar.shape[pos]+1) for pos in positions["x"]])
-                yinds = np.asarray([np.arange(0, ncvar.shape[pos]+1) for pos in positions["y"]])
+                xinds = np.asarray([np.arange(0, layout.shape[pos]) for pos in positions["x"]])
+                yinds = np.asarray([np.arange(0, layout.shape[pos]) for pos in positions["y"]])
 
         indices = [None for i in range(ndim)]
         for name in positions:
@@ -696,37 +805,9 @@ class Dataset(object):
 
         """
         assert var in self._current_variables
-        ncvar = self.nc.variables[var]
-        names = self.get_coord_names(var)
-        # find how the shapes match up to var
-        # (should i use dim names or just sizes to figure out?)
-        # I'm going to use dim names
-        dims = ncvar.dimensions
-        ndim = ncvar.ndim
-        positions = dict()
-
-        for i in names:
-            name = names[i]
-            if i == "tname":
-                common_name = "time"
-            elif i == "zname":
-                common_name = "z"
-            elif i == "xname":
-                common_name = "x"
-            elif i == "yname":
-                common_name = "y"
-            else:
-                common_name = None
-            if common_name is not None:
-                positions[common_name] = None
-                if name is not None:
-                    positions[common_name] = []
-                    cdims = self.nc.variables[name].dimensions
-                    for cdim in cdims:
-                        try:
-                            positions[common_name].append(dims.index(cdim))
-                        except StandardError:
-                            pass
+        layout = self.get_axis_layout(var)
+        positions = layout.positions
+        ndim = len(layout.dims)
         # get t inds, z inds, xy inds
         # tinds = [[1,],]
         # zinds = [[1,],]
@@ -740,7 +821,7 @@ class Dataset(object):
                     if point is not None:
                         tinds = np.asarray([self.get_nearest_tind(var, point)])
                     else:
-                        tinds = np.asarray([np.arange(0, ncvar.shape[positions["time"][0]]+1)])
+                        tinds = np.asarray([np.arange(0, layout.shape[positions["time"][0]])])
                 else:
                     if isinstance(timeinds, list) or isinstance(timeinds, tuple):
                         tinds = np.asarray(timeinds)
@@ -756,7 +837,7 @@ class Dataset(object):
                     if point is not None:
                         zinds = np.asarray([self.get_nearest_zind(var, point)])
                     else:
-                        zinds = np.asarray([np.arange(0, ncvar.shape[positions["z"][0]]+1)])
+                        zinds = np.asarray([np.arange(0, layout.shape[positions["z"][0]])])
                 else:
                     if isinstance(zinds, list) or isinstance(zinds, tuple):
                         zinds = np.asarray(zinds)
@@ -766,15 +847,13 @@ class Dataset(object):
                         zinds = np.asarray([zinds])
         if bbox is not None:
             xinds, yinds = self.get_xyind_from_bbox(var, bbox)
-            xinds = xinds[0]
-            yinds = yinds[0]
         else:
             if point is not None:
                 num = kwargs.get("num", 1)
                 xinds, yinds = self.get_xyind_from_point(var, point, num=num)
             else:
-                xinds = np.asarray([np.arange(0, ncvar.shape[pos]+1) for pos in positions["x"]])
-                yinds = np.asarray([np.arange(0, ncvar.shape[pos]+1) for pos in positions["y"]])
+                xinds = np.asarray([np.arange(0, layout.shape[pos]) for pos in positions["x"]])
+                yinds = np.asarray([np.arange(0, layout.shape[pos]) for pos in positions["y"]])
         #if len(tinds) > 0 and len(zinds) > 0 and \
         #    len(xinds) > 0 and len(yinds) > 0:
         # Now take time inds, z inds, x and y inds and put them
@@ -804,6 +883,138 @@ class Dataset(object):
             raise ValueError("no data inside the domian specified")
         return data
 
+    def get_values_at_points(self, var, points=None, lons=None, lats=None,
+                             depths=None, times=None, max_cells=4000000, use_local=False,
+                             xyinds=None):
+        """
+
+        Sample a variable at many positions at once.
+
+        Positions are either a sequence of Location4D objects or parallel
+        lons, lats, depths and times sequences.  Every position is matched
+        to its nearest time, depth and grid location in vectorized form, the
+        union hyperslab of all of the matches is read once and the values
+        are scattered back into an array with one row per position.  When
+        the union would hold more than max_cells values the positions are
+        split into groups, each read as its own window of no more than
+        max_cells values (a group that shares every matched index is read
+        whole).
+
+        Grid locations that are already known can be passed as xyinds, a
+        dict of horizontal dimension name to one index per position, and
+        are used in place of the nearest grid location.  They are applied
+        to any dimension of the variable they name, with or without x/y
+        coordinates.
+
+        >> values = dataset.get_values_at_points("u", points=particles)
+        >> values = dataset.get_values_at_points("u", lons=lons, lats=lats,
+                                                 depths=depths, times=times)
+
+        """
+        assert var in self._current_variables
+        if points is not None:
+            lons = [p.longitude for p in points]
+            lats = [p.latitude for p in points]
+            depths = [p.depth for p in points]
+            times = [p.time for p in points]
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        npoints = lons.shape[0]
+
+        layout = self.get_axis_layout(var)
+        names = layout.names
+        dims = layout.dims
+
+        # Which coordinate each dimension of the variable is indexed by
+        roles = [None for d in dims]
+        for role, key in (("z", "z"), ("time", "time"), ("xy", "x"), ("xy", "y")):
+            for position in getattr(layout, key) or ():
+                roles[position] = role
+
+        indices = dict()
+        if xyinds is None and "xy" in roles:
+            xyinds = self.get_xyind_from_points(var, lons, lats)
+        if xyinds is not None:
+            # Also for dimensions without x/y coordinates, like the faces of a mesh
+            indices.update((d, ind) for d, ind in xyinds.items() if d in dims)
+        if "time" in roles:
+            if times is None or any(t is None for t in times):
+                raise ValueError("times are required to sample %s" % var)
+            tinds = np.asarray(self.gettimevar(var).nearest_index(times)).ravel()
+            for i, d in enumerate(dims):
+                if roles[i] == "time":
+                    indices[d] = tinds
+        if "z" in roles:
+            if depths is None or any(d is None for d in depths):
+                raise ValueError("depths are required to sample %s" % var)
+            depths = np.asarray(depths, dtype=np.float64).ravel()
+            depthvar = self.getdepthvar(var)
+            meters = np.asarray(depthvar.meters, dtype=np.float64)
+            zdims = self.nc.variables[names["zname"]].dimensions
+            vertical = [i for i, d in enumerate(zdims) if d in dims and roles[dims.index(d)] == "z"]
+            others = [d for i, d in enumerate(zdims) if i not in vertical]
+            if meters.ndim == 1:
+                profile = meters[np.newaxis, :]
+            elif len(vertical) == 1 and all(d in indices for d in others):
+                # Pull the depth profile at each position's grid location
+                profile = np.rollaxis(meters, vertical[0], meters.ndim)
+                profile = profile[tuple(indices[d] for d in others)]
+            else:
+                raise ValueError("Can not match depths against the %s coordinate of %s" % (names["zname"], var))
+            distance = np.abs(profile - depths[:, np.newaxis])
+            distance[np.isnan(distance)] = np.inf
+            zinds = np.argmin(distance, axis=1)
+            for i, d in enumerate(dims):
+                if roles[i] == "z":
+                    indices[d] = zinds
+
+        matched = [i for i, d in enumerate(dims) if d in indices]
+        unmatched = [i for i, d in enumerate(dims) if d not in indices]
+        inds = [np.asarray(indices[dims[i]], dtype=np.int64) for i in matched]
+
+        def read(select):
+            # Read the window spanning the selected positions, with the matched
+            # dimensions first, and pull out the value at each position
+            request = [None for d in dims]
+            for i, ind in zip(matched, inds):
+                request[i] = np.arange(ind[select].min(), ind[select].max() + 1)
+            for i in unmatched:
+                request[i] = np.arange(0, layout.shape[i])
+            block = self._get_data(var, request, use_local)
+            block = np.ma.asarray(block).reshape([r.shape[0] for r in request])
+            block = block.transpose(matched + unmatched)
+            return block[tuple(ind[select] - ind[select].min() for ind in inds)]
+
+        if len(inds) == 0 or npoints == 0:
+            return read(slice(None))
+        rest = np.prod([layout.shape[i] for i in unmatched])
+        if np.prod([ind.max() - ind.min() + 1 for ind in inds]) * rest <= max_cells:
+            return read(slice(None))
+
+        # Split the positions into groups whose windows fit in max_cells,
+        # across the widest gap of the most spread out dimension of each
+        # group that does not
+        values = None
+        groups = [np.arange(npoints)]
+        while groups:
+            select = groups.pop()
+            spans = [ind[select].max() - ind[select].min() + 1 for ind in inds]
+            if np.prod(spans) * rest > max_cells and max(spans) > 1:
+                ind = inds[int(np.argmax(spans))][select]
+                unique = np.unique(ind)
+                gaps = np.diff(unique)
+                # Widest gap, the one closest to the middle on a tie
+                middle = np.abs(np.arange(gaps.size) - (gaps.size - 1) / 2.)
+                split = unique[np.lexsort((middle, -gaps))[0]]
+                groups.append(select[ind <= split])
+                groups.append(select[ind > split])
+                continue
+            slab = read(select)
+            if values is None:
+                values = np.ma.masked_all((npoints,) + slab.shape[1:], dtype=slab.dtype)
+            values[select] = slab
+        return values
+
     def get_values_on_grid(self, var, lon, lat, **kwargs):
         z = kwargs.get('z', None)
         t = kwargs.get('t', None)
@@ -814,23 +1025,40 @@ class Dataset(object):
             zbounds = z
         else:
             zbounds = (np.min(np.min(np.min(np.min(z)))), np.max(np.max(np.max(np.max(z)))),)
-        if t is None:
-            tbounds = t
-        else:
-            if True:
-                tbounds = None
-                timeinds = np.arange(t[0], t[-1]+1)
-            else:
-                tbounds = (t[0], t[-1])
+        tbounds = None
         method = kwargs.get('method', 'nearest')
         raw_vals = self.get_values(var, zbounds=zbounds, bbox=bbox,
                                    timeinds=tinds, zinds=zinds, timebounds=tbounds)
         coords_struct = self.sub_coords(var, zbounds=zbounds, bbox=bbox,
                                         timeinds=tinds, zinds=zinds, timebounds=tbounds)
+        # Weights are kept for a few target grids, so later calls for other
+        # variables or times on the same coordinates skip the triangulation
+        if len(self._interpcache) > 8:
+            self._interpcache.clear()
+        source_t = None
+        if t is not None:
+            source_t, t = self._time_axis(var, t)
         interpolator = CfGeoInterpolator(raw_vals, coords_struct.x, coords_struct.y,
-                                         z=coords_struct.z, t=coords_struct.time, method=method)
+                                         z=coords_struct.z, t=source_t, method=method,
+                                         cache=self._interpcache)
         return interpolator.interpgrid(lon, lat, t=t, z=z)
 
+    def _time_axis(self, var, t):
+        """
+            The time axis of var and the target times t, in the units
+            get_values_on_grid interpolates time in: epoch seconds for a
+            Timevar or datetimes (naive datetimes are taken to be in the
+            time zone of the time variable), and time indexes for numbers,
+            where fractional indexes fall between time steps.
+        """
+        time = self.gettimevar(var)
+        if isinstance(t, Timevar):
+            return time.get_epoch_seconds(), t.get_epoch_seconds()
+        if hasattr(t[0], 'year'):
+            t = [d.replace(tzinfo=time._tzinfo) if d.tzinfo is None else d for d in t]
+            return time.get_epoch_seconds(), date2epoch(t)
+        return np.arange(time.shape[0], dtype=np.float64), np.asarray(t, dtype=np.float64)
+
     def _get_data(self, var, **kwargs):
         raise NotImplementedError
 
@@ -857,12 +1085,10 @@ class Dataset(object):
         assert times is not None
         assert len(times) == 2
         new = self._copy()
-        for var in new._current_variables:
-            time_dimension = new.gettimevar(var)
-            if time_dimension is not None:
-                inds = new.get_tind_from_bounds(var, times)
-                time_dimension = _sub_by_nan(time_dimension, inds[0][0])
-                new._coordcache[var].t = time_dimension
+        def restrict(var, time_dimension):
+            inds = new.get_tind_from_bounds(var, times)
+            return _sub_by_nan(time_dimension.copy(), inds[0])
+        new._restrict_coords('time', restrict)
         return new
 
     def restrict_vars(self, varlist = None):
@@ -876,18 +1102,17 @@ class Dataset(object):
         for var in self._current_variables:
             if (not var in set(varlist)) and (not var in set(coord_names)):
                 new._current_variables.remove(var)
+        new._layoutcache = dict()
         return new
 
     def restrict_depth(self, depths = None):
         assert depths is not None
         assert len(depths) == 2
         new = self._copy()
-        for var in new._current_variables:
-            depth_dimension = new.getdepthvar(var)
-            if depth_dimension is not None:
-                inds = new.get_zind_from_bounds(var, depths)
-                depth_dimension = _sub_by_nan(depth_dimension, inds[0])
-                new._coordcache[var].z = depth_dimension
+        def restrict(var, depth_dimension):
+            inds = new.get_zind_from_bounds(var, depths)
+            return _sub_by_nan(depth_dimension.copy(), inds[0])
+        new._restrict_coords('z', restrict)
         return new
 
     def nearest_point(self, point):
@@ -897,28 +1122,121 @@ class Dataset(object):
         new = self._copy()
         if type(depth) != Location4D:
             depth = Location4D(depth=depth, latitude=0, longitude=0)
-        for var in self._current_variables:
-            depth_dimension = new.getdepthvar(var)
-            if depth_dimension is not None:
-                ind = new.get_nearest_zind(var, depth)
-                depth_dimension = _sub_by_nan(depth_dimension, ind)
-                new._coordcache[var].z = depth_dimension
+        def restrict(var, depth_dimension):
+            ind = new.get_nearest_zind(var, depth)
+            return _sub_by_nan(depth_dimension.copy(), ind)
+        new._restrict_coords('z', restrict)
         return new
 
     def nearest_time(self, time):
         new = self._copy()
         if type(time) != Location4D:
             time = Location4D(time=time, latitude=0, longitude=0)
-        for var in self._current_variables:
-            time_dimension = new.gettimevar(var)
-            if time_dimension is not None:
-                ind = new.get_nearest_tind(var, time)
-                time_dimension = _sub_by_nan(time_dimension, ind)
-                new._coordcache[var].t = time_dimension
+        def restrict(var, time_dimension):
+            ind = new.get_nearest_tind(var, time)
+            return _sub_by_nan(time_dimension.copy(), ind)
+        new._restrict_coords('time', restrict)
         return new
 
     def save_as_grid(self, filename, lon, lat, **kwargs):
         pass
 
+    def _current_windows(self):
+        """
+            The (start, stop) index window of each dimension the current
+            variables are restricted along, from where their restricted
+            coordinates are not NaN.  A dimension restricted differently
+            for different variables gets the window covering all of them.
+        """
+        windows = dict()
+        for var in self._current_variables:
+            names = self.get_coord_names(var)
+            coords = []
+            if names['tname'] is not None:
+                coords.append((names['tname'], self.gettimevar(var)))
+            if names['zname'] is not None:
+                coords.append((names['zname'], self.getdepthvar(var)))
+            if names['xname'] is not None and names['yname'] is not None:
+                grid = self.getgridobj(var)
+                coords.append((grid._xname, grid._xarray))
+                coords.append((grid._yname, grid._yarray))
+            for name, values in coords:
+                dims = self.nc.variables[name].dimensions
+                values = np.asarray(values)
+                if values.ndim != len(dims) or values.dtype.kind != 'f':
+                    continue
+                valid = np.isfinite(values)
+                for axis, dim in enumerate(dims):
+                    inds = np.where(valid.any(axis=tuple(a for a in range(values.ndim) if a != axis)))[0]
+                    if inds.size == 0:
+                        raise ValueError("No data left in %s after the restrictions" % name)
+                    window = (inds[0], inds[-1] + 1)
+                    if dim in windows:
+                        window = (min(window[0], windows[dim][0]), max(window[1], windows[dim][1]))
+                    windows[dim] = window
+        return windows
+
     def save_current_as(self, filename, **kwargs):
-        pass
+        """
+            Write the current view of the dataset (after restrict_bbox,
+            restrict_time, restrict_depth and restrict_vars) to a new
+            netCDF file: the current variables over the index windows of
+            their restricted coordinates, with their attributes and the
+            global attributes.  Each variable is copied a block along its
+            first dimension at a time, so the subset never has to fit in
+            memory.  kwargs:
+            chunks -- chunk preset or shape of the new variables (see
+                      paegan.cdm.writer.chunk_shape), "balanced" by default
+            compress -- compress the new variables, True by default
+            block_size -- bytes to read at a time, 32 MB by default
+
+            >> dataset.restrict_bbox(bbox).restrict_time(times).save_current_as(filename)
+        """
+        chunks = kwargs.get('chunks', 'balanced')
+        compress = kwargs.get('compress', True)
+        block_size = kwargs.get('block_size', pw.BUFFER_SIZE)
+        windows = self._current_windows()
+        current = set(self._current_variables)
+        variables = [var for var in self.nc.variables if var in current]
+
+        def window(dim):
+            return windows.get(dim, (0, len(self.nc.dimensions[dim])))
+
+        with pw.WriterSession.new(filename, buffer_size=block_size) as session:
+            dims = OrderedDict()
+            for var in variables:
+                for dim in self.nc.variables[var].dimensions:
+                    if dim not in dims:
+                        start, stop = window(dim)
+                        dims[dim] = None if self.nc.dimensions[dim].isunlimited() else stop - start
+            session.add_coordinates(dims)
+
+            for var in variables:
+                ncvar = self.nc.variables[var]
+                # Only numbers are chunked and compressed
+                chunked = np.dtype(ncvar.dtype).kind in 'biuf' and len(ncvar.dimensions) > 0
+                session.create_variable(var, ncvar.dtype, ncvar.dimensions, compress=(compress and chunked),
+                                        fill=getattr(ncvar, '_FillValue', None),
+                                        chunks=(chunks if chunked else None))
+                for at in ncvar.ncattrs():
+                    session.add_attribute(at, ncvar.getncattr(at), var=var)
+            for at in self.nc.ncattrs():
+                session.add_attribute(at, self.nc.getncattr(at))
+            history = "subset by Python tool 'paegan' at " + str(datetime.datetime.now())
+            if "history" in self.nc.ncattrs():
+                history = self.nc.getncattr("history") + ", " + history
+            session.add_attribute("history", history)
+
+            for var in variables:
+                ncvar = self.nc.variables[var]
+                if len(ncvar.dimensions) == 0:
+                    session.write(var, ncvar[...])
+                    continue
+                windowed = [window(dim) for dim in ncvar.dimensions]
+                rest = [slice(start, stop) for start, stop in windowed[1:]]
+                row = np.prod([stop - start for start, stop in windowed[1:]]) * (np.dtype(ncvar.dtype).itemsize or 8)
+                rows = int(max(1, block_size // max(row, 1)))
+                first, last = windowed[0]
+                for b0 in xrange(first, last, rows):
+                    b1 = min(b0 + rows, last)
+                    session.write(var, ncvar[tuple([slice(b0, b1)] + rest)], start=b0 - first)
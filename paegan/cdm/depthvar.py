@@ -23,37 +23,43 @@ class Depthvar(np.ndarray):
     _meters2unit['kilometers'] = 0.001
     _meters2unit['miles'] = 0.000621371
 
-    def __new__(self, ncfile, name, units=None, **kwargs):
+    def __new__(cls, ncfile, name, units=None, **kwargs):
         if type(ncfile) is str:
             ncfile = netCDF4.Dataset(ncfile)
-        self._nc = ncfile
 
-        data = self._nc.variables[name][:]
+        data = ncfile.variables[name][:]
         if units == None:
             try:
-                self._units = self._nc.variables[name].units
+                units = ncfile.variables[name].units
             except StandardError:
-                self._units = 'meters'
-        else:
-            self._units = units
+                units = 'meters'
 
         # compatibility to CF convention v1.0/udunits names:
-        if self._units in ['m','meter','meters from the sea surface']:
-            self._units='meters'
-        if self._units in ['cm','centimeter']:
-            self._units='centimeters'
-        if self._units in ['mm','millimeter']:
-            self._units='millimeters'
-        if self._units in ['km','kilometer']:
-            self._units='kilometers'
-        if self._units in ['ft','feets']:
-            self._units='feet'
-        if self._units in ['yd','yard']:
-            self._units='yards'
-        if self._units in ['mile']:
-            self._units='miles'
+        if units in ['m','meter','meters from the sea surface']:
+            units='meters'
+        if units in ['cm','centimeter']:
+            units='centimeters'
+        if units in ['mm','millimeter']:
+            units='millimeters'
+        if units in ['km','kilometer']:
+            units='kilometers'
+        if units in ['ft','feets']:
+            units='feet'
+        if units in ['yd','yard']:
+            units='yards'
+        if units in ['mile']:
+            units='miles'
 
-        return data.view(self)
+        obj = np.asarray(data).view(cls)
+        obj._nc = ncfile
+        obj._units = units
+        return obj
+
+    def __array_finalize__(self, obj):
+        if obj is None:
+            return
+        self._nc = getattr(obj, '_nc', None)
+        self._units = getattr(obj, '_units', 'meters')
 
     def nearest_index(self, depth):
         return np.where(abs(self.meters-depth) == np.nanmin(abs(self.meters-depth)))[0]
@@ -3,6 +3,7 @@ import copy
 import numpy as np
 
 from paegan.cdm.dataset import Dataset, _sub_by_nan
+from paegan.location4d import Location4D
 
 
 class NCellDataset(Dataset):
@@ -11,6 +12,12 @@ class NCellDataset(Dataset):
         NCellDataset(Dataset)
 
     """
+    # Node selections are usually scattered over the mesh, keep them as
+    # separate runs rather than merging them into wide windows, but not
+    # at the cost of thousands of round trips to a server
+    max_slabs = 4096
+    remote_max_slabs = 64
+
     def __init__(self, *args,**kwargs):
         super(NCellDataset,self).__init__(*args, **kwargs)
         if None in self.nc.variables:
@@ -19,7 +26,7 @@ class NCellDataset(Dataset):
 
     def _copy(self):
         new = NCellDataset(self._filepath, self._datasettype)
-        new._coordcache = copy.copy(self._coordcache)
+        self._copycache(new)
         new._current_variables = copy.copy(self._current_variables)
         return new
 
@@ -27,25 +34,21 @@ class NCellDataset(Dataset):
         assert bbox != None
         assert len(bbox) == 4
         new = self._copy()
-        for var in new._current_variables:
-            grid = new.getgridobj(var)
-            if grid != None:
-                inds, inds =  new.get_xyind_from_bbox(var, bbox)
-                grid._xarray = _sub_by_nan(grid._xarray, inds[0][0])
-                grid._yarray = _sub_by_nan(grid._yarray, inds[0][0])
-                new._coordcache[var].xy = grid
+        def restrict(var, grid):
+            inds, inds = new.get_xyind_from_bbox(var, bbox)
+            return grid._with_arrays(_sub_by_nan(grid._xarray.copy(), inds[0]),
+                                     _sub_by_nan(grid._yarray.copy(), inds[0]))
+        new._restrict_coords('xy', restrict)
         return new
 
     def nearest_point(self, point):
         assert type(point) == Location4D
         new = self._copy()
-        for var in new._current_variables:
-            grid = new.getgridobj(var)
-            if grid != None:
-                inds, inds = new.get_xyind_from_point(var, point)
-                grid._xarray = _sub_by_nan(grid._xarray, inds)
-                grid._yarray = _sub_by_nan(grid._yarray, inds)
-                new._coordcache[var].xy = grid
+        def restrict(var, grid):
+            inds, inds = new.get_xyind_from_point(var, point)
+            return grid._with_arrays(_sub_by_nan(grid._xarray.copy(), inds),
+                                     _sub_by_nan(grid._yarray.copy(), inds))
+        new._restrict_coords('xy', restrict)
         return new
 
     def get_xyind_from_bbox(self, var, bbox):
@@ -61,28 +64,31 @@ class NCellDataset(Dataset):
         inds, inds = grid.near_xy(point=point, num=num, ncell=True)
         return inds, inds
 
+    def get_xyind_from_points(self, var, lons, lats):
+        grid = self.getgridobj(var)
+        inds = grid.nearest_indices(lons, lats, ncell=True)
+        return dict(zip(self.nc.variables[grid._xname].dimensions, inds))
+
+    def contains_points(self, lons, lats, var=None):
+        """
+            Boolean array, True where the position is inside of the convex
+            hull of the nodes (inside of a face of the mesh for a UGRID
+            mesh).
+        """
+        return self._domain_grid(var).contains_points(lons, lats, ncell=True)
+
+    def get_nearest_nodes(self, var, lons, lats, num=1):
+        """
+            Node indexes and distances (meters) of the num nearest nodes
+            to each of the points, as two (npoints, num) arrays sorted by
+            distance.
+        """
+        return self.getgridobj(var).nearest_neighbors(lons, lats, num)
+
     def _get_data(self, var, indarray, use_local=False):
-        ndims = len(indarray)
         if use_local == False:
-            var =    self.nc.variables[var]
+            var = self.nc.variables[var]
         else:
             pass
-        if ndims == 1:
-            data = var[:]
-            data = data[indarray]
-        elif ndims == 2:
-            data = var[:]
-            data = data[indarray[0], indarray[1]]
-        elif ndims == 3:
-            data = var[indarray[0], indarray[1], :]
-            data = data[:, :, indarray[2]]
-        elif ndims == 4:
-            data = var[indarray[0], indarray[1], indarray[2],
-                       indarray[3]]
-        elif ndims == 5:
-            data = var[indarray[0], indarray[1], indarray[2],
-                       indarray[3], indarray[4]]
-        elif ndims == 6:
-            data = var[indarray[0], indarray[1], indarray[2],
-                       indarray[3], indarray[4], indarray[5]]
-        return data
+
+        return self.readplanner.read(var, indarray)
@@ -3,6 +3,8 @@ import copy
 import numpy as np
 
 from paegan.cdm.dataset import Dataset, _sub_by_nan
+from paegan.location4d import Location4D
+from paegan.utils.asainterpolate import SeparableInterpolator, _bracket
 
 
 class RGridDataset(Dataset):
@@ -16,7 +18,7 @@ class RGridDataset(Dataset):
 
     def _copy(self):
         new = RGridDataset(self._filepath, self._datasettype)
-        new._coordcache = copy.copy(self._coordcache)
+        self._copycache(new)
         new._current_variables = copy.copy(self._current_variables)
         return new
 
@@ -24,33 +26,29 @@ class RGridDataset(Dataset):
         assert bbox != None
         assert len(bbox) == 4
         new = self._copy()
-        for var in new._current_variables:
-            grid = new.getgridobj(var)
-            if grid != None:
-                xinds, yinds =  new.get_xyind_from_bbox(var, bbox)
-                grid._xarray = _sub_by_nan(grid._xarray, xinds[0][0])
-                grid._yarray = _sub_by_nan(grid._yarray, yinds[0][0])
-                new._coordcache[var].xy = grid
+        def restrict(var, grid):
+            xinds, yinds = new.get_xyind_from_bbox(var, bbox)
+            return grid._with_arrays(_sub_by_nan(grid._xarray.copy(), xinds[0]),
+                                     _sub_by_nan(grid._yarray.copy(), yinds[0]))
+        new._restrict_coords('xy', restrict)
         return new
 
     def nearest_point(self, point):
         assert type(point) == Location4D
         new = self._copy()
-        for var in new._current_variables:
-            grid = new.getgridobj(var)
-            if grid != None:
-                xind, yind = new.get_xyind_from_point(var, point)
-                grid._xarray = _sub_by_nan(grid._xarray, xind)
-                grid._yarray = _sub_by_nan(grid._yarray, yind)
-                new._coordcache[var].xy = grid
+        def restrict(var, grid):
+            xind, yind = new.get_xyind_from_point(var, point)
+            return grid._with_arrays(_sub_by_nan(grid._xarray.copy(), xind),
+                                     _sub_by_nan(grid._yarray.copy(), yind))
+        new._restrict_coords('xy', restrict)
         return new
 
     def get_xyind_from_bbox(self, var, bbox):
         grid = self.getgridobj(var)
         xbool = grid.get_xbool_from_bbox(bbox)
         ybool = grid.get_ybool_from_bbox(bbox)
-        xinds = [np.where(xbool)]
-        yinds = [np.where(ybool)]
+        xinds = np.where(xbool)
+        yinds = np.where(ybool)
         return xinds, yinds #xinds, yinds
 
     def get_xyind_from_point(self, var, point, **kwargs):
@@ -59,27 +57,62 @@ class RGridDataset(Dataset):
         index = grid.near_xy(point=point, num=num)
         return index[1], index[0]
 
+    def get_xyind_from_points(self, var, lons, lats):
+        grid = self.getgridobj(var)
+        yinds, xinds = grid.nearest_indices(lons, lats)
+        return {self.nc.variables[grid._yname].dimensions[0] : yinds,
+                self.nc.variables[grid._xname].dimensions[0] : xinds}
+
+    def get_values_on_grid(self, var, lon, lat, **kwargs):
+        """
+            Interpolate var onto 1-D lon and lat axes, and optionally onto
+            depths (z) and times (t, a Timevar, datetimes or fractional time
+            indexes).
+            The rectilinear axes are interpolated one at a time with a
+            SeparableInterpolator, on the smallest window of the variable
+            that brackets the targets.  Anything that is not 1-D, or another
+            method than "nearest" or "linear", goes through Dataset's
+            scattered interpolation.
+
+            Returns an array in the dimension order of the variable.
+        """
+        z = kwargs.get('z', None)
+        t = kwargs.get('t', None)
+        method = kwargs.get('method', 'nearest')
+        layout = self.get_axis_layout(var)
+        depthvar = self.getdepthvar(var) if z is not None else None
+        if np.ndim(lon) != 1 or np.ndim(lat) != 1 or method not in ('nearest', 'linear') or \
+           layout.x is None or layout.y is None or \
+           (z is not None and (np.ndim(z) != 1 or depthvar is None or np.ndim(depthvar) != 1)) or \
+           (t is not None and layout.time is None):
+            return super(RGridDataset, self).get_values_on_grid(var, lon, lat, **kwargs)
+
+        grid = self.getgridobj(var)
+        axes = [None for d in layout.dims]
+        targets = [None for d in layout.dims]
+        axes[layout.x[0]], targets[layout.x[0]] = grid._xarray, lon
+        axes[layout.y[0]], targets[layout.y[0]] = grid._yarray, lat
+        if z is not None:
+            axes[layout.z[0]], targets[layout.z[0]] = np.asarray(depthvar), z
+        if t is not None:
+            axes[layout.time[0]], targets[layout.time[0]] = self._time_axis(var, t)
+
+        # Only read the window that brackets the targets
+        indarray = []
+        for axis, target, size in zip(axes, targets, layout.shape):
+            if target is None:
+                indarray.append(np.arange(size))
+            else:
+                lower, upper, weight, outside = _bracket(axis, target, method)
+                indarray.append(np.arange(min(lower.min(), upper.min()), max(lower.max(), upper.max()) + 1))
+        data = self._get_data(var, indarray)
+        axes = [None if a is None else np.asarray(a)[ind] for a, ind in zip(axes, indarray)]
+        return SeparableInterpolator(data, axes, method=method).interpgrid(*targets)
+
     def _get_data(self, var, indarray, use_local=False):
-        ndims = len(indarray)
-        #print "this is what im trying to get", indarray
         if use_local == False:
             var = self.nc.variables[var]
         else:
             pass
 
-        if ndims == 1:
-            data = var[indarray]
-        elif ndims == 2:
-            data = var[indarray[0], indarray[1]]
-        elif ndims == 3:
-            data = var[indarray[0], indarray[1], indarray[2]]
-        elif ndims == 4:
-            data = var[indarray[0], indarray[1], indarray[2],
-                       indarray[3]]
-        elif ndims == 5:
-            data = var[indarray[0], indarray[1], indarray[2],
-                       indarray[3], indarray[4]]
-        elif ndims == 6:
-            data = var[indarray[0], indarray[1], indarray[2],
-                       indarray[3], indarray[4], indarray[5]]
-        return data
+        return self.readplanner.read(var, indarray)
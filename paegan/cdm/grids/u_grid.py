@@ -1,2 +1,152 @@
-class UGridDataset(object):
-    pass
+import copy
+
+import numpy as np
+
+from paegan.cdm.dataset import Dataset, _readonly
+from paegan.cdm.grids.n_cell import NCellDataset
+from paegan.cdm.meshvar import Meshobj
+
+
+def find_mesh_topology(nc):
+    """
+        Names of the UGRID mesh topology variables in a netCDF4 dataset
+        (the variables with a cf_role of "mesh_topology").
+    """
+    return [name for name, v in nc.variables.items()
+            if getattr(v, 'cf_role', None) == 'mesh_topology']
+
+
+class UGridDataset(NCellDataset):
+    """
+
+        UGridDataset(NCellDataset)
+
+        An unstructured mesh following the UGRID conventions.  The faces
+        of the mesh are read from the face_node_connectivity of its mesh
+        topology variable and indexed, so points can be located in their
+        face with barycentric weights and bboxes resolved without testing
+        every node.
+
+        >> dataset = CommonDataset.open(url, dataset_type="ugrid")
+        >> faces, nodes, weights = dataset.getmeshobj().locate(lons, lats)
+        >> values = dataset.get_values_at_points("temp", lons=lons, lats=lats,
+                                                 depths=depths, times=times,
+                                                 method="linear")
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(UGridDataset, self).__init__(*args, **kwargs)
+        meshes = find_mesh_topology(self.nc)
+        if len(meshes) == 0:
+            raise ValueError("%s has no mesh_topology variable" % self._filepath)
+        self._mesh_name = meshes[0]
+
+    def _copy(self):
+        new = UGridDataset(self._filepath, self._datasettype)
+        self._copycache(new)
+        new._current_variables = copy.copy(self._current_variables)
+        return new
+
+    def _mesh_of(self, var=None):
+        if var is not None:
+            mesh = getattr(self.nc.variables[var], 'mesh', None)
+            if mesh in self.nc.variables:
+                return mesh
+        return self._mesh_name
+
+    def getmeshobj(self, var=None):
+        """
+            The Meshobj of the mesh a variable is defined on (the first mesh
+            of the file when var is None).  It is shared with the variables
+            on the mesh nodes as their grid object.
+        """
+        mesh = self._mesh_of(var)
+        meshobj = self._coordvars.get(('mesh', mesh))
+        if meshobj is None:
+            topology = self.nc.variables[mesh]
+            xname, yname = topology.node_coordinates.split()[:2]
+            meshobj = self._coordvars.get(('xy', xname, yname))
+            if not isinstance(meshobj, Meshobj):
+                meshobj = _readonly(Meshobj(self.nc, xname, yname,
+                                            facename=topology.face_node_connectivity,
+                                            face_dimension=getattr(topology, 'face_dimension', None)))
+                self._coordvars[('xy', xname, yname)] = meshobj
+            self._coordvars[('mesh', mesh)] = meshobj
+        return meshobj
+
+    def getgridobj(self, var=None):
+        # Register the mesh first so the node coordinates resolve to it
+        self.getmeshobj(var)
+        return super(UGridDataset, self).getgridobj(var)
+
+    def _find_coord_names(self, var=None, **kwargs):
+        names = super(UGridDataset, self)._find_coord_names(var, **kwargs)
+        ncvar = self.nc.variables[var]
+        location = getattr(ncvar, 'location', None)
+        mesh = getattr(ncvar, 'mesh', None)
+        if location is not None and mesh in self.nc.variables:
+            coordinates = getattr(self.nc.variables[mesh], location + '_coordinates', '').split()
+            if len(coordinates) >= 2:
+                if names['xname'] is None and 'xname' not in kwargs:
+                    names['xname'] = coordinates[0]
+                if names['yname'] is None and 'yname' not in kwargs:
+                    names['yname'] = coordinates[1]
+        return names
+
+    def contains_points(self, lons, lats, var=None):
+        """
+            Boolean array, True where the position is inside of a face of
+            the mesh of var (the first mesh when var is None).
+        """
+        return self.getmeshobj(var).contains_points(lons, lats)
+
+    def get_xyind_from_bbox(self, var, bbox):
+        grid = self.getgridobj(var)
+        if isinstance(grid, Meshobj):
+            inds = (grid.nodes_in_bbox(bbox),)
+            return inds, inds #xinds, yinds
+        return super(UGridDataset, self).get_xyind_from_bbox(var, bbox)
+
+    def get_values_at_points(self, var, points=None, lons=None, lats=None,
+                             depths=None, times=None, method='nearest', **kwargs):
+        """
+            Dataset.get_values_at_points, with method="linear" weighting
+            the values at the three nodes of the triangle holding each
+            position by its barycentric weights.  Face variables take the
+            value of the face holding the position.  Positions outside
+            the mesh are masked.
+        """
+        if method == 'nearest':
+            return Dataset.get_values_at_points(self, var, points=points, lons=lons, lats=lats,
+                                                depths=depths, times=times, **kwargs)
+        if points is not None:
+            lons = [p.longitude for p in points]
+            lats = [p.latitude for p in points]
+            depths = [p.depth for p in points]
+            times = [p.time for p in points]
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        meshobj = self.getmeshobj(var)
+        faces, nodes, weights = meshobj.locate(lons, lats)
+        outside = faces < 0
+
+        if getattr(self.nc.variables[var], 'location', 'node') == 'face':
+            xyinds = {meshobj._face_dim : np.where(outside, 0, faces)}
+            values = Dataset.get_values_at_points(self, var, lons=lons, lats=lats, depths=depths,
+                                                  times=times, xyinds=xyinds, **kwargs)
+            values = np.ma.array(values)
+            values[outside] = np.ma.masked
+            return values
+
+        # Sample each position at the three nodes of its triangle
+        nodedim = self.nc.variables[meshobj._xname].dimensions[0]
+        xyinds = {nodedim : np.where(outside[:, np.newaxis], 0, nodes).ravel()}
+        repeat = lambda a: None if a is None else np.repeat(np.asarray(a).ravel(), 3)
+        values = Dataset.get_values_at_points(self, var, lons=repeat(lons), lats=repeat(lats),
+                                              depths=repeat(depths), times=repeat(times),
+                                              xyinds=xyinds, **kwargs)
+        values = np.ma.asarray(values).reshape((lons.shape[0], 3) + values.shape[1:])
+        w = np.where(outside[:, np.newaxis], 0, weights).reshape(weights.shape + (1,) * (values.ndim - 2))
+        values = (values * w).sum(axis=1)
+        values[outside] = np.ma.masked
+        return values
@@ -1,11 +1,62 @@
+import copy
 import numpy as np
 import netCDF4
 from paegan.utils.asagreatcircle import AsaGreatCircle
 from paegan.location4d import Location4D
-from shapely.geometry import MultiLineString, LineString
-from shapely.ops import polygonize
+from shapely.geometry import LineString, Point, Polygon
+from shapely.ops import polygonize, unary_union
+from shapely.prepared import prep
+from scipy.spatial import cKDTree, ConvexHull
+try:
+    from shapely import vectorized
+except ImportError:
+    # Needs the compiled shapely speedups
+    vectorized = None
+
+def _lonlat_to_xyz(lon, lat):
+    """
+        Cartesian coordinates on the unit sphere for arrays of
+        longitudes and latitudes in decimal degrees.  Chord lengths
+        between these points are monotonic with great circle distance,
+        so they can be indexed with a KD-tree.
+    """
+    lon = np.radians(np.asarray(lon, dtype=np.float64).ravel())
+    lat = np.radians(np.asarray(lat, dtype=np.float64).ravel())
+    coslat = np.cos(lat)
+    return np.column_stack((coslat * np.cos(lon), coslat * np.sin(lon), np.sin(lat)))
+
+def _nearest_1d(axis, values):
+    """
+        Index of the closest element of the 1-D `axis` for each of the
+        `values`.  Uses a binary search when the axis is monotonic and
+        falls back to comparing against every element otherwise.
+    """
+    axis = np.asarray(axis, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).ravel()
+    diffs = np.diff(axis)
+    if axis.shape[0] > 1 and np.all(np.isfinite(axis)) and (np.all(diffs > 0) or np.all(diffs < 0)):
+        flip = diffs[0] < 0
+        if flip:
+            axis = axis[::-1]
+        right = np.clip(np.searchsorted(axis, values), 1, axis.shape[0] - 1)
+        left = right - 1
+        inds = np.where(np.abs(values - axis[left]) <= np.abs(axis[right] - values), left, right)
+        if flip:
+            inds = axis.shape[0] - 1 - inds
+        return inds
+    distance = np.abs(axis[np.newaxis, :] - values[:, np.newaxis])
+    distance[np.isnan(distance)] = np.inf
+    return np.argmin(distance, axis=1)
 
 class Gridobj:
+
+    # Number of extra KD-tree candidates that are refined with Vincenty
+    # distances, to absorb the difference between the sphere and ellipsoid
+    _refine_candidates = 8
+
+    # Rows and columns per block of the curvilinear bbox index
+    _block_size = 32
+
     def __init__(self, nc, xname=None, yname=None,
         xunits=None, yunits=None, projected=False, **kwargs):
         self._projected = projected
@@ -19,6 +70,10 @@ class Gridobj:
         self._ymesh = None
         self._xmesh = None
         self._type = None
+        self._kdtree = None
+        self._blockindex = None
+        self._boundingpolygon = None
+        self._hull = None
 
         if self._xname != None:
             self._x_nc = self._nc.variables[self._xname]
@@ -36,6 +91,20 @@ class Gridobj:
             self._yarray = np.asarray((),)
 
 
+    def _with_arrays(self, xarray, yarray):
+        """
+            Copy of this grid around new coordinate arrays, e.g. ones that
+            were restricted with NaNs.  The KD-tree is rebuilt on demand.
+        """
+        new = copy.copy(self)
+        new._xarray = xarray
+        new._yarray = yarray
+        new._kdtree = None
+        new._blockindex = None
+        new._boundingpolygon = None
+        new._hull = None
+        return new
+
     def get_xbool_from_bbox(self, bbox):
         return np.logical_and(self._xarray<=bbox[2],
                               self._xarray>=bbox[0])
@@ -80,38 +149,90 @@ class Gridobj:
             bbox = xtmp[0], self.ymin, xtmp[-1], self.ymax
         return bbox
 
-    def get_boundingpolygon(self):
+    def _perimeter(self):
         """
-            TODO: Implement ncell bbox
-
-            order of lines creation (assumes 0,0 is x)
+            (n, 2) closed ring of x/y pairs around the edge of the grid,
+            in this order (assumes 0,0 is x)
             -----3-----
             |         |
             4         2
             |         |
             x----1-----
         """
-
+        x, y = self._xarray, self._yarray
         if self._ndim == 2: # CGRID
-            nx,ny = self._xarray.shape
-            one = MultiLineString([((self._xarray[i][0],self._yarray[i][0]),(self._xarray[i+1][0],self._yarray[i+1][0])) for i in range(nx-1)])
-            two = MultiLineString([((self._xarray[nx-1][j],self._yarray[nx-1][j]),(self._xarray[nx-1][j+1],self._yarray[nx-1][j+1])) for j in range(ny-1)])
-            three = MultiLineString([((self._xarray[i][ny-1],self._yarray[i][ny-1]),(self._xarray[i-1][ny-1],self._yarray[i-1][ny-1])) for i in reversed(range(1,nx))])
-            four = MultiLineString([((self._xarray[0][j],self._yarray[0][j]),(self._xarray[0][j-1],self._yarray[0][j-1])) for j in reversed(range(1,ny))])
-            m = one.union(two).union(three).union(four)
+            xs = np.concatenate((x[:, 0], x[-1, 1:], x[-2::-1, -1], x[0, -2::-1]))
+            ys = np.concatenate((y[:, 0], y[-1, 1:], y[-2::-1, -1], y[0, -2::-1]))
         else: # RGRID
-            nx,ny = self._xarray.shape[0], self._yarray.shape[0]
-            one = LineString([(self._xarray[i], self._yarray[0]) for i in range(nx)])
-            two = LineString([(self._xarray[-1], self._yarray[i]) for i in range(ny)])
-            three = LineString([(self._xarray[i], self._yarray[-1]) for i in reversed(range(nx))])
-            four = LineString([(self._xarray[0], self._yarray[i]) for i in reversed(range(ny))])
-            m = MultiLineString([one,two,three,four])
-
-        polygons = list(polygonize(m))
-        # -- polygonize returns a list of polygons, including interior features, the largest in area "should" be the full feature
-        assert len(polygons) > 0, "Could not determine a polygon"
-        polygon = sorted(polygons, key=lambda x: x.area)[-1]
-        return polygon
+            nx, ny = x.shape[0], y.shape[0]
+            xs = np.concatenate((x, np.repeat(x[-1], ny - 1), x[-2::-1], np.repeat(x[0], ny - 1)))
+            ys = np.concatenate((np.repeat(y[0], nx), y[1:], np.repeat(y[-1], nx - 1), y[-2::-1]))
+        return np.column_stack((xs, ys))
+
+    def get_boundingpolygon(self):
+        """
+            TODO: Implement ncell bbox
+
+            Polygon around the edge of the grid, built once and reused
+            until the coordinate arrays are replaced.
+        """
+        if self._boundingpolygon is None or \
+           self._boundingpolygon[0] is not self._xarray or \
+           self._boundingpolygon[1] is not self._yarray:
+            ring = self._perimeter()
+            polygon = Polygon(ring)
+            if not polygon.is_valid:
+                # The edge crosses itself, split it where it does and keep
+                # the largest of the pieces
+                polygons = list(polygonize(unary_union(LineString(ring))))
+                # -- polygonize returns a list of polygons, including interior features, the largest in area "should" be the full feature
+                assert len(polygons) > 0, "Could not determine a polygon"
+                polygon = sorted(polygons, key=lambda x: x.area)[-1]
+            self._boundingpolygon = (self._xarray, self._yarray, polygon, None)
+        return self._boundingpolygon[2]
+
+    def get_prepared_boundingpolygon(self):
+        """
+            The bounding polygon as a prepared geometry, for repeated
+            contains/intersects tests against it.
+        """
+        polygon = self.get_boundingpolygon()
+        if self._boundingpolygon[3] is None:
+            self._boundingpolygon = self._boundingpolygon[:3] + (prep(polygon),)
+        return self._boundingpolygon[3]
+
+    def get_prepared_hull(self):
+        """
+            Prepared convex hull of the finite x/y pairs, the domain of an
+            ncell grid, built once and reused until the coordinate arrays
+            are replaced.
+        """
+        if self._hull is None or \
+           self._hull[0] is not self._xarray or \
+           self._hull[1] is not self._yarray:
+            x = self._xarray.ravel()
+            y = self._yarray.ravel()
+            valid = np.logical_and(np.isfinite(x), np.isfinite(y))
+            points = np.column_stack((x[valid], y[valid]))
+            hull = Polygon(points[ConvexHull(points).vertices])
+            self._hull = (self._xarray, self._yarray, prep(hull))
+        return self._hull[2]
+
+    def contains_points(self, lons, lats, ncell=False):
+        """
+            Boolean array, True where the point is inside of the grid's
+            bounding polygon (the convex hull of the nodes for ncell).
+        """
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        if ncell:
+            domain = self.get_prepared_hull()
+        else:
+            domain = self.get_prepared_boundingpolygon()
+        if vectorized is not None:
+            return vectorized.contains(domain, lons, lats)
+        return np.fromiter((domain.contains(Point(x, y)) for x, y in zip(lons, lats)),
+                           dtype=bool, count=lons.shape[0])
 
     def get_projectedbool(self):
         return self._projected
@@ -133,9 +254,193 @@ class Gridobj:
     def bbox_to_wkt(self):
         pass
 
+    def get_kdtree(self):
+        """
+            cKDTree over the unit sphere positions of every finite
+            x/y pair, built once and reused until the coordinate arrays
+            are replaced.  Returns the tree and the flat indices of the
+            cells it was built from.
+        """
+        if self._kdtree is None or \
+           self._kdtree[0] is not self._xarray or \
+           self._kdtree[1] is not self._yarray:
+            x = self._xarray.ravel()
+            y = self._yarray.ravel()
+            valid = np.where(np.logical_and(np.isfinite(x), np.isfinite(y)))[0]
+            tree = cKDTree(_lonlat_to_xyz(x[valid], y[valid]))
+            self._kdtree = (self._xarray, self._yarray, tree, valid)
+        return self._kdtree[2], self._kdtree[3]
+
+    def get_blockindex(self):
+        """
+            Extents of square blocks of cells of a 2-D grid, built once
+            and reused until the coordinate arrays are replaced.  Returns
+            a dict holding the x and y arrays padded with NaN and split
+            into (block rows, block columns, size, size) blocks, the
+            min/max x and y of each block (blocks of NaN have inverted
+            extents) and whether each block is free of NaN.
+        """
+        if self._blockindex is None or \
+           self._blockindex["x"] is not self._xarray or \
+           self._blockindex["y"] is not self._yarray:
+            size = self._block_size
+            rows, cols = self._xarray.shape
+            nbr, nbc = -(-rows // size), -(-cols // size)
+            index = {"x" : self._xarray, "y" : self._yarray, "shape" : (nbr, nbc)}
+            for key, array in (("x", self._xarray), ("y", self._yarray)):
+                padded = np.nan * np.ones((nbr * size, nbc * size))
+                padded[:rows, :cols] = array
+                blocks = padded.reshape(nbr, size, nbc, size).swapaxes(1, 2).copy()
+                nan = np.isnan(blocks)
+                index[key + "blocks"] = blocks
+                index[key + "min"] = np.where(nan, np.inf, blocks).min(axis=3).min(axis=2)
+                index[key + "max"] = np.where(nan, -np.inf, blocks).max(axis=3).max(axis=2)
+                index[key + "nan"] = nan.any(axis=3).any(axis=2)
+            index["complete"] = ~(index["xnan"] | index["ynan"])
+            self._blockindex = index
+        return self._blockindex
+
+    def window_from_bbox(self, bbox):
+        """
+            (minrow, maxrow, mincol, maxcol) of the cells of a 2-D grid
+            inside the bbox (minx, miny, maxx, maxy), or None when there
+            are none.  The same window as masking every cell, but blocks
+            entirely inside or outside of the bbox are decided from their
+            extents and only the cells of blocks crossing its edge are
+            tested.
+        """
+        index = self.get_blockindex()
+        size = self._block_size
+        overlap = (index["xmin"] <= bbox[2]) & (index["xmax"] >= bbox[0]) & \
+                  (index["ymin"] <= bbox[3]) & (index["ymax"] >= bbox[1])
+        inside = overlap & index["complete"] & \
+                 (index["xmin"] >= bbox[0]) & (index["xmax"] <= bbox[2]) & \
+                 (index["ymin"] >= bbox[1]) & (index["ymax"] <= bbox[3])
+        rows, cols = [], []
+
+        br, bc = np.where(inside)
+        if br.size > 0:
+            rows += [br.min() * size, br.max() * size + size - 1]
+            cols += [bc.min() * size, bc.max() * size + size - 1]
+
+        br, bc = np.where(overlap & ~inside)
+        if br.size > 0:
+            x = index["xblocks"][br, bc]
+            y = index["yblocks"][br, bc]
+            with np.errstate(invalid='ignore'):
+                hit = (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+            k, r = np.where(hit.any(axis=2))
+            rows += list(br[k] * size + r)
+            k, c = np.where(hit.any(axis=1))
+            cols += list(bc[k] * size + c)
+
+        if len(rows) == 0:
+            return None
+        # Padding cells are NaN and never inside, so the window stays on the grid
+        return min(rows), max(rows), min(cols), max(cols)
+
+    def _nearest_cells(self, lons, lats, num=1):
+        """
+            Flat cell indices and Vincenty distances (meters) of the `num`
+            nearest cells to each of the points, sorted by distance.  The
+            KD-tree narrows the search down to a few candidates per point,
+            and only those candidates are measured on the ellipsoid.
+
+            Returns two (npoints, num) arrays.  Slots that could not be
+            filled have an index of -1 and a distance of inf.
+        """
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        tree, valid = self.get_kdtree()
+        inds = -1 * np.ones((lons.shape[0], num), dtype=np.int64)
+        dists = np.inf * np.ones((lons.shape[0], num))
+        if valid.shape[0] == 0:
+            return inds, dists
+
+        k = min(num + self._refine_candidates, valid.shape[0])
+        chord, tinds = tree.query(_lonlat_to_xyz(lons, lats), k=k)
+        candidates = valid[np.reshape(tinds, (lons.shape[0], k))]
+
+        distance = AsaGreatCircle.great_distance(
+            start_lats=self._yarray.ravel()[candidates],
+            start_lons=self._xarray.ravel()[candidates],
+            end_lats=lats[:, np.newaxis], end_lons=lons[:, np.newaxis])["distance"]
+        # Cells blanked out since the tree was built can not be returned
+        distance = np.where(np.isfinite(distance), distance, np.inf)
+
+        order = np.argsort(distance, axis=1, kind='mergesort')[:, :num]
+        rows = np.arange(lons.shape[0])[:, np.newaxis]
+        found = min(num, k)
+        inds[:, :found] = candidates[rows, order]
+        dists[:, :found] = distance[rows, order]
+        inds[np.isinf(dists)] = -1
+        return inds, dists
+
+    def nearest_neighbors(self, lons, lats, num=1):
+        """
+            The `num` nearest cells (nodes for an ncell grid) to each of
+            the points, using the cached KD-tree.
+
+            Returns (inds, dists), two (npoints, num) arrays sorted by
+            distance.  inds are flat indexes into the coordinate arrays
+            and dists are in meters.  Slots beyond the number of valid
+            cells have an index of -1 and a distance of inf.
+
+            >> inds, dists = grid.nearest_neighbors(lons, lats, num=4)
+            >> weights = 1. / dists
+        """
+        return self._nearest_cells(lons, lats, num)
+
+    def nearest_indices(self, lons, lats, ncell=False):
+        """
+            Index of the closest grid location to each of many points, as
+            a tuple with one array per dimension of the coordinate
+            variables:
+
+            curvilinear grid  -> (row indexes, column indexes)
+            rectilinear grid  -> (y indexes, x indexes)
+            ncell             -> (node indexes,)
+        """
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        if ncell or self._ndim == 2:
+            inds = self._nearest_cells(lons, lats, 1)[0][:, 0]
+            if np.any(inds < 0):
+                raise ValueError("No valid grid locations to search")
+            if ncell:
+                return (inds,)
+            return np.unravel_index(inds, self._xarray.shape)
+        return _nearest_1d(self._yarray, lats), _nearest_1d(self._xarray, lons)
+
+    def _near_cells(self, point, num):
+        """
+            Indexes of the `num` closest cells to `point`, one array per
+            dimension of the coordinate variables (rows and columns of a
+            2-D grid, nodes of an ncell grid).  Ties with the closest cell
+            are all returned when num is 1.
+        """
+        # Ask for more than one cell to find the ties
+        wanted = num if num > 1 else 1 + self._refine_candidates
+        inds, dists = self._nearest_cells(point.longitude, point.latitude, wanted)
+        inds, dists = inds[0], dists[0]
+        if np.isinf(dists[0]):
+            # Nothing usable in the index, measure every cell
+            distance = AsaGreatCircle.great_distance(
+                start_lats=self._yarray, start_lons=self._xarray,
+                end_lats=point.latitude, end_lons=point.longitude)["distance"]
+            return np.where(distance == np.nanmin(distance))
+
+        if num == 1:
+            # In index order, like a scan of every cell
+            inds = np.sort(inds[dists == dists[0]])
+        else:
+            inds = inds[np.isfinite(dists)]
+        return np.unravel_index(inds, self._xarray.shape)
+
     def near_xy(self, **kwargs):
         """
-            TODO: Implement ncell near_xy
+            Indexes of the grid locations closest to a point.  With num > 1
+            the num closest are returned, ordered by distance.
         """
         point = kwargs.get("point", None)
         if point == None:
@@ -145,20 +450,11 @@ class Gridobj:
         num = kwargs.get("num", 1)
         ncell = kwargs.get("ncell", False)
         if ncell:
-            if num > 1:
-                pass
-            else:
-                distance = AsaGreatCircle.great_distance(
-                    start_lats=self._yarray, start_lons=self._xarray,
-                    end_lats=point.latitude, end_lons=point.longitude)["distance"]
-                inds = np.where(distance == np.nanmin(distance))
-                xinds, yinds = inds, inds
+            inds = self._near_cells(point, num or 1)
+            xinds, yinds = inds, inds
         else:
             if self._ndim == 2:
-                distance = AsaGreatCircle.great_distance(
-                    start_lats=self._yarray, start_lons=self._xarray,
-                    end_lats=point.latitude, end_lons=point.longitude)["distance"]
-                yinds, xinds = np.where(distance == np.nanmin(distance))
+                yinds, xinds = self._near_cells(point, num or 1)
             else:
                 #if self._xmesh == None and self._ymesh == None:
                 #    self._xmesh, self._ymesh = np.meshgrid(self._xarray, self._yarray)
@@ -183,6 +479,7 @@ class Gridobj:
     ymin = property(get_ymin, None)
     bbox = property(get_bbox, None)
     boundingpolygon = property(get_boundingpolygon, None)
+    prepared_boundingpolygon = property(get_prepared_boundingpolygon, None)
     xunits = property(get_xunits, None)
     yunits = property(get_yunits, None)
     _findy = findy
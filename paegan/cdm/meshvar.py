@@ -0,0 +1,198 @@
+import numpy as np
+from paegan.cdm.gridvar import Gridobj
+
+def _expand(starts, counts):
+    """
+        Concatenation of range(start, start + count) for every start and
+        count, along with the position each value came from.
+    """
+    total = counts.sum()
+    owner = np.repeat(np.arange(counts.shape[0]), counts)
+    offset = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offset, owner
+
+class Meshobj(Gridobj):
+    """
+        The node coordinates of an unstructured mesh along with its face
+        connectivity.
+
+        Faces with more than three nodes are split into triangles around
+        their first node.  The triangles are registered in a regular grid
+        of bins over the mesh (about one triangle per bin on average), so
+        locating a point or collecting the faces in a bbox only looks at
+        the triangles of the bins it touches.
+    """
+
+    # Barycentric weights this far below zero still count as inside, so
+    # points on a shared edge are not lost to rounding
+    _tolerance = 1e-9
+
+    def __init__(self, nc, xname=None, yname=None, facename=None, start_index=None, **kwargs):
+        Gridobj.__init__(self, nc, xname, yname, **kwargs)
+        self._facename = facename
+
+        facevar = self._nc.variables[facename]
+        faces = np.ma.filled(np.ma.asarray(facevar[:]), -1).astype(np.int64)
+        if start_index is None:
+            start_index = getattr(facevar, 'start_index', None)
+        if start_index is None:
+            # FVCOM and ADCIRC number their nodes from one
+            start_index = 1 if faces.min() > 0 and faces.max() == self._xarray.shape[0] else 0
+        faces = np.where(faces >= 0, faces - int(start_index), -1)
+
+        # (nface, nmax) order, FVCOM stores nv as (three, nele)
+        nodedim = facevar.dimensions[1]
+        if kwargs.get('face_dimension', None) is not None:
+            if facevar.dimensions[1] == kwargs['face_dimension']:
+                faces = faces.T
+                nodedim = facevar.dimensions[0]
+        elif faces.shape[0] < faces.shape[1] and faces.shape[0] <= 8:
+            faces = faces.T
+            nodedim = facevar.dimensions[0]
+        self._faces = faces
+        self._face_dim = [d for d in facevar.dimensions if d != nodedim][0]
+
+        # Fan triangulation
+        tris, owners = [], []
+        for k in range(1, faces.shape[1] - 1):
+            valid = np.where((faces[:, 0] >= 0) & (faces[:, k] >= 0) & (faces[:, k+1] >= 0))[0]
+            tris.append(np.column_stack((faces[valid, 0], faces[valid, k], faces[valid, k+1])))
+            owners.append(valid)
+        self._triangles = np.concatenate(tris)
+        self._triangle_face = np.concatenate(owners)
+
+        used = np.zeros(self._xarray.shape[0], dtype=bool)
+        used[self._triangles.ravel()] = True
+        self._orphans = np.where(~used)[0]
+
+        self._build_bins()
+
+    def _build_bins(self):
+        x = np.asarray(self._xarray, dtype=np.float64)
+        y = np.asarray(self._yarray, dtype=np.float64)
+        tx, ty = x[self._triangles], y[self._triangles]
+        self._tri_bounds = np.column_stack((tx.min(1), ty.min(1), tx.max(1), ty.max(1)))
+
+        finite = np.isfinite(self._tri_bounds).all(axis=1)
+        ntri = max(1, finite.sum())
+        x0, y0 = np.nanmin(x), np.nanmin(y)
+        width = max(np.nanmax(x) - x0, 1e-12)
+        height = max(np.nanmax(y) - y0, 1e-12)
+        nbx = int(max(1, np.ceil(np.sqrt(ntri * width / height))))
+        nby = int(max(1, np.ceil(ntri / float(nbx))))
+        self._bins = (x0, y0, width / nbx, height / nby, nbx, nby)
+
+        bounds = self._tri_bounds[finite]
+        ix0, iy0 = self._bin_of(bounds[:, 0], bounds[:, 1])
+        ix1, iy1 = self._bin_of(bounds[:, 2], bounds[:, 3])
+        nx = ix1 - ix0 + 1
+        counts = nx * (iy1 - iy0 + 1)
+        local, owner = _expand(np.zeros(counts.shape[0], dtype=np.int64), counts)
+        bins = (iy0[owner] + local // nx[owner]) * nbx + ix0[owner] + local % nx[owner]
+        order = np.argsort(bins, kind='mergesort')
+        self._bin_triangles = np.where(finite)[0][owner[order]]
+        self._bin_starts = np.searchsorted(bins[order], np.arange(nbx * nby + 1))
+
+    def _bin_of(self, x, y):
+        x0, y0, dx, dy, nbx, nby = self._bins
+        ix = np.clip(np.floor((x - x0) / dx), 0, nbx - 1).astype(np.int64)
+        iy = np.clip(np.floor((y - y0) / dy), 0, nby - 1).astype(np.int64)
+        return ix, iy
+
+    def _candidates(self, bins):
+        """
+            (triangles, owner) pairs for every triangle registered in each
+            of the bins, owner being the position in `bins`.
+        """
+        starts = self._bin_starts[bins]
+        counts = self._bin_starts[bins + 1] - starts
+        slots, owner = _expand(starts, counts)
+        return self._bin_triangles[slots], owner
+
+    def locate(self, lons, lats):
+        """
+            Triangle containing each point and the barycentric weights of
+            its three nodes.
+
+            Returns (faces, nodes, weights).  faces holds the index of the
+            containing face (-1 outside the mesh), nodes the (n, 3) node
+            indexes of the containing triangle and weights the matching
+            (n, 3) weights, which sum to one.  Points outside the mesh
+            have -1 nodes and NaN weights.
+        """
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        npoints = lons.shape[0]
+        faces = -np.ones(npoints, dtype=np.int64)
+        nodes = -np.ones((npoints, 3), dtype=np.int64)
+        weights = np.nan * np.ones((npoints, 3))
+
+        x0, y0, dx, dy, nbx, nby = self._bins
+        inside = np.where((lons >= x0) & (lons <= x0 + dx * nbx) & (lats >= y0) & (lats <= y0 + dy * nby))[0]
+        if inside.size == 0:
+            return faces, nodes, weights
+        ix, iy = self._bin_of(lons[inside], lats[inside])
+        tri, owner = self._candidates(iy * nbx + ix)
+        point = inside[owner]
+
+        # Barycentric weights against the current (possibly restricted) nodes
+        verts = self._triangles[tri]
+        x = np.asarray(self._xarray, dtype=np.float64)[verts]
+        y = np.asarray(self._yarray, dtype=np.float64)[verts]
+        px, py = lons[point], lats[point]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            det = (y[:, 1] - y[:, 2]) * (x[:, 0] - x[:, 2]) + (x[:, 2] - x[:, 1]) * (y[:, 0] - y[:, 2])
+            w1 = ((y[:, 1] - y[:, 2]) * (px - x[:, 2]) + (x[:, 2] - x[:, 1]) * (py - y[:, 2])) / det
+            w2 = ((y[:, 2] - y[:, 0]) * (px - x[:, 2]) + (x[:, 0] - x[:, 2]) * (py - y[:, 2])) / det
+            w3 = 1.0 - w1 - w2
+            hit = np.where((w1 >= -self._tolerance) & (w2 >= -self._tolerance) & (w3 >= -self._tolerance))[0]
+
+        # First containing triangle of each point
+        found, first = np.unique(point[hit], return_index=True)
+        hit = hit[first]
+        faces[found] = self._triangle_face[tri[hit]]
+        nodes[found] = verts[hit]
+        weights[found] = np.column_stack((w1[hit], w2[hit], w3[hit]))
+        return faces, nodes, weights
+
+    def _triangles_in_bbox(self, bbox):
+        x0, y0, dx, dy, nbx, nby = self._bins
+        ix0, iy0 = self._bin_of(np.asarray([bbox[0]]), np.asarray([bbox[1]]))
+        ix1, iy1 = self._bin_of(np.asarray([bbox[2]]), np.asarray([bbox[3]]))
+        if bbox[2] < x0 or bbox[0] > x0 + dx * nbx or bbox[3] < y0 or bbox[1] > y0 + dy * nby:
+            return np.asarray([], dtype=np.int64)
+        bx, by = np.meshgrid(np.arange(ix0[0], ix1[0] + 1), np.arange(iy0[0], iy1[0] + 1))
+        tri, owner = self._candidates((by * nbx + bx).ravel())
+        tri = np.unique(tri)
+        b = self._tri_bounds[tri]
+        return tri[(b[:, 0] <= bbox[2]) & (b[:, 2] >= bbox[0]) & (b[:, 1] <= bbox[3]) & (b[:, 3] >= bbox[1])]
+
+    def faces_in_bbox(self, bbox):
+        """
+            Sorted indexes of the faces whose extent overlaps the bbox
+            (minx, miny, maxx, maxy).
+        """
+        return np.unique(self._triangle_face[self._triangles_in_bbox(bbox)])
+
+    def nodes_in_bbox(self, bbox):
+        """
+            Sorted indexes of the nodes inside the bbox (minx, miny, maxx,
+            maxy), the same as testing every node.
+        """
+        nodes = np.union1d(self._triangles[self._triangles_in_bbox(bbox)].ravel(), self._orphans)
+        x, y = self._xarray[nodes], self._yarray[nodes]
+        with np.errstate(invalid='ignore'):
+            keep = (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+        return nodes[keep]
+
+    def contains_points(self, lons, lats, ncell=True):
+        """
+            Boolean array, True where the point is inside of a face of the
+            mesh.
+        """
+        return self.locate(lons, lats)[0] >= 0
+
+    def get_facename(self):
+        return self._facename
+
+    facename = property(get_facename, None)
@@ -0,0 +1,144 @@
+import itertools
+import numpy as np
+
+from paegan.logger import logger
+
+
+class ReadPlanner(object):
+    """
+        Reads orthogonal index selections (one integer index array, or a
+        single integer, per dimension, the way netCDF4 variables are
+        indexed) as a few contiguous hyperslabs.
+
+        The requested indexes of each dimension are sorted and split into
+        runs.  Runs separated by no more than `gap` unread indexes are
+        coalesced, and runs are merged further, closest first, until no
+        more than `max_slabs` slice reads are needed.  The slabs are read
+        into one buffer and the requested indexes are picked out of it, in
+        the requested order.
+
+        >> planner = ReadPlanner(gap=10)
+        >> data = planner.read(nc.variables["u"], [tinds, zinds, yinds, xinds])
+        >> planner.requests, planner.bytes
+
+    """
+    def __init__(self, gap=0, max_slabs=64):
+        self.gap = gap
+        self.max_slabs = max_slabs
+        self.reset()
+
+    def reset(self):
+        """
+            Zero the running totals of requests and bytes read.
+        """
+        self.requests = 0
+        self.bytes = 0
+
+    def _normalize(self, ind, size):
+        """
+            Requested indexes of one dimension as a 1-D array, and whether
+            the dimension is dropped from the result (a scalar index).
+        """
+        if isinstance(ind, slice):
+            return np.arange(*ind.indices(size)), False
+        scalar = np.ndim(ind) == 0
+        ind = np.asarray(ind)
+        if ind.dtype == bool:
+            ind = np.where(ind)[0]
+        ind = ind.astype(np.int64).ravel()
+        ind = np.where(ind < 0, ind + size, ind)
+        if ind.size > 0 and (ind.min() < 0 or ind.max() >= size):
+            raise IndexError("index exceeds dimension size")
+        return ind, scalar
+
+    def _runs(self, unique):
+        """
+            (starts, stops) of the runs covering the sorted unique indexes,
+            closing gaps of up to self.gap indexes.
+        """
+        breaks = np.where(np.diff(unique) > self.gap + 1)[0]
+        starts = np.concatenate((unique[:1], unique[breaks + 1]))
+        stops = np.concatenate((unique[breaks], unique[-1:])) + 1
+        return starts, stops
+
+    def _merge(self, starts, stops, count):
+        """
+            Merge runs, across the smallest gaps first, until `count` are left.
+        """
+        if count >= starts.size:
+            return starts, stops
+        gaps = starts[1:] - stops[:-1]
+        keep = np.sort(np.argsort(gaps, kind='mergesort')[starts.size - count:])
+        return np.concatenate((starts[:1], starts[keep + 1])), np.concatenate((stops[keep], stops[-1:]))
+
+    def plan(self, shape, indarray):
+        """
+            Work out the slab reads for a selection.
+
+            Returns a list with, per dimension, a tuple of
+            (indexes, scalar, starts, stops).
+        """
+        dims = []
+        for ind, size in zip(indarray, shape):
+            ind, scalar = self._normalize(ind, size)
+            unique = np.unique(ind)
+            starts, stops = self._runs(unique)
+            dims.append([ind, scalar, starts, stops])
+
+        total = np.prod([d[2].size for d in dims])
+        while total > self.max_slabs:
+            # Thin out the dimension that is split the most
+            d = dims[np.argmax([dd[2].size for dd in dims])]
+            count = max(1, int(d[2].size * self.max_slabs // total))
+            if count == d[2].size:
+                count -= 1
+            d[2], d[3] = self._merge(d[2], d[3], count)
+            total = np.prod([dd[2].size for dd in dims])
+        return [tuple(d) for d in dims]
+
+    def read(self, var, indarray):
+        """
+            Read var[indarray] with netCDF4 (orthogonal) indexing semantics
+            through slice based hyperslab reads.
+        """
+        indarray = list(indarray)
+        if len(indarray) != len(var.shape):
+            raise IndexError("expected %d indexes, got %d" % (len(var.shape), len(indarray)))
+        dims = self.plan(var.shape, indarray)
+
+        if any(d[0].size == 0 for d in dims):
+            return np.ma.masked_all([d[0].size for d in dims if not d[1]], dtype=var.dtype)
+
+        # Where each run lands in the buffer
+        lengths = [d[3] - d[2] for d in dims]
+        offsets = [np.concatenate(([0], np.cumsum(l)[:-1])) for l in lengths]
+
+        slabs = list(itertools.product(*[range(d[2].size) for d in dims]))
+        data = None
+        nbytes = 0
+        for runs in slabs:
+            request = tuple(slice(d[2][r], d[3][r]) for d, r in zip(dims, runs))
+            slab = var[request]
+            nbytes += np.asarray(slab).nbytes
+            if len(slabs) == 1:
+                data = slab
+                break
+            if data is None:
+                data = np.ma.masked_all([l.sum() for l in lengths], dtype=slab.dtype)
+            data[tuple(slice(o[r], o[r] + l[r]) for o, l, r in zip(offsets, lengths, runs))] = slab
+
+        # Pick the requested indexes out of the buffer, skipping the copy
+        # when the buffer already is the request
+        positions = []
+        for d, o in zip(dims, offsets):
+            run = np.searchsorted(d[2], d[0], side='right') - 1
+            positions.append(o[run] + d[0] - d[2][run])
+        if not all(p.size == n and (p == np.arange(n)).all() for p, n in zip(positions, data.shape)):
+            data = data[np.ix_(*positions)]
+        if any(d[1] for d in dims):
+            data = data[tuple(0 if d[1] else slice(None) for d in dims)]
+
+        self.requests += len(slabs)
+        self.bytes += nbytes
+        logger.debug("Read %s in %d request(s), %d bytes" % (str(data.shape), len(slabs), nbytes))
+        return data
@@ -7,7 +7,6 @@
 import numpy as np
 import netCDF4, datetime
 from dateutil.parser import parse
-import bisect
 import pytz
 
 # Same basedate as matplotlib: http://matplotlib.org/api/dates_api.html#matplotlib.dates.num2date
@@ -19,6 +18,22 @@ def date2num(python_datetime):
 def num2date(indatenum, inunits, tzinfo=None):
     return np.vectorize(lambda x: x.replace(tzinfo=tzinfo))(netCDF4.num2date(indatenum, inunits, 'proleptic_gregorian'))
 
+_epoch = datetime.datetime(1970, 1, 1)
+
+def date2epoch(python_datetime):
+    """
+        Seconds since 1970-01-01 UTC for a datetime or a sequence of
+        datetimes.  Naive datetimes are taken to be UTC.
+    """
+    def _one(dt):
+        if dt.tzinfo is not None and dt.utcoffset() is not None:
+            dt = dt.replace(tzinfo=None) - dt.utcoffset()
+        return (dt - _epoch).total_seconds()
+    try:
+        return np.asarray([_one(d) for d in python_datetime], dtype=np.float64)
+    except TypeError:
+        return _one(python_datetime)
+
 class Timevar(np.ndarray):
 
     _unit2sec={}
@@ -35,68 +50,169 @@ class Timevar(np.ndarray):
     _sec2unit['hours'] = 1.0/3600.0
     _sec2unit['days'] = 1.0/(24.0*3600.0)
 
-    def __new__(self, ncfile, name='time', units=None, tzinfo=None, **kwargs):
+    def __new__(cls, ncfile, name='time', units=None, tzinfo=None, **kwargs):
         if type(ncfile) is str:
             ncfile = netCDF4.Dataset(ncfile)
-        self._nc = ncfile
 
-        if self._nc.variables[name].ndim > 1:
-            _str_data = self._nc.variables[name][:,:]
+        if ncfile.variables[name].ndim > 1:
+            _str_data = ncfile.variables[name][:,:]
             if units == None:
                 units = timevar_units
             dates = [parse(_str_data[i, :].tostring()) for i in range(len(_str_data[:,0]))]
             data = netCDF4.date2num(dates, units)
         else:
-            data = self._nc.variables[name][:]
+            data = ncfile.variables[name][:]
 
         if units == None:
             try:
-                self._units = self._nc.variables[name].units
+                units = ncfile.variables[name].units
             except StandardError:
-                self._units = units
-        else:
-            self._units = units
+                pass
 
         if tzinfo == None:
-            self._tzinfo = pytz.utc
-        else:
-            self._tzinfo = tzinfo
+            tzinfo = pytz.utc
 
-
-        units_split=self._units.split(' ',2)
+        units_split=units.split(' ',2)
         assert len(units_split) == 3 and units_split[1] == 'since', \
-            'units string improperly formatted\n' + self._units
-        self.origin=parse(units_split[2])
+            'units string improperly formatted\n' + units
+
+        obj = np.asarray(data).view(cls)
+        obj._nc = ncfile
+        obj._tzinfo = tzinfo
+        obj.origin=parse(units_split[2])
 
-        self._units = units_split[0].lower()
+        obj._units = units_split[0].lower()
 
         # compatibility to CF convention v1.0/udunits names:
-        if self._units in ['second','sec','secs','s']:
-            self._units='seconds'
-        if self._units in ['min','minute','mins']:
-            self._units='minutes'
-        if self._units in ['h','hs','hr','hrs','hour']:
-            self._units='hours'
-        if self._units in ['day','d','ds']:
-            self._units='days'
+        if obj._units in ['second','sec','secs','s']:
+            obj._units='seconds'
+        if obj._units in ['min','minute','mins']:
+            obj._units='minutes'
+        if obj._units in ['h','hs','hr','hrs','hour']:
+            obj._units='hours'
+        if obj._units in ['day','d','ds']:
+            obj._units='days'
+
+        return obj
+
+    def __array_finalize__(self, obj):
+        if obj is None:
+            return
+        self._nc = getattr(obj, '_nc', None)
+        self._units = getattr(obj, '_units', None)
+        self._tzinfo = getattr(obj, '_tzinfo', pytz.utc)
+        self.origin = getattr(obj, 'origin', None)
+        self._epoch_cache = None
 
-        return data.view(self)
+    def __setitem__(self, key, value):
+        self._epoch_cache = None
+        super(Timevar, self).__setitem__(key, value)
 
     def gettimestep(self):
         return self.seconds[1] - self.seconds[0]
 
+    def get_epoch_seconds(self):
+        """
+            The time axis as float64 seconds since 1970-01-01 UTC.  Computed
+            once from the units and origin and cached; no datetime objects
+            are built unless the tzinfo has a DST dependent offset.
+        """
+        cache = getattr(self, '_epoch_cache', None)
+        if cache is None:
+            offset = self._tzinfo.utcoffset(None)
+            if offset is None:
+                # Offset changes over the axis, go through the dates once
+                values = np.asarray(self, dtype=np.float64)
+                cache = np.empty(values.shape)
+                finite = np.isfinite(values)
+                cache[~finite] = np.nan
+                cache[finite] = date2epoch(self[finite].dates)
+            else:
+                origin = self.origin.replace(tzinfo=None) - offset
+                fac = self._unit2sec[self._units]
+                cache = np.asarray(self, dtype=np.float64) * fac + (origin - _epoch).total_seconds()
+            cache.flags.writeable = False
+            self._epoch_cache = cache
+        return cache
+
+    def _is_ascending(self):
+        """
+            True when the epoch axis has no NaNs and never decreases, so
+            it can be binary searched as it is.  Cached with the axis.
+        """
+        epoch = self.epoch_seconds
+        if getattr(self, '_ascending_cache', None) is None or self._ascending_cache[0] is not epoch:
+            flat = epoch.ravel()
+            ascending = epoch.ndim == 1 and bool(np.isfinite(flat).all()) and not bool(np.any(np.diff(flat) < 0))
+            self._ascending_cache = (epoch, ascending)
+        return self._ascending_cache[1]
+
+    def bounds_index(self, start, end):
+        """
+            Timesteps between two datetimes, inclusive on both ends.
+
+            On an ascending axis without NaNs this is two binary searches
+            and a slice is returned.  Otherwise the axis is masked and an
+            array of indexes is returned.
+        """
+        start, end = date2epoch(start), date2epoch(end)
+        epoch = self.epoch_seconds
+        if self._is_ascending():
+            return slice(int(np.searchsorted(epoch, start, side='left')),
+                         int(np.searchsorted(epoch, end, side='right')))
+        with np.errstate(invalid='ignore'):
+            return np.where((epoch >= start) & (epoch <= end))[0]
+
+    def _sorted_epoch(self):
+        """
+            Finite epoch seconds in ascending order along with their
+            indexes into the axis.  The argsort is skipped for an axis
+            that is already monotonic.
+        """
+        epoch = self.epoch_seconds.ravel()
+        valid = np.where(np.isfinite(epoch))[0]
+        values = epoch[valid]
+        if values.size > 1 and np.any(np.diff(values) < 0):
+            order = np.argsort(values, kind='mergesort')
+            values, valid = values[order], valid[order]
+        return values, valid
+
     def nearest_index(self, dateo, select='nearest'):
-        to = date2num(dateo)
-        if select == 'nearest':
-            try:
-                return [np.where(abs(self.datenum-t) == np.nanmin(abs(self.datenum-t)))[0][0] for t in to]
-            except TypeError:
-                return [np.where(abs(self.datenum-to) == np.nanmin(abs(self.datenum-to)))[0][0]]
-        elif select == 'before':
-            try:
-                return np.asarray([bisect.bisect(self.datenum, t)-1 for t in to])
-            except TypeError:
-                return np.asarray([bisect.bisect(self.datenum, to)-1])
+        """
+            Index of the timestep nearest to a datetime (or a sequence of
+            datetimes).
+
+            select='nearest' : closest timestep, ties go to the lower index
+            select='before'  : last timestep at or before, -1 if there is none
+            select='after'   : first timestep at or after, len(self) if there is none
+
+            Returns an array with one index per requested time.
+        """
+        to = np.atleast_1d(date2epoch(dateo))
+        values, valid = self._sorted_epoch()
+        if values.size == 0:
+            raise ValueError("Time axis has no valid values")
+
+        if select == 'before':
+            pos = np.searchsorted(values, to, side='right') - 1
+            return np.where(pos < 0, -1, valid[np.clip(pos, 0, None)])
+        elif select == 'after':
+            pos = np.searchsorted(values, to, side='left')
+            return np.where(pos >= values.size, self.size, valid[np.clip(pos, None, values.size - 1)])
+
+        pos = np.searchsorted(values, to, side='left')
+        right = np.clip(pos, 0, values.size - 1)
+        left = np.clip(pos - 1, 0, values.size - 1)
+        # First occurrence of the neighbouring values, so that repeated
+        # times resolve to the lowest index like a full scan would
+        right = np.searchsorted(values, values[right], side='left')
+        left = np.searchsorted(values, values[left], side='left')
+        dright = np.abs(values[right] - to)
+        dleft = np.abs(values[left] - to)
+        inds = np.where(dleft < dright, valid[left], valid[right])
+        tie = dleft == dright
+        inds[tie] = np.minimum(valid[left], valid[right])[tie]
+        return inds
 
     def nearest(self, dateo, select='nearest'):
         """
@@ -108,7 +224,7 @@ class Timevar(np.ndarray):
         #    res=self.jd[self.nearest_index(dateo, select)][0]
         #else:
         #    res=self.jd[self.nearest_index(dateo, select)][1]
-        return self.dates[self.nearest_index(dateo, select)][0]
+        return self[self.nearest_index(dateo, select)].dates[0]
 
     def get_seconds(self):
         fac = self._unit2sec[self._units] * self._sec2unit['seconds']
@@ -132,7 +248,8 @@ class Timevar(np.ndarray):
     def get_datenum(self):
         return date2num(self.dates)
 
-    datenum = property(get_datenum, None, doc="datenum in seconds since 1970-01-01")
+    datenum = property(get_datenum, None, doc="datenum in days since 0001-01-01")
+    epoch_seconds = property(get_epoch_seconds, None, doc="seconds since 1970-01-01 UTC")
     seconds = property(get_seconds, None, doc="seconds")
     minutes = property(get_minutes, None, doc="minutes")
     hours = property(get_hours, None, doc="hours")
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import namedtuple
 
 class Coordinates(object):
     """
@@ -68,6 +69,21 @@ class SubCoordinates(object):
             self.time = kwargs["time"]
 
 
+class AxisLayout(namedtuple('AxisLayout', ['tname', 'zname', 'xname', 'yname',
+                                           'dims', 'shape', 'time', 'z', 'y', 'x'])):
+    """
+    Immutable description of how the dimensions of a field variable line up
+    with its coordinate variables.  time, z, y and x are tuples of dimension
+    positions in the field variable, or None when it has no such coordinate.
+    """
+    __slots__ = ()
 
+    def get_names(self):
+        return {"tname" : self.tname, "zname" : self.zname,
+                "xname" : self.xname, "yname" : self.yname}
 
+    def get_positions(self):
+        return {"time" : self.time, "z" : self.z, "y" : self.y, "x" : self.x}
 
+    names = property(get_names)
+    positions = property(get_positions)
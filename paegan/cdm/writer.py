@@ -1,8 +1,69 @@
+import os
 import numpy as np
 import netCDF4 as ncd
+from collections import OrderedDict
 
 FILL_VALUE = None
 
+# Bytes of consecutive slabs a WriterSession collects before writing them
+BUFFER_SIZE = 2**25
+
+# Bytes in a chunk the chunk presets aim for
+CHUNK_SIZE = 2**20
+
+def _fit(lengths, budget):
+    '''
+    Chunk lengths along dimensions of the given lengths holding about
+    budget elements, shared out evenly.  Dimensions too short for their
+    share are taken whole and leave the rest to the longer ones.
+    '''
+    chunks = [1] * len(lengths)
+    remaining = float(max(budget, 1))
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    for k, i in enumerate(order):
+        share = remaining ** (1. / (len(order) - k))
+        chunks[i] = int(min(lengths[i], max(1, np.floor(share + 1e-9))))
+        remaining = remaining / chunks[i]
+    return chunks
+
+def chunk_shape(shape, dtype, chunks="balanced", chunk_size=CHUNK_SIZE, unlimited=1024):
+    '''
+    Chunk shape for a variable of the given shape and dtype, holding about
+    chunk_size bytes, for the way it will be read:
+
+    "map"        -- whole horizontal slices (the last two dimensions) at a
+                    time, so a chunk is one slice of every leading dimension
+    "timeseries" -- the first (time) dimension at a few points, so a chunk
+                    is as long in time as it can be
+    "balanced"   -- anything, every dimension is cut the same number of
+                    times
+
+    chunks can also be an explicit chunk shape, where None takes the whole
+    dimension.  Unlimited dimensions (0 in shape) are taken to be
+    `unlimited` long.
+
+    >> chunk_shape((8760, 20, 200, 300), np.float32, "timeseries")
+    (8760, 3, 3, 3)
+    '''
+    lengths = [int(n) if n else unlimited for n in shape]
+    if len(lengths) == 0:
+        return None
+    if not isinstance(chunks, basestring):
+        if len(chunks) != len(lengths):
+            raise ValueError("Chunk shape %s does not match the shape %s" % (chunks, tuple(shape)))
+        return tuple(n if c is None else int(min(c, n)) for c, n in zip(chunks, lengths))
+
+    budget = max(1, chunk_size // np.dtype(dtype).itemsize)
+    if chunks == "map":
+        spatial = min(2, len(lengths))
+        return tuple([1] * (len(lengths) - spatial) + _fit(lengths[-spatial:], budget))
+    elif chunks == "timeseries":
+        first = min(lengths[0], budget)
+        return tuple([first] + _fit(lengths[1:], budget // first))
+    elif chunks == "balanced":
+        return tuple(_fit(lengths, budget))
+    raise ValueError("Unknown chunk preset %s, use 'map', 'timeseries' or 'balanced'" % chunks)
+
 def new(filename):
     '''
     Return the netcdf4-python rootgroup for a new netcdf file
@@ -10,6 +71,263 @@ def new(filename):
     '''
     return ncd.Dataset(filename, 'w', clobber=False)
 
+class WriterSession(object):
+    '''
+    Collects the dimensions, variables and attributes of a netcdf file
+    and creates them all in one define phase: the first time data is
+    written, at a checkpoint, or once the data of the variables added
+    with add_variable fills the buffer.  Slabs written one after another
+    along the first dimension of a variable are gathered into blocks of
+    about buffer_size bytes before they go to the file, and the file is
+    only synced at checkpoints and on close.
+
+    >> with WriterSession.new(filename) as session:
+    >>     session.add_coordinates(OrderedDict([("time", 5040), ("x", 10)]))
+    >>     session.create_variable("temp", np.float64, ("time", "x"))
+    >>     session.add_attributes({"units" : "degC"}, var="temp")
+    >>     for start, block in blocks:
+    >>         session.write("temp", block, start=start)
+    '''
+    def __init__(self, nc, buffer_size=BUFFER_SIZE):
+        self.nc = nc
+        self.buffer_size = buffer_size
+        self._dimensions = OrderedDict()
+        self._variables = OrderedDict()
+        self._attributes = OrderedDict()
+        self._data = []
+        # (varname, start, [slabs], rows, nbytes)
+        self._buffer = None
+
+    @classmethod
+    def new(cls, filename, **kwargs):
+        '''
+        A WriterSession on a new netcdf file, which it closes.
+        '''
+        return cls(new(filename), **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_coordinates(self, dict_of_dims):
+        for dimname, size in dict_of_dims.iteritems():
+            self._dimensions[dimname] = size
+
+    def create_variable(self, varname, dtype, dims, compress=False, fill=FILL_VALUE, **kwargs):
+        '''
+        kwargs:
+        chunks -- a chunk_shape preset ("map", "timeseries" or "balanced")
+                  or an explicit chunk shape, worked out against the
+                  dimension lengths when the variable is defined
+        chunk_size -- bytes in a chunk for the presets
+        complevel, shuffle -- compression settings when compress is True
+        least_significant_digit -- quantize the data to this many decimal
+                  digits, so it compresses better
+        '''
+        self._variables[varname] = (dtype, dims, compress, fill, kwargs)
+
+    def add_variable(self, varname, data, dims, compress=False, fill=FILL_VALUE, **kwargs):
+        self.create_variable(varname, data.dtype, dims, compress=compress, fill=fill, **kwargs)
+        self._data.append((varname, data))
+        # Do not hold on to more than a buffer of data waiting for a define
+        if sum(d.nbytes for n, d in self._data) >= self.buffer_size:
+            self.define()
+
+    def add_scalar(self, varname, data, compress=False, fill=FILL_VALUE):
+        self.add_variable(varname, np.asarray(data), (), compress=compress, fill=fill)
+
+    def add_attribute(self, key, value, var=None):
+        if var is None or key not in set([ "_FillValue", "_ChunkSize" ]):
+            self._attributes.setdefault(var, OrderedDict())[key] = value
+
+    def add_attributes(self, attrs, var=None):
+        self._attributes.setdefault(var, OrderedDict()).update(attrs)
+
+    def define(self):
+        '''
+        Create everything added since the last define, and write the data
+        of the variables added with add_variable or add_scalar.
+        '''
+        for dimname, size in self._dimensions.iteritems():
+            self.nc.createDimension(dimname, size=size)
+        for varname, (dtype, dims, compress, fill, kwargs) in self._variables.iteritems():
+            chunks = kwargs.get('chunks', None)
+            if chunks is not None:
+                shape = [0 if self.nc.dimensions[d].isunlimited() else len(self.nc.dimensions[d]) for d in dims]
+                chunks = chunk_shape(shape, dtype, chunks, chunk_size=kwargs.get('chunk_size', CHUNK_SIZE))
+            self.nc.createVariable(varname, dtype, dimensions=dims, zlib=compress, fill_value=fill,
+                                   complevel=kwargs.get('complevel', 4), shuffle=kwargs.get('shuffle', True),
+                                   chunksizes=chunks,
+                                   least_significant_digit=kwargs.get('least_significant_digit', None))
+        for var, attrs in self._attributes.iteritems():
+            if var is None:
+                self.nc.setncatts(attrs)
+            else:
+                self.nc.variables[var].setncatts(attrs)
+        for varname, data in self._data:
+            self.nc.variables[varname][:] = data
+        self._dimensions = OrderedDict()
+        self._variables = OrderedDict()
+        self._attributes = OrderedDict()
+        self._data = []
+
+    def write(self, varname, data, start=None):
+        '''
+        Write data into a variable, all of it when start is None or else
+        data.shape[0] slabs along its first dimension from start.
+        '''
+        if self._variables or self._attributes or self._data:
+            self.define()
+        if start is None:
+            self._flush_buffer()
+            self.nc.variables[varname][:] = data
+            return
+        if self._buffer is not None:
+            name, first, slabs, rows, nbytes = self._buffer
+            if name == varname and first + rows == start:
+                slabs.append(data)
+                self._buffer = (name, first, slabs, rows + data.shape[0], nbytes + data.nbytes)
+                if self._buffer[4] >= self.buffer_size:
+                    self._flush_buffer()
+                return
+            self._flush_buffer()
+        self._buffer = (varname, start, [data], data.shape[0], data.nbytes)
+        if data.nbytes >= self.buffer_size:
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        if self._buffer is not None:
+            varname, start, slabs, rows, nbytes = self._buffer
+            self._buffer = None
+            if len(slabs) == 1:
+                data = slabs[0]
+            else:
+                data = np.ma.concatenate(slabs)
+            self.nc.variables[varname][start:start + rows] = data
+
+    def flush(self):
+        '''
+        Define anything pending and write out the buffered slabs.
+        '''
+        self.define()
+        self._flush_buffer()
+
+    def checkpoint(self):
+        self.flush()
+        self.nc.sync()
+
+    def close(self):
+        self.checkpoint()
+        self.nc.close()
+
+class AppendWriter(WriterSession):
+    '''
+    A WriterSession for output produced a time step at a time, along an
+    unlimited time dimension.  append() takes the values of one step for
+    any of the variables on the time dimension; `steps` of them are kept
+    in memory and written as one slab per variable, and the file is
+    synced after each such write.
+
+    The number of steps safely in the file is kept in its complete_steps
+    attribute, so after a crash AppendWriter.open() picks up from there
+    (running the same set up again only defines what is missing).  The
+    records of a slab that was being written when it crashed are masked
+    as the file is reopened.
+
+    >> writer = AppendWriter.open(filename, steps=24)
+    >> writer.add_coordinates(OrderedDict([("time", None), ("y", 40), ("x", 60)]))
+    >> writer.create_variable("time", np.float64, ("time",))
+    >> writer.create_variable("temp", np.float32, ("time", "y", "x"), chunks="map")
+    >> for t, temp in model:
+    >>     writer.append({"time" : t, "temp" : temp})
+    >> writer.close()
+    '''
+    def __init__(self, nc, time_dim="time", steps=24, **kwargs):
+        super(AppendWriter, self).__init__(nc, **kwargs)
+        self.time_dim = time_dim
+        self.steps = steps
+        self._steps = []
+        if "complete_steps" in self.nc.ncattrs():
+            self.complete_steps = int(self.nc.getncattr("complete_steps"))
+            self._mask_tail()
+        elif time_dim in self.nc.dimensions:
+            self.complete_steps = len(self.nc.dimensions[time_dim])
+        else:
+            self.complete_steps = 0
+
+    @classmethod
+    def open(cls, filename, **kwargs):
+        '''
+        An AppendWriter on a new file, or on the end of an existing one.
+        '''
+        if os.path.exists(filename):
+            return cls(ncd.Dataset(filename, 'a'), **kwargs)
+        return cls(new(filename), **kwargs)
+
+    def __len__(self):
+        return self.complete_steps + len(self._steps)
+
+    def _time_variables(self):
+        for varname, var in self.nc.variables.iteritems():
+            if len(var.dimensions) > 0 and var.dimensions[0] == self.time_dim:
+                yield varname, var
+
+    def _mask_tail(self):
+        # The unlimited dimension can not shrink, so records written past
+        # complete_steps before a crash are masked instead
+        if self.time_dim not in self.nc.dimensions:
+            return
+        start, stop = self.complete_steps, len(self.nc.dimensions[self.time_dim])
+        if stop <= start:
+            return
+        for varname, var in self._time_variables():
+            var[start:stop] = np.ma.masked_all((stop - start,) + var.shape[1:], dtype=var.dtype)
+        self.nc.sync()
+
+    def define(self):
+        # What a resumed file already has is left alone
+        for dimname in self._dimensions.keys():
+            if dimname in self.nc.dimensions:
+                del self._dimensions[dimname]
+        for varname in self._variables.keys():
+            if varname in self.nc.variables:
+                del self._variables[varname]
+        super(AppendWriter, self).define()
+
+    def append(self, step):
+        '''
+        Add one time step, a dict of variable name to its values at that
+        step.  Variables left out of the dict are masked at that step.
+        '''
+        for varname in step:
+            if varname not in self.nc.variables and varname not in self._variables:
+                raise KeyError("%s is not a variable of %s" % (varname, self.nc.filepath()))
+        self._steps.append(step)
+        if len(self._steps) >= self.steps:
+            self.checkpoint()
+
+    def _write_steps(self):
+        if len(self._steps) == 0:
+            return
+        start, n = self.complete_steps, len(self._steps)
+        for varname, var in self._time_variables():
+            if not any(varname in step for step in self._steps):
+                continue
+            slab = np.ma.masked_all((n,) + var.shape[1:], dtype=var.dtype)
+            for i, step in enumerate(self._steps):
+                if varname in step:
+                    slab[i] = step[varname]
+            var[start:start + n] = slab
+        self.complete_steps = start + n
+        self.nc.setncattr("complete_steps", self.complete_steps)
+        self._steps = []
+
+    def flush(self):
+        super(AppendWriter, self).flush()
+        self._write_steps()
+
 def add_coordinates(nc, dict_of_dims):
     '''
     Create dimensions in netcdf file nc.
@@ -19,48 +337,60 @@ def add_coordinates(nc, dict_of_dims):
     # Loop through keys, and add each as a dimension, with the
     # cooresponding dict value tuple as the representative
     # shape of the dimension.
-    for dimname in dict_of_dims.iterkeys():
-        t = nc.createDimension(dimname, size=dict_of_dims[dimname])
-    nc.sync()
-    
-def add_variable(nc, varname, data, dims, compress=False, fill=FILL_VALUE):
+    session = WriterSession(nc)
+    session.add_coordinates(dict_of_dims)
+    session.checkpoint()
+
+def add_variable(nc, varname, data, dims, compress=False, fill=FILL_VALUE, **kwargs):
     '''
     Thin wrapper for easily adding data to netcdf variable with just
     the variable name the current array of values, and a tuple with
-    the cooresponding dimension names
+    the cooresponding dimension names.  kwargs set the chunking,
+    compression and quantization (see WriterSession.create_variable).
+
+    >> add_variable(nc, "temp", temp, ("time", "z", "y", "x"), compress=True,
+                    chunks="timeseries", least_significant_digit=3)
+    '''
+    session = WriterSession(nc)
+    session.add_variable(varname, data, dims, compress=compress, fill=fill, **kwargs)
+    session.checkpoint()
+
+def create_variable(nc, varname, dtype, dims, compress=False, fill=FILL_VALUE, **kwargs):
+    '''
+    Create an empty netcdf variable to be filled in later, a slab
+    at a time, and return it.
+
+    >> v = create_variable(nc, "temp", np.float64, ("time", "y", "x"))
+    >> v[0:10] = block
     '''
-    v = nc.createVariable(varname, data.dtype, dimensions=dims, zlib=compress, fill_value=fill) 
-    v[:] = data
-    nc.sync()
+    session = WriterSession(nc)
+    session.create_variable(varname, dtype, dims, compress=compress, fill=fill, **kwargs)
+    session.define()
+    return nc.variables[varname]
 
 def add_scalar(nc, varname, data, compress=False, fill=FILL_VALUE):
     '''
     Functionality to simply add a scalar variable to a netcdf file,
     expects a numpy array of length 1 for the data argument.
     '''
-    v = nc.createVariable(varname, data.dtype, zlib=compress, fill_value=fill)
-    v[:] = data
-    nc.sync()
+    session = WriterSession(nc)
+    session.add_scalar(varname, data, compress=compress, fill=fill)
+    session.checkpoint()
 
 def add_attribute(nc, key, value, var=None):
     '''
     Take in a single attname:value pair and write into the global
     or variable namespace
     '''
-    if var==None:
-        nc.setncattr(key, value)
-    else:
-        if not key in set([ "_FillValue", "_ChunkSize" ]):
-            nc.variables[var].setncattr(key, value)
-    nc.sync()
+    session = WriterSession(nc)
+    session.add_attribute(key, value, var=var)
+    session.checkpoint()
 
 def add_attributes(nc, attrs, var=None):
     '''
     Take in a dict of attname:value pairs and write the whole dict
     into the global or variable namespace
     '''
-    if var==None:
-        nc.setncatts(attrs)
-    else:
-        nc.variables[var].setncatts(attrs)
-    nc.sync()
+    session = WriterSession(nc)
+    session.add_attributes(attrs, var=var)
+    session.checkpoint()
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 class GreatCircle(object):
     # -----------------------------------------------------------------------
@@ -224,4 +225,317 @@ class GreatCircle(object):
                 alpha21 = alpha21 - two_pi
 
 
-        return phi2,  lembda2,  alpha21
\ No newline at end of file
+        return phi2,  lembda2,  alpha21
+
+
+    # -----------------------------------------------------------------------
+    # | Array versions of the formulae above.                               |
+    # |                                                                     |
+    # | Every element is iterated in lockstep, and an element drops out of  |
+    # | the iteration as soon as it has converged, so arrays of any shape   |
+    # | are solved without a Python level loop over the elements.          |
+    # -----------------------------------------------------------------------
+
+    @staticmethod
+    def vinc_dist_array( f, a, phi1, lembda1, phi2, lembda2, maxiter=200 ) :
+        """
+
+        Array version of vinc_dist.  The latitudes and longitudes are
+        broadcast against each other.  lats, longs and azimuths are in
+        radians, distance in metres
+
+        Returns ( s, alpha12, alpha21 ) as a tuple of arrays
+
+        """
+
+        phi1, lembda1, phi2, lembda2 = np.broadcast_arrays(
+            *[np.asarray(x, dtype=np.float64) for x in (phi1, lembda1, phi2, lembda2)])
+        shape = phi1.shape
+        phi1, lembda1, phi2, lembda2 = [x.ravel() for x in (phi1, lembda1, phi2, lembda2)]
+
+        two_pi = 2.0*np.pi
+
+        b = a * (1.0 - f)
+
+        U1 = np.arctan((1-f) * np.tan(phi1))
+        U2 = np.arctan((1-f) * np.tan(phi2))
+        sinU1, cosU1 = np.sin(U1), np.cos(U1)
+        sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+        lembda = lembda2 - lembda1
+        omega = lembda.copy()
+
+        same = np.logical_and(np.abs(phi2 - phi1) < 1e-8, np.abs(lembda2 - lembda1) < 1e-8)
+
+        sqr_sin_sigma = np.zeros_like(lembda)
+        Sin_sigma = np.zeros_like(lembda)
+        Cos_sigma = np.zeros_like(lembda)
+        sigma = np.zeros_like(lembda)
+        cos_sq_alpha = np.zeros_like(lembda)
+        Cos2sigma_m = np.zeros_like(lembda)
+
+        # Iterate the following equations,
+        #  until there is no significant change in lembda
+        active = np.where(~same)[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in xrange(maxiter):
+                if active.size == 0:
+                    break
+                l = lembda[active]
+                sU1, cU1, sU2, cU2 = sinU1[active], cosU1[active], sinU2[active], cosU2[active]
+
+                sss = (cU2 * np.sin(l))**2 + (cU1 * sU2 - sU1 * cU2 * np.cos(l))**2
+                ss = np.sqrt(sss)
+                cs = sU1 * sU2 + cU1 * cU2 * np.cos(l)
+                sg = np.arctan2(ss, cs)
+
+                sa = cU1 * cU2 * np.sin(l) / np.sin(sg)
+                csa = 1.0 - sa * sa
+
+                # Lines along the equator have no cos(alpha)
+                c2sm = np.where(csa != 0, np.cos(sg) - (2 * sU1 * sU2 / csa), 0.0)
+
+                C = (f/16) * csa * (4 + f * (4 - 3 * csa))
+
+                new_lembda = omega[active] + (1-C) * f * sa * (sg + C * np.sin(sg) * \
+                        (c2sm + C * np.cos(sg) * (-1 + 2 * c2sm**2)))
+
+                sqr_sin_sigma[active] = sss
+                Sin_sigma[active] = ss
+                Cos_sigma[active] = cs
+                sigma[active] = sg
+                cos_sq_alpha[active] = csa
+                Cos2sigma_m[active] = c2sm
+                lembda[active] = new_lembda
+
+                converged = np.logical_or(new_lembda == 0,
+                                          ~(np.abs((l - new_lembda) / new_lembda) > 1.0e-9))
+                active = active[~converged]
+
+        u2 = cos_sq_alpha * (a*a-b*b) / (b*b)
+
+        A = 1 + (u2/16384) * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+
+        B = (u2/1024) * (256 + u2 * (-128+ u2 * (74 - 47 * u2)))
+
+        delta_sigma = B * Sin_sigma * (Cos2sigma_m + (B/4) * \
+                (Cos_sigma * (-1 + 2 * Cos2sigma_m**2) - \
+                (B/6) * Cos2sigma_m * (-3 + 4 * sqr_sin_sigma) * \
+                (-3 + 4 * Cos2sigma_m**2)))
+
+        s = b * A * (sigma - delta_sigma)
+
+        alpha12 = np.arctan2( (cosU2 * np.sin(lembda)), \
+                (cosU1 * sinU2 - sinU1 * cosU2 * np.cos(lembda)))
+
+        alpha21 = np.arctan2( (cosU1 * np.sin(lembda)), \
+                (-sinU1 * cosU2 + cosU1 * sinU2 * np.cos(lembda)))
+
+        alpha12 = np.where(alpha12 < 0.0, alpha12 + two_pi, alpha12)
+        alpha12 = np.where(alpha12 > two_pi, alpha12 - two_pi, alpha12)
+
+        alpha21 = alpha21 + two_pi / 2.0
+        alpha21 = np.where(alpha21 < 0.0, alpha21 + two_pi, alpha21)
+        alpha21 = np.where(alpha21 > two_pi, alpha21 - two_pi, alpha21)
+
+        s[same] = 0.0
+        alpha12[same] = 0.0
+        alpha21[same] = 0.0
+
+        return s.reshape(shape), alpha12.reshape(shape), alpha21.reshape(shape)
+
+    @staticmethod
+    def vinc_pt_array( f, a, phi1, lembda1, alpha12, s, maxiter=200 ) :
+        """
+
+        Array version of vinc_pt.  The reference points, azimuths and
+        distances are broadcast against each other.  lats, longs and
+        azimuths are passed in RADIANS
+
+        Returns ( phi2,  lambda2,  alpha21 ) as a tuple of arrays, all in radians
+
+        """
+
+        phi1, lembda1, alpha12, s = np.broadcast_arrays(
+            *[np.asarray(x, dtype=np.float64) for x in (phi1, lembda1, alpha12, s)])
+        shape = phi1.shape
+        phi1, lembda1, alpha12, s = [x.ravel() for x in (phi1, lembda1, alpha12, s)]
+
+        two_pi = 2.0*np.pi
+
+        alpha12 = np.where(alpha12 < 0.0, alpha12 + two_pi, alpha12)
+        alpha12 = np.where(alpha12 > two_pi, alpha12 - two_pi, alpha12)
+
+        b = a * (1.0 - f)
+
+        TanU1 = (1-f) * np.tan(phi1)
+        # cos(arctan(x)) and sin(arctan(x)) without the round trip
+        cosU1 = 1.0 / np.sqrt(1.0 + TanU1 * TanU1)
+        sinU1 = TanU1 * cosU1
+        sinalpha12, cosalpha12 = np.sin(alpha12), np.cos(alpha12)
+        sigma1 = np.arctan2( TanU1, cosalpha12 )
+        Sinalpha = cosU1 * sinalpha12
+        cosalpha_sq = 1.0 - Sinalpha * Sinalpha
+
+        u2 = cosalpha_sq * (a * a - b * b ) / (b * b)
+        A = 1.0 + (u2 / 16384) * (4096 + u2 * (-768 + u2 * \
+                (320 - 175 * u2) ) )
+        B = (u2 / 1024) * (256 + u2 * (-128 + u2 * (74 - 47 * u2) ) )
+
+        # Starting with the approximation
+        first = (s / (b * A))
+        sigma = first.copy()
+        two_sigma_m = 2 * sigma1 + sigma
+
+        # Not moving anywhere. Those keep the location that was passed in.
+        still = sigma == 0
+
+        # Iterate the following three equations
+        # until there is no significant change in sigma.  Only the points
+        # that have not converged yet are carried into the next pass; while
+        # all of them are still moving the full arrays are used directly.
+        active = None if not still.any() else np.where(~still)[0]
+        twosigma1 = 2 * sigma1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in xrange(maxiter):
+                if active is None:
+                    sg, Ba, first_a, ts1 = sigma, B, first, twosigma1
+                elif active.size == 0:
+                    break
+                else:
+                    sg, Ba, first_a, ts1 = sigma[active], B[active], first[active], twosigma1[active]
+                tsm = ts1 + sg
+                cos_tsm = np.cos(tsm)
+                sin_sg = np.sin(sg)
+                cos_tsm_sq = cos_tsm * cos_tsm
+
+                delta_sigma = Ba * sin_sg * ( cos_tsm \
+                             + (Ba/4) * (np.cos(sg) * \
+                             (-1 + 2 * cos_tsm_sq -  \
+                             (Ba/6) * cos_tsm * \
+                             (-3 + 4 * sin_sg * sin_sg) *  \
+                             (-3 + 4 * cos_tsm_sq))))
+
+                new_sigma = first_a + delta_sigma
+                converged = ~(np.abs((sg - new_sigma) / new_sigma) > 1.0e-9)
+                if active is None:
+                    two_sigma_m = tsm
+                    sigma = new_sigma
+                    if converged.all():
+                        break
+                    active = np.where(~converged)[0]
+                else:
+                    two_sigma_m[active] = tsm
+                    sigma[active] = new_sigma
+                    active = active[~converged]
+
+        sinsigma, cossigma = np.sin(sigma), np.cos(sigma)
+
+        phi2 = np.arctan2 ( (sinU1 * cossigma + cosU1 * sinsigma * cosalpha12 ), \
+                ((1-f) * np.sqrt( Sinalpha**2 +  \
+                (sinU1 * sinsigma - cosU1 * cossigma * cosalpha12)**2)))
+
+        lembda = np.arctan2( (sinsigma * sinalpha12 ), (cosU1 * cossigma -  \
+                sinU1 *  sinsigma * cosalpha12))
+
+        C = (f/16) * cosalpha_sq * (4 + f * (4 - 3 * cosalpha_sq ))
+
+        cos_tsm = np.cos(two_sigma_m)
+        omega = lembda - (1-C) * f * Sinalpha *  \
+                (sigma + C * sinsigma * (cos_tsm + \
+                C * cossigma * (-1 + 2 * cos_tsm**2 )))
+
+        lembda2 = lembda1 + omega
+
+        alpha21 = np.arctan2 ( Sinalpha, (-sinU1 * sinsigma +  \
+                cosU1 * cossigma * cosalpha12))
+
+        alpha21 = alpha21 + two_pi / 2.0
+        alpha21 = np.where(alpha21 < 0.0, alpha21 + two_pi, alpha21)
+        alpha21 = np.where(alpha21 > two_pi, alpha21 - two_pi, alpha21)
+
+        phi2[still] = phi1[still]
+        lembda2[still] = lembda1[still]
+        alpha21[still] = alpha12[still]
+
+        return phi2.reshape(shape), lembda2.reshape(shape), alpha21.reshape(shape)
+
+    #----------------------------------------------------------------------------
+    # Spherical (haversine) distance                                            |
+    #                                                                           |
+    # Treats the earth as a sphere with the mean radius of the ellipsoid,       |
+    # R1 = (2a + b) / 3.  Much cheaper than the Vincenty iteration.  On the     |
+    # WGS84 ellipsoid the distance is within 0.56% of the ellipsoidal           |
+    # distance (worst case for north/south lines near the poles or the          |
+    # equator) and the azimuths are within a few tenths of a degree.            |
+    #----------------------------------------------------------------------------
+    @staticmethod
+    def haversine_dist( f, a, phi1, lembda1, phi2, lembda2 ) :
+        """
+
+        Returns the spherical distance between two (arrays of) geographic
+        points and the forward and reverse azimuths between these points.
+        lats, longs and azimuths are in radians, distance in metres
+
+        Returns ( s, alpha12,  alpha21 ) as a tuple of arrays
+
+        """
+
+        phi1, lembda1, phi2, lembda2 = [np.asarray(x, dtype=np.float64) for x in (phi1, lembda1, phi2, lembda2)]
+
+        two_pi = 2.0*np.pi
+        radius = a * (3.0 - f) / 3.0
+
+        dlembda = lembda2 - lembda1
+        sinphi1, cosphi1 = np.sin(phi1), np.cos(phi1)
+        sinphi2, cosphi2 = np.sin(phi2), np.cos(phi2)
+
+        h = np.sin((phi2 - phi1) / 2.0)**2 + cosphi1 * cosphi2 * np.sin(dlembda / 2.0)**2
+        s = 2.0 * radius * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+        alpha12 = np.arctan2(np.sin(dlembda) * cosphi2,
+                             cosphi1 * sinphi2 - sinphi1 * cosphi2 * np.cos(dlembda))
+        alpha21 = np.arctan2(-np.sin(dlembda) * cosphi1,
+                             cosphi2 * sinphi1 - sinphi2 * cosphi1 * np.cos(dlembda))
+
+        alpha12 = np.mod(alpha12, two_pi)
+        alpha21 = np.mod(alpha21, two_pi)
+
+        return s, alpha12, alpha21
+
+    @staticmethod
+    def haversine_pt( f, a, phi1, lembda1, alpha12, s ) :
+        """
+
+        Spherical counterpart of vinc_pt_array, on the same sphere as
+        haversine_dist.  The reference points, azimuths and distances are
+        broadcast against each other.  lats, longs and azimuths are passed
+        in RADIANS, distance in metres
+
+        Returns ( phi2,  lambda2,  alpha21 ) as a tuple of arrays, all in radians
+
+        """
+
+        phi1, lembda1, alpha12, s = [np.asarray(x, dtype=np.float64) for x in (phi1, lembda1, alpha12, s)]
+
+        two_pi = 2.0*np.pi
+        radius = a * (3.0 - f) / 3.0
+
+        delta = s / radius
+        sindelta, cosdelta = np.sin(delta), np.cos(delta)
+        sinphi1, cosphi1 = np.sin(phi1), np.cos(phi1)
+        sinalpha12, cosalpha12 = np.sin(alpha12), np.cos(alpha12)
+
+        sinphi2 = np.clip(sinphi1 * cosdelta + cosphi1 * sindelta * cosalpha12, -1.0, 1.0)
+        phi2 = np.arcsin(sinphi2)
+        lembda2 = lembda1 + np.arctan2(sinalpha12 * sindelta * cosphi1,
+                                       cosdelta - sinphi1 * sinphi2)
+
+        # Bearing back to the reference point
+        alpha21 = np.mod(np.arctan2(sinalpha12 * cosphi1,
+                                    -sinphi1 * sindelta + cosphi1 * cosdelta * cosalpha12)
+                         + two_pi / 2.0, two_pi)
+        # Not moving anywhere, same as vinc_pt_array
+        alpha21 = np.where(s == 0, np.mod(alpha12, two_pi), alpha21)
+
+        return phi2, lembda2, alpha21
@@ -1,5 +1,19 @@
+import logging
 import multiprocessing
 from paegan.logger.null_handler import NullHandler
 
+# Progress updates, as (percent, message) tuples or plain numbers.  The
+# level may already have been set up by an application using paegan.
+# It sits between DEBUG and INFO, clear of multiprocessing's SUBDEBUG.
+if not hasattr(logging, 'PROGRESS'):
+    logging.PROGRESS = 15
+    logging.addLevelName(logging.PROGRESS, 'PROGRESS')
+
+if not hasattr(logging.Logger, 'progress'):
+    def progress(self, msg, *args, **kwargs):
+        if self.isEnabledFor(logging.PROGRESS):
+            self._log(logging.PROGRESS, msg, args, **kwargs)
+    logging.Logger.progress = progress
+
 logger = multiprocessing.get_logger()
-logger.addHandler(NullHandler())
\ No newline at end of file
+logger.addHandler(NullHandler())
@@ -1,8 +1,12 @@
 import os.path
+import glob
 import threading
+import multiprocessing
+from itertools import izip
 import numpy as np
 import netCDF4
-from paegan.utils.asainterpolate import CfGeoInterpolator
+from paegan.logger import logger
+from paegan.utils.asainterpolate import CfGeoInterpolator, InterpolationWeights, _bracket
 import paegan.cdm.writer as pw
 from collections import OrderedDict
 import datetime
@@ -88,52 +92,55 @@ def shrink(a, b):
 
     return a
 
-def _uv_to_rho(u_data, v_data, angle, rho_x, rho_y):
-    # Create empty rho matrix to store complex U + Vj
-    U = np.empty([rho_y,rho_x], dtype=complex )
-    # And fill it with with nan values
-    U[:] = np.nan
-
-    vfunc = np.vectorize(complex)
-
-    # THREE IDENTICAL METHODS
-    # Fill in RHO cells per diagram above.  Skip first row and first
-    # column of RHOs and leave them as numpy.nan values.  Also skip the
-    # last row and column.
-
-    #1.)
-    # Fill rho points with averages (if we can do the calculation)
-    # Thread]
-    #t1 = AverageAdjacents(u_data)
-    #t2 = AverageAdjacents(v_data, True)
-    #t1.start(); t2.start()
-    #t1.join();  t2.join()
-    #u_avg = t1.data
-    #v_avg = t2.data
-    #complexed = vfunc(u_avg[1:-1,:],v_avg[:,1:-1])
-
-    # 2.)
-    # Don't thread
-    u_avg = average_adjacents(u_data)
-    v_avg = average_adjacents(v_data,True)
-    complexed = vfunc(u_avg[1:-1,:],v_avg[:,1:-1])
-
-    # 3.)
-    # Use Octant method
-    #data_U = (rho_y-2,rho_x-2)
-    #u_avg = shrink(u_data, data_U)
-    #v_avg = shrink(v_data, data_U)
-    #complexed = vfunc(u_avg,v_avg)
-
-    # Only pull the U and V values that can contribute to the averaging (see diagram).
-    # This means we lost the first and last row and the first and last column of both
-    # U and V.
-    U[1:rho_y-1, 1:rho_x-1] = complexed
+def _uv_to_rho(u_data, v_data, angle, rho_x, rho_y, out=None):
+    """
+        U + Vj on the rho grid, rotated by the rho angles.
+
+        u_data is (..., rho_y, rho_x-1) and v_data (..., rho_y-1, rho_x), so
+        a single time step, a stack of levels or a whole (time, level) block
+        is averaged and rotated with broadcasting in one pass.  Per the
+        diagram above, the first and last row and column of the result can
+        not be calculated and are left as numpy.nan.
+
+        The result is written into out when given, a complex array of
+        shape (..., rho_y, rho_x), and returned.
+    """
+    u_data = np.ma.filled(np.ma.asarray(u_data, dtype=np.float64), np.nan)
+    v_data = np.ma.filled(np.ma.asarray(v_data, dtype=np.float64), np.nan)
+    shape = u_data.shape[:-2] + (rho_y, rho_x)
+    if u_data.shape[-2:] != (rho_y, rho_x - 1) or v_data.shape != shape[:-2] + (rho_y - 1, rho_x):
+        raise ValueError("u and v do not match a (%d, %d) rho grid" % (rho_y, rho_x))
+    if out is None:
+        out = np.empty(shape, dtype=complex)
+    elif out.shape != shape or not np.iscomplexobj(out):
+        raise ValueError("out must be a complex array of shape %s" % (shape,))
+
+    out[..., 0, :] = np.nan
+    out[..., -1, :] = np.nan
+    out[..., 0] = np.nan
+    out[..., -1] = np.nan
+
+    # Average the U and V values that contribute to each inner rho cell
+    inner = out[..., 1:rho_y-1, 1:rho_x-1]
+    real, imag = inner.real, inner.imag
+    np.add(u_data[..., 1:-1, :-1], u_data[..., 1:-1, 1:], out=real)
+    np.add(v_data[..., :-1, 1:-1], v_data[..., 1:, 1:-1], out=imag)
+    real *= 0.5
+    imag *= 0.5
 
     # We need the rotated point, so rotate by the "angle"
-    return rotate_complex_by_angle(U,angle)
+    out *= np.exp(1j * np.asarray(angle))
+    return out
+
+def uv_to_rho(file, time=0, level=0, out=None):
+    """
+        U + Vj on the rho grid of a ROMS file, rotated by its angles.
 
-def uv_to_rho(file):
+        time and level index the u and v variables, so slices convert
+        every time and level at once:
+
+        >> uv = uv_to_rho(file, time=slice(None), level=slice(None))
+    """
     nc = netCDF4.Dataset(file)
 
     lat_rho=nc.variables['lat_rho']
@@ -148,10 +155,10 @@ def uv_to_rho(file):
     [rho_y,rho_x] = lat_rho.shape
 
     # U
-    u_data = nc.variables['u'][0,0,:,:]
+    u_data = nc.variables['u'][time,level,:,:]
 
     # V
-    v_data = nc.variables['v'][0,0,:,:]
+    v_data = nc.variables['v'][time,level,:,:]
 
     # Get the angles
     angle = nc.variables['angle'][:,:]
@@ -159,7 +166,7 @@ def uv_to_rho(file):
     # Close the dataset
     nc.close()
 
-    return _uv_to_rho(u_data, v_data, angle, rho_x, rho_y)
+    return _uv_to_rho(u_data, v_data, angle, rho_x, rho_y, out=out)
 
 def rotate_complex_by_angle(points,angles):
     """
@@ -246,187 +253,309 @@ def average_adjacents(a, by_column=False):
 
     return sumd
 
-def regrid_roms(newfile, filename, lon_new, lat_new, t=None, z=None):
+def _regrid_block(nc, grid, keys, b0, b1, cache):
+    '''Regrid new time steps b0:b1 of a time varying rho grid variable, or of
+       a (u, v) pair rotated onto the rho grid, and return one array per key.
+
+       grid holds the source and new coordinates (see regrid_roms).  Only the
+       source time steps around the new times are read, one at a time, so
+       memory use depends on b1 - b0 and not on the length of the file.  The
+       spatial weights are worked out once (and kept in `cache`) and the new
+       times are interpolated between the regridded steps.
+    '''
+    variables = [nc.variables[key] for key in keys]
+    shape = grid['shape'][variables[-1].ndim]
+    if variables[-1].ndim == 4:
+        z_rho, z_new = grid['depth_rho'], grid['z']
+    else:
+        z_rho, z_new = None, None
+    if len(keys) == 2:
+        # Every level of a step onto the rho grid, in one buffer
+        buf = np.empty(variables[-1].shape[1:-2] + grid['rho_shape'], dtype=complex)
+    lower, upper, weight, outside = _bracket(grid['time'], grid['t'][b0:b1], grid['method'])
+
+    # Regrid each source time step the block needs
+    interpolator = None
+    regridded = dict()
+    for i in np.union1d(lower, upper):
+        if len(keys) == 2:
+            rho_y, rho_x = grid['rho_shape']
+            uv = _uv_to_rho(variables[0][i], variables[1][i], grid['angle'], rho_x, rho_y, out=buf)
+            steps = [uv.real, uv.imag]
+        else:
+            steps = [variables[0][i]]
+        regridded[i] = []
+        for data in steps:
+            data = np.ma.filled(np.ma.asarray(data, dtype=np.float64), np.nan)
+            data[..., grid['mask'] == 0] = np.nan
+            if interpolator is None:
+                interpolator = CfGeoInterpolator(data, grid['lon_rho'], grid['lat_rho'], z=z_rho,
+                                                 cache=cache, method=grid['method'])
+            regridded[i].append(interpolator.interpgrid(grid['lon_new'], grid['lat_new'], z=z_new, data=data).reshape(shape))
+
+    results = []
+    mix = weight > 0
+    w = weight[mix].reshape((-1,) + (1,) * len(shape))
+    for k in range(len(keys)):
+        values = np.asarray([regridded[i][k] for i in lower])
+        if mix.any():
+            upper_values = np.asarray([regridded[i][k] for i in upper[mix]])
+            values[mix] = (1 - w) * values[mix] + w * upper_values
+        values[outside] = np.nan
+        results.append(values)
+    return results
+
+# What each regrid_roms worker process reads from
+_worker = dict()
+
+def _init_regrid_worker(filename, grid, cache):
+    # Every worker reads through its own handle
+    _worker['nc'] = netCDF4.Dataset(filename)
+    _worker['grid'] = grid
+    _worker['cache'] = cache
+
+def _regrid_worker(unit):
+    keys, b0, b1 = unit
+    return _regrid_block(_worker['nc'], _worker['grid'], keys, b0, b1, _worker['cache'])
+
+def _roms_grid(nc, lon_new, lat_new, t=None, z=None):
+    '''The source and new coordinates of a regrid_roms run, as a dict (this
+       is everything _regrid_block needs to know about the grids).
+    '''
+    for key in nc.variables:
+        try:
+            if "since" in nc.variables[key].units:
+                time = nc.variables[key][:]
+        except AttributeError:
+            pass
+    # Identify the rho coordinates, and get them
+    lon_rho = nc.variables["lon_rho"][:]
+    lat_rho = nc.variables["lat_rho"][:]
+    rho_y, rho_x = lat_rho.shape
+    mask_rho = nc.variables["mask_rho"][:]
+    if "angle" in nc.variables:
+        angle = nc.variables["angle"][:]
+    else:
+        angle = 0
+    depth_rho = nc.variables["s_rho"][:]
+    #depth_w   = nc.variables["s_w"][:]
+    if t is None:
+        t = time
+    # Sizes of the new dimensions
+    if len(depth_rho.shape) == 4:
+        s_rho = depth_rho.shape[1]
+    else:
+        s_rho = depth_rho.shape[0]
+    if len(lon_new.shape) == 2 and len(lon_new.shape) == 2:
+        eta_new = lat_new.shape[0]
+        xi_new = lon_new.shape[1]
+    elif len(lon_new.shape) == 1 and len(lon_new.shape) == 1:
+        eta_new = lat_new.shape[0]
+        xi_new = lon_new.shape[0]
+    else:
+        raise ValueError("New lat and lon have invalid shapes or don't match in shape.")
+    if z is None:
+        z = depth_rho
+    s_new = z.shape[0]
+
+    return dict(time=time, t=t, z=z, depth_rho=depth_rho, mask=mask_rho, angle=angle,
+                lon_rho=lon_rho, lat_rho=lat_rho, lon_new=lon_new, lat_new=lat_new,
+                rho_shape=(rho_y, rho_x), method='nearest',
+                shape={3: (eta_new, xi_new), 4: (s_new, eta_new, xi_new)})
+
+def regrid_roms(newfile, filename, lon_new, lat_new, t=None, z=None, weights=None, block=None, processes=None):
     '''Function to regrid the entire roms datasets (all values on non-rho coords)
        onto an arbitrary grid to support regridding on to regular grids as well.
+
+       weights -- precomputed InterpolationWeights, as a list of them or the
+                  name of a directory of saved ones.  Weights computed during
+                  the run are saved to the directory for the next run, and
+                  saved weights that do not match the grids are not used.
+       block   -- regrid the variables that vary in time this many new time
+                  steps at a time (all of them at once by default), reading
+                  only the source time steps they need.  Every source step
+                  is regridded onto the new grid and each new time takes the
+                  values of the closest one, however the steps are blocked.
+       processes -- regrid the variables that vary in time (in blocks of
+                  `block` time steps, or whole) in a pool of this many
+                  processes, each reading the file through its own handle.
+                  The results are written in order as they come back, and
+                  progress is logged to paegan.logger at the PROGRESS level.
     '''
-    with pw.new(newfile) as new:
+    # Every variable on the rho grid shares its interpolation weights
+    cache = dict()
+    weights_dir = None
+    if isinstance(weights, basestring):
+        weights_dir = weights
+        for name in glob.glob(os.path.join(weights_dir, "*.npz")):
+            w = InterpolationWeights.load(name)
+            cache[w.key] = w
+    elif weights is not None:
+        for w in weights:
+            cache[w.key] = w
+    pool = None
+    if processes is not None:
+        # netCDF4 handles do not survive a fork, so the workers are started
+        # before any file is open here.  They get the grids and the spatial
+        # weights (worked out once, here) as they start.
         with netCDF4.Dataset(filename) as nc:
-            for key in nc.variables:
-                try:
-                    if "since" in nc.variables[key].units:
-                        time = nc.variables[key][:]
-                except AttributeError:
-                    pass
-            # Identify the rho coordinates, and get them
-            lon_rho = nc.variables["lon_rho"][:]
-            lat_rho = nc.variables["lat_rho"][:]
-            rho_y, rho_x = lat_rho.shape
-            depth_rho = nc.variables["s_rho"][:]
-            #depth_w   = nc.variables["s_w"][:]
-            if t == None:
-                t = time
-            # Put dimensions into the new netcdf file, should only be for
-            # time, rhos, psis (not sure what to do about w yet)
-            if len(depth_rho.shape) == 4:
-                s_rho = depth_rho.shape[1]
-            else:
-                s_rho = depth_rho.shape[0]
-            if len(lon_new.shape) == 2 and len(lon_new.shape) == 2:
-                eta_new = lat_new.shape[0]
-                xi_new = lon_new.shape[1]
-            elif len(lon_new.shape) == 1 and len(lon_new.shape) == 1:
-                eta_new = lat_new.shape[0]
-                xi_new = lon_new.shape[0]
-            else:
-                raise ValueError("New lat and lon have invalid shapes or don't match in shape.")
-            if z == None:
-                z = depth_rho
-            s_new = z.shape[0]
-            time_new = t.shape[0]
-
-            #[pw.add_attribute(new, at, new.getncattr(at)) for at in new.ncattrs()]
-            pw.add_coordinates(new, OrderedDict([("time_new",time_new),("s_new",s_new),("eta_new",eta_new),("xi_new",xi_new)]))
-            #print "Coordinates " + str([("time_new",time_new),("s_new",s_new),("eta_new",eta_new),("xi_new",xi_new)])
-
-            pw.add_variable(new, "ocean_time", t, ("time_new",))
-            pw.add_variable(new, "s_new", z, ("s_new",))
-            if len(lon_new.shape) == 2 and len(lat_new.shape) == 2:
-                pw.add_variable(new, "lat_new", lat_new, ("eta_new", "xi_new",))
-                pw.add_variable(new, "lon_new", lon_new, ("eta_new", "xi_new",))
-            elif len(lon_new.shape) == 1 and len(lat_new.shape) == 1:
-                pw.add_variable(new, "lat_new", lat_new, ("eta_new",))
-                pw.add_variable(new, "lon_new", lon_new, ("xi_new",))
-            # Identify variables that arn't coordinates, and their native grids,
-            # convert non-rho variables to rho with `average_adjacents`. Create
-            # sequence of rho-based variables in `roms_variables` object
-            for key in nc.variables:
-                var = nc.variables[key]
-                try:
-                    if key == "w":
-                        if z == None:
-                            z = depth_w
-                        grid_type = "rho"
-                    else:
-                        if "_psi" in var.coordinates:
-                            grid_type = "psi"
-                        elif "_u" in var.coordinates:
-                            grid_type = "u"
-                        elif "_v" in var.coordinates:
-                            grid_type = "v"
-                        else:
+            grid = _roms_grid(nc, lon_new, lat_new, t=t, z=z)
+        for z_rho, z_target in [(None, None), (grid['depth_rho'], grid['z'])]:
+            interpolator = CfGeoInterpolator(np.zeros(np.shape(z_rho)[:1] + grid['lon_rho'].shape),
+                                             grid['lon_rho'], grid['lat_rho'], z=z_rho, cache=cache,
+                                             method=grid['method'])
+            interpolator.get_weights(lon_new, lat_new, z=z_target)
+        pool = multiprocessing.Pool(processes, initializer=_init_regrid_worker, initargs=(filename, grid, cache))
+    try:
+        with pw.WriterSession.new(newfile) as new:
+            with netCDF4.Dataset(filename) as nc:
+                grid = _roms_grid(nc, lon_new, lat_new, t=t, z=z)
+                time, t, z = grid['time'], grid['t'], grid['z']
+                lon_rho, lat_rho, depth_rho = grid['lon_rho'], grid['lat_rho'], grid['depth_rho']
+                mask_rho, angle = grid['mask'], grid['angle']
+                rho_y, rho_x = grid['rho_shape']
+                s_new, eta_new, xi_new = grid['shape'][4]
+                time_new = t.shape[0]
+
+                # Keys of the variables that are created now and filled block by block
+                streamed = []
+                if block is None:
+                    block = time_new
+
+                #[pw.add_attribute(new, at, new.getncattr(at)) for at in new.ncattrs()]
+                new.add_coordinates(OrderedDict([("time_new",time_new),("s_new",s_new),("eta_new",eta_new),("xi_new",xi_new)]))
+                #print "Coordinates " + str([("time_new",time_new),("s_new",s_new),("eta_new",eta_new),("xi_new",xi_new)])
+
+                new.add_variable("ocean_time", t, ("time_new",))
+                new.add_variable("s_new", z, ("s_new",))
+                if len(lon_new.shape) == 2 and len(lat_new.shape) == 2:
+                    new.add_variable("lat_new", lat_new, ("eta_new", "xi_new",))
+                    new.add_variable("lon_new", lon_new, ("eta_new", "xi_new",))
+                elif len(lon_new.shape) == 1 and len(lat_new.shape) == 1:
+                    new.add_variable("lat_new", lat_new, ("eta_new",))
+                    new.add_variable("lon_new", lon_new, ("xi_new",))
+                # Identify variables that arn't coordinates, and their native grids,
+                # convert non-rho variables to rho with `average_adjacents`. Create
+                # sequence of rho-based variables in `roms_variables` object
+                for key in nc.variables:
+                    var = nc.variables[key]
+                    try:
+                        if key == "w":
+                            if z is None:
+                                z = depth_w
                             grid_type = "rho"
-                except AttributeError:
-                    grid_type = None
-                if grid_type != None and grid_type != "psi":
-                    if key in set([ "sustr", "bustr", "DU_avg1", "DU_avg2", "u", "w", "ubar", "mask_u", "mask_v", "mask_psi", "mask_rho" ]):
-                        pass
-                    elif grid_type == "v":
-                        var_dimensionality = len(var.shape)
-                        if "sv" in key or "bv" in key or "DV" in key or key == "vbar" or key == "v":
-                            paired_vector = {"svstr":"sustr", 
-                                             "bvstr":"bustr", 
-                                             "DV_avg1":"DU_avg1", 
-                                             "DV_avg2":"DU_avg2",
-                                             "vbar":"ubar",
-                                             "v":"u"}
-                            for i in xrange(var.shape[0]):
-                                if var_dimensionality == 3:
-                                    complex_uv = _uv_to_rho(nc.variables[paired_vector[key]][i,:,:], var[i,:,:], nc.variables["angle"][:], rho_x, rho_y)
-                                    uz, vz = complex_uv.real, complex_uv.imag
-                                elif var_dimensionality == 4:
-                                    for j in xrange(var.shape[1]):
-                                        complex_uv = _uv_to_rho(nc.variables["u"][i,j,:,:], var[i,j,:,:], nc.variables["angle"][:], rho_x, rho_y)
-                                        if j == 0:
-                                            uz, vz = complex_uv.real[np.newaxis,:], complex_uv.imag[np.newaxis,:]
-                                        else:
-                                            uz = np.vstack((uz, complex_uv.real[np.newaxis,:]))
-                                            vz = np.vstack((vz, complex_uv.imag[np.newaxis,:]))
-                                if i == 0:
-                                    u, v = uz[np.newaxis,:], vz[np.newaxis,:]
-                                else:
-                                    u = np.vstack((u, uz[np.newaxis,:]))
-                                    v = np.vstack((v, vz[np.newaxis,:]))
-                            values = {paired_vector[key]:u, key:v}
-                            for new_key in values:
-                                values_interp[:, np.where(nc.variables["mask_rho"]==0)] = np.nan
+                        else:
+                            if "_psi" in var.coordinates:
+                                grid_type = "psi"
+                            elif "_u" in var.coordinates:
+                                grid_type = "u"
+                            elif "_v" in var.coordinates:
+                                grid_type = "v"
+                            else:
+                                grid_type = "rho"
+                    except AttributeError:
+                        grid_type = None
+                    if grid_type != None and grid_type != "psi":
+                        if key in set([ "sustr", "bustr", "DU_avg1", "DU_avg2", "u", "w", "ubar", "mask_u", "mask_v", "mask_psi", "mask_rho" ]):
+                            pass
+                        elif grid_type == "v":
+                            var_dimensionality = len(var.shape)
+                            if "sv" in key or "bv" in key or "DV" in key or key == "vbar" or key == "v":
+                                paired_vector = {"svstr":"sustr", 
+                                                 "bvstr":"bustr", 
+                                                 "DV_avg1":"DU_avg1", 
+                                                 "DV_avg2":"DU_avg2",
+                                                 "vbar":"ubar",
+                                                 "v":"u"}
                                 if var_dimensionality == 3:
-                                    interpolator = CfGeoInterpolator(values[new_key], lon_rho, lat_rho, t=time)
-                                    values_interp = interpolator.interpgrid(lon_new, lat_new, t=t)
                                     coordtuple = ("time_new", "eta_new", "xi_new",)
                                     coordattr = "ocean_time lat_new lon_new"
-                                elif var_dimensionality == 4:
-                                    interpolator = CfGeoInterpolator(values[new_key], lon_rho, lat_rho, t=time, z=depth_rho)
-                                    values_interp = interpolator.interpgrid(lon_new, lat_new, t=t, z=z)
+                                else:
                                     coordtuple = ("time_new", "s_new", "eta_new", "xi_new",)
                                     coordattr = "ocean_time s_new lat_new lon_new"
-                                values_interp = np.ma.MaskedArray(values_interp, mask=values_interp==np.nan)
-                                pw.add_variable(new, new_key, values_interp, coordtuple)
-                                [pw.add_attribute(new, at, nc.variables[new_key].getncattr(at), var=new_key) for at in nc.variables[new_key].ncattrs()]
-                                pw.add_attribute(new, "coordinates", coordattr, var=new_key)
-                    else:
-                        var_dimensionality = len(var.shape)
-                        vartmp = var[:]
-                        if var_dimensionality == 4:
-                            vartmp[:,:, np.where(nc.variables["mask_rho"]==0)] = np.nan
-                            interpolator = CfGeoInterpolator(vartmp, lon_rho, lat_rho, t=time, z=depth_rho)
-                            values_interp = interpolator.interpgrid(lon_new, lat_new, t=t, z=z)
-                            pw.add_variable(new, key, values_interp, ("time_new", "s_new", "eta_new", "xi_new",))
-                            [pw.add_attribute(new, at, nc.variables[key].getncattr(at), var=key) for at in nc.variables[key].ncattrs()]
-                            pw.add_attribute(new, "coordinates", "ocean_time s_new lat_new lon_new", var=key)
-                        elif var_dimensionality == 3:
-                            vartmp[:, np.where(nc.variables["mask_rho"]==0)] = np.nan
-                            if var.shape[0] == time.shape[0]:
-                                try:
-                                    interpolator = CfGeoInterpolator(vartmp, lon_rho, lat_rho, t=time)
-                                    values_interp = interpolator.interpgrid(lon_new, lat_new, t=t)
+                                for new_key in (paired_vector[key], key):
+                                    new.create_variable(new_key, np.float64, coordtuple)
+                                    [new.add_attribute(at, nc.variables[new_key].getncattr(at), var=new_key) for at in nc.variables[new_key].ncattrs()]
+                                    new.add_attribute("coordinates", coordattr, var=new_key)
+                                streamed.append((paired_vector[key], key))
+                        else:
+                            var_dimensionality = len(var.shape)
+                            if var_dimensionality == 4 or (var_dimensionality == 3 and var.shape[0] == time.shape[0]):
+                                if var_dimensionality == 4:
+                                    coordtuple = ("time_new", "s_new", "eta_new", "xi_new",)
+                                    coordattr = "ocean_time s_new lat_new lon_new"
+                                else:
+                                    coordtuple = ("time_new", "eta_new", "xi_new",)
+                                    coordattr = "ocean_time lat_new lon_new"
+                                new.create_variable(key, np.float64, coordtuple)
+                                [new.add_attribute(at, nc.variables[key].getncattr(at), var=key) for at in nc.variables[key].ncattrs()]
+                                new.add_attribute("coordinates", coordattr, var=key)
+                                streamed.append((key,))
+                                continue
+                            vartmp = var[:]
+                            if var_dimensionality == 3:
+                                vartmp[:, np.where(nc.variables["mask_rho"]==0)] = np.nan
+                                if var.shape[0] == depth_rho.shape[0]:
+                                    interpolator = CfGeoInterpolator(vartmp, lon_rho, lat_rho, z=depth_rho, cache=cache)
+                                    values_interp = interpolator.interpgrid(lon_new, lat_new, z=z)
                                     values_interp = np.ma.MaskedArray(values_interp, mask=values_interp==np.nan)
-                                    pw.add_variable(new, key, values_interp, ("time_new", "eta_new", "xi_new",))
-                                    [pw.add_attribute(new, at, nc.variables[key].getncattr(at), var=key) for at in nc.variables[key].ncattrs()]
-                                    pw.add_attribute(new, "coordinates", "ocean_time lat_new lon_new", var=key)
-                                except:
-                                    print key, vartmp.shape, lon_rho.shape, lat_rho.shape, time.shape
-                            elif var.shape[0] == depth_rho.shape[0]:
-                                interpolator = CfGeoInterpolator(vartmp, lon_rho, lat_rho, z=depth_rho)
-                                values_interp = interpolator.interpgrid(lon_new, lat_new, z=z)
+                                    new.add_variable(key, values_interp, ("depth_new", "eta_new", "xi_new",))
+                                    [new.add_attribute(at, nc.variables[key].getncattr(at), var=key) for at in nc.variables[key].ncattrs()]
+                                    new.add_attribute("coordinates", "s_new lat_new lon_new", var=key)
+                                else:
+                                    raise valueerror("unsure about what dimension this varaible varies with in addition to lat/lon.")
+                            elif var_dimensionality == 2:
+                                vartmp[np.where(nc.variables["mask_rho"]==0)] = np.nan
+                                interpolator = CfGeoInterpolator(vartmp, lon_rho, lat_rho, cache=cache)
+                                values_interp = interpolator.interpgrid(lon_new, lat_new)
                                 values_interp = np.ma.MaskedArray(values_interp, mask=values_interp==np.nan)
-                                pw.add_variable(new, key, values_interp, ("depth_new", "eta_new", "xi_new",))
-                                [pw.add_attribute(new, at, nc.variables[key].getncattr(at), var=key) for at in nc.variables[key].ncattrs()]
-                                pw.add_attribute(new, "coordinates", "s_new lat_new lon_new", var=key)
+                                new.add_variable(key, values_interp, ("eta_new", "xi_new",))
+                                [new.add_attribute(at, nc.variables[key].getncattr(at), var=key) for at in nc.variables[key].ncattrs()]
+                                new.add_attribute("coordinates", "lat_new lon_new", var=key)
                             else:
-                                raise valueerror("unsure about what dimension this varaible varies with in addition to lat/lon.")
-                        elif var_dimensionality == 2:
-                            vartmp[np.where(nc.variables["mask_rho"]==0)] = np.nan
-                            interpolator = CfGeoInterpolator(vartmp, lon_rho, lat_rho)
-                            values_interp = interpolator.interpgrid(lon_new, lat_new)
-                            values_interp = np.ma.MaskedArray(values_interp, mask=values_interp==np.nan)
-                            pw.add_variable(new, key, values_interp, ("eta_new", "xi_new",))
-                            [pw.add_attribute(new, at, nc.variables[key].getncattr(at), var=key) for at in nc.variables[key].ncattrs()]
-                            pw.add_attribute(new, "coordinates", "lat_new lon_new", var=key)
-                        else:
-                            # todo if 1-d check for which dimension it matches and interp based on that...
-                            #      if 5+ d, only interpolate to the 4d dimensions that we can specify i guess...
-                            raise valueerror("sort of confused about the dimensionality of the variable i am attempting to regrid...")
-                elif grid_type == "psi":
-                    pass
+                                # todo if 1-d check for which dimension it matches and interp based on that...
+                                #      if 5+ d, only interpolate to the 4d dimensions that we can specify i guess...
+                                raise valueerror("sort of confused about the dimensionality of the variable i am attempting to regrid...")
+                    elif grid_type == "psi":
+                        pass
+                    else:
+                        if len(var.dimensions) == 0:
+                            new.add_scalar(key, var[:])
+                            [new.add_attribute(at, nc.variables[key].getncattr(at), var=key) for at in nc.variables[key].ncattrs()]
+
+                # Fill in the streamed variables a block of time steps at a time
+                units = [(keys, b0, min(b0 + block, time_new)) for keys in streamed for b0 in xrange(0, time_new, block)]
+                if pool is not None:
+                    results = pool.imap(_regrid_worker, units)
                 else:
-                    if len(var.dimensions) == 0:
-                        pw.add_scalar(new, key, var[:])
-                        [pw.add_attribute(new, at, nc.variables[key].getncattr(at), var=key) for at in nc.variables[key].ncattrs()]
-
-            # Add time attributes
-            for key in nc.variables:
-                var = nc.variables[key]
-                if "time" in key:
-                    [pw.add_attribute(new, at, nc.variables[key].getncattr(at), var="ocean_time") for at in nc.variables[key].ncattrs()]
-
-            # Add global attributes to the file
-            [pw.add_attribute(new, at, nc.getncattr(at)) for at in nc.ncattrs()]
-            try:
-                new.history = new.history + ", regridded by Python tool 'paegan' at " + str(datetime.datetime.now())
-            except:
-                new.history = "regridded by Python tool 'paegan' at " + str(datetime.datetime.now())
-        new.sync()
+                    results = (_regrid_block(nc, grid, keys, b0, b1, cache) for keys, b0, b1 in units)
+                for n, ((keys, b0, b1), values) in enumerate(izip(units, results)):
+                    for key, value in zip(keys, values):
+                        new.write(key, np.ma.masked_invalid(value), start=b0)
+                    logger.progress(((n + 1) * 100. / len(units), "Regridded %s time steps %d to %d" % (", ".join(keys), b0, b1)))
+
+                # Add time attributes
+                for key in nc.variables:
+                    var = nc.variables[key]
+                    if "time" in key:
+                        [new.add_attribute(at, nc.variables[key].getncattr(at), var="ocean_time") for at in nc.variables[key].ncattrs()]
+
+                # Add global attributes to the file
+                [new.add_attribute(at, nc.getncattr(at)) for at in nc.ncattrs()]
+                history = "regridded by Python tool 'paegan' at " + str(datetime.datetime.now())
+                if "history" in nc.ncattrs():
+                    history = nc.getncattr("history") + ", " + history
+                new.add_attribute("history", history)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if weights_dir is not None:
+        for key, w in cache.items():
+            name = os.path.join(weights_dir, "%s_%s_%s.npz" % key)
+            if not os.path.exists(name):
+                w.save(name)
 
 # Threaded instance for speed testing on enormous grids.
 class AverageAdjacents(threading.Thread):
@@ -11,8 +11,14 @@ class AsaGreatCircle(object):
             distance = distance to traveled
             azimuth = angle, in DECIMAL DEGREES of HEADING from NORTH
             start_point = Location4D object representing the starting point
+            OR
+            start_lats, start_lons = arrays (or scalars) in decimal degrees.
+            distance and azimuth may then be arrays too, all four are
+            broadcast against each other
             rmajor = radius of earth's major axis. default=6378137.0 (WGS84)
             rminor = radius of earth's minor axis. default=6356752.3142 (WGS84)
+            method = 'vincenty' (default) or 'haversine'.  The haversine
+                     method moves along a sphere, matching great_distance.
 
             Returns a dictionary with:
             'latitude' in decimal degrees
@@ -23,14 +29,30 @@ class AsaGreatCircle(object):
 
         distance = kwargs.pop('distance')
         azimuth = kwargs.pop('azimuth')
-        starting = kwargs.pop('start_point')
+        starting = kwargs.pop('start_point', None)
+        if starting is None:
+            start_lat = kwargs.pop('start_lats')
+            start_lon = kwargs.pop('start_lons')
         rmajor = kwargs.pop('rmajor', 6378137.0)
         rminor = kwargs.pop('rminor', 6356752.3142)
+        method = kwargs.pop('method', 'vincenty')
         f = (rmajor - rminor) / rmajor
 
-        lat_result, lon_result, angle_result = GreatCircle.vinc_pt(f, rmajor, math.radians(starting.latitude), math.radians(starting.longitude), math.radians(azimuth), distance)
+        if starting is not None and method == 'vincenty':
+            lat_result, lon_result, angle_result = GreatCircle.vinc_pt(f, rmajor, math.radians(starting.latitude), math.radians(starting.longitude), math.radians(azimuth), distance)
+            return {'latitude': math.degrees(lat_result), 'longitude': math.degrees(lon_result), 'reverse_azimuth': math.degrees(angle_result)}
 
-        return {'latitude': math.degrees(lat_result), 'longitude': math.degrees(lon_result), 'reverse_azimuth': math.degrees(angle_result)}
+        if starting is not None:
+            start_lat, start_lon = starting.latitude, starting.longitude
+
+        if method == 'haversine':
+            lat_result, lon_result, angle_result = GreatCircle.haversine_pt(f, rmajor, np.radians(start_lat), np.radians(start_lon),
+                                                                            np.radians(azimuth), distance)
+        else:
+            lat_result, lon_result, angle_result = GreatCircle.vinc_pt_array(f, rmajor, np.radians(start_lat), np.radians(start_lon),
+                                                                             np.radians(azimuth), distance)
+
+        return {'latitude': np.degrees(lat_result), 'longitude': np.degrees(lon_result), 'reverse_azimuth': np.degrees(angle_result)}
 
     @classmethod
     def great_distance(self, **kwargs):
@@ -38,8 +60,14 @@ class AsaGreatCircle(object):
             Named arguments:
             start_point = Location4D obect representing start point
             end_point = Location4D obect representing end point
+            OR
+            start_lats, start_lons, end_lats, end_lons = arrays (or scalars)
+            in decimal degrees, broadcast against each other
             rmajor = radius of earth's major axis. default=6378137.0 (WGS84)
             rminor = radius of earth's minor axis. default=6356752.3142 (WGS84)
+            method = 'vincenty' (default) or 'haversine'.  The haversine
+                     method treats the earth as a sphere and is much faster,
+                     distances are within 0.56% of the Vincenty distances.
 
             Returns a dictionaty with:
             'distance' in meters
@@ -57,17 +85,23 @@ class AsaGreatCircle(object):
             end_lon = kwargs.pop("end_lons")
         rmajor = kwargs.pop('rmajor', 6378137.0)
         rminor = kwargs.pop('rminor', 6356752.3142)
+        method = kwargs.pop('method', 'vincenty')
         f = (rmajor - rminor) / rmajor
 
-        if start_point != None and end_point != None:
+        if method == 'haversine':
+            if start_point != None and end_point != None:
+                start_lat, start_lon = start_point.latitude, start_point.longitude
+                end_lat, end_lon = end_point.latitude, end_point.longitude
+            distance, angle, reverse_angle = GreatCircle.haversine_dist(f, rmajor, np.radians(start_lat), np.radians(start_lon),
+                                                                        np.radians(end_lat), np.radians(end_lon))
+        elif start_point != None and end_point != None:
             distance, angle, reverse_angle = GreatCircle.vinc_dist(f, rmajor, math.radians(start_point.latitude),
                                                                    math.radians(start_point.longitude),
                                                                    math.radians(end_point.latitude),
                                                                    math.radians(end_point.longitude))
         else:
-            vector_dist = np.vectorize(GreatCircle.vinc_dist)
-            distance, angle, reverse_angle = vector_dist(f, rmajor, np.radians(start_lat), np.radians(start_lon),
-                                                         np.radians(end_lat), np.radians(end_lon))
+            distance, angle, reverse_angle = GreatCircle.vinc_dist_array(f, rmajor, np.radians(start_lat), np.radians(start_lon),
+                                                                         np.radians(end_lat), np.radians(end_lon))
         return {'distance': distance, 'azimuth': np.degrees(angle), 'reverse_azimuth': np.degrees(reverse_angle)}
 
 
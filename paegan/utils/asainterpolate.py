@@ -1,5 +1,8 @@
+import hashlib
 import numpy as np
+from scipy import sparse
 from scipy.interpolate import griddata
+from scipy.spatial import cKDTree, Delaunay
 
 def create_grid(lonmin, lonmax, latmin, latmax, **kwargs):
     dx, dy = kwargs.get("dx", None), kwargs.get("dy", None)
@@ -41,24 +44,335 @@ class GenInterpolator(object):
                 unique.append(dim.shape[0])
             return np.squeeze( f.reshape( *unique ) )
 
+def _digest(*arrays):
+    """
+        sha1 hex digest of the shapes and contents of some arrays.
+    """
+    sha = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        sha.update(str(a.shape).encode())
+        sha.update(a.view(np.uint8))
+    return sha.hexdigest()
+
+class InterpolationWeights(object):
+    """
+        The part of griddata that only depends on where the source and
+        target points are, so it can be worked out once and applied to
+        any number of data arrays on the same source points.
+
+        Every target point has `indices` into the source points and the
+        matching `weights` (one vertex with a weight of 1 for "nearest",
+        the vertices of the containing simplex with their barycentric
+        weights for "linear").  Targets outside of the source points'
+        convex hull get NaN with "linear", like griddata.  Applying the
+        weights is a sparse matrix product.
+
+        The digests of the source and target points are kept with the
+        weights, so weights saved to a file can be loaded on a later run
+        and checked against the grids they are used with.
+
+        >> weights = InterpolationWeights(points, targets, method="linear")
+        >> for data in steps:
+        >>     values = weights.apply(data)
+        >> weights.save("roms_to_regular.npz")
+        >> weights = InterpolationWeights.load("roms_to_regular.npz", points, targets)
+    """
+    def __init__(self, points, targets, method='nearest'):
+        points = np.asarray(points, dtype=np.float64)
+        targets = np.asarray(targets, dtype=np.float64)
+        if method == 'nearest':
+            indices = cKDTree(points).query(targets)[1][:, np.newaxis]
+            weights = np.ones(indices.shape)
+            outside = np.zeros(targets.shape[0], dtype=bool)
+        elif method == 'linear':
+            tri = Delaunay(points)
+            simplex = tri.find_simplex(targets)
+            outside = simplex < 0
+            simplex[outside] = 0
+            transform = tri.transform[simplex]
+            ndim = points.shape[1]
+            bary = np.einsum('ijk,ik->ij', transform[:, :ndim, :], targets - transform[:, ndim, :])
+            weights = np.column_stack((bary, 1 - bary.sum(axis=1)))
+            indices = tri.simplices[simplex]
+            weights[outside] = 0
+        else:
+            raise ValueError("Interpolation weights are only available for 'nearest' and 'linear', not '%s'" % method)
+        self._setup(method, points.shape[0], indices, weights, outside,
+                    _digest(points), _digest(targets))
+
+    def _setup(self, method, nsource, indices, weights, outside, source_hash, target_hash):
+        self.method = method
+        self.nsource = nsource
+        self.ntarget = indices.shape[0]
+        self.indices = indices
+        self.weights = weights
+        self.outside = outside
+        self.source_hash = source_hash
+        self.target_hash = target_hash
+        rows = np.repeat(np.arange(self.ntarget), self.indices.shape[1])
+        # Zero weights are stored too, so NaNs on a vertex spread the way
+        # they do with griddata
+        self.matrix = sparse.csr_matrix((self.weights.ravel(), (rows, self.indices.ravel())),
+                                        shape=(self.ntarget, self.nsource))
+
+    def get_key(self):
+        return (self.method, self.source_hash, self.target_hash)
+
+    key = property(get_key, None)
+
+    def matches(self, points, targets):
+        """
+            True if these weights were computed for these source and
+            target points.
+        """
+        return self.source_hash == _digest(points) and self.target_hash == _digest(targets)
+
+    def save(self, filename):
+        """
+            Write the weights and grid digests to an .npz file.
+        """
+        np.savez(filename, method=np.asarray(self.method), nsource=np.asarray(self.nsource),
+                 indices=self.indices, weights=self.weights, outside=self.outside,
+                 source_hash=np.asarray(self.source_hash), target_hash=np.asarray(self.target_hash))
+
+    @classmethod
+    def load(cls, filename, points=None, targets=None):
+        """
+            Read weights written by save.  When the source points and/or
+            target points are given, weights that were computed for other
+            grids raise a ValueError.
+        """
+        f = np.load(filename)
+        try:
+            new = cls.__new__(cls)
+            new._setup(str(f['method']), int(f['nsource']), f['indices'], f['weights'], f['outside'],
+                       str(f['source_hash']), str(f['target_hash']))
+        finally:
+            f.close()
+        if points is not None and _digest(points) != new.source_hash:
+            raise ValueError("%s was computed for another source grid" % filename)
+        if targets is not None and _digest(targets) != new.target_hash:
+            raise ValueError("%s was computed for another target grid" % filename)
+        return new
+
+    def apply(self, data):
+        """
+            Interpolate data on the source points (flattened to one value
+            per point along its first axis) to the target points.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        values = self.matrix.dot(data.reshape((self.nsource, -1)))
+        values[self.outside] = np.nan
+        return values.reshape((self.ntarget,) + data.shape[1:])
+
+def _bracket(axis, values, method='linear'):
+    """
+        Where each of the values falls on a 1-D axis (ascending or
+        descending), found with a binary search.
+
+        Returns (lower, upper, weight, outside): the indexes of the axis
+        elements on either side of each value and the weight of the
+        upper one for "linear", or the index of the closest element (in
+        both lower and upper) and a weight of 0 for "nearest".  outside
+        marks values beyond the ends of the axis, which "nearest" snaps
+        to the end instead.
+    """
+    axis = np.asarray(axis, dtype=np.float64).ravel()
+    values = np.asarray(values, dtype=np.float64).ravel()
+    n = axis.shape[0]
+    flip = n > 1 and axis[-1] < axis[0]
+    if flip:
+        axis = axis[::-1]
+    if n == 1:
+        lower = np.zeros(values.shape[0], dtype=np.int64)
+        upper = lower
+        weight = np.zeros(values.shape[0])
+    else:
+        upper = np.clip(np.searchsorted(axis, values, side='right'), 1, n - 1)
+        lower = upper - 1
+        weight = (values - axis[lower]) / (axis[upper] - axis[lower])
+    with np.errstate(invalid='ignore'):
+        outside = np.logical_or(values < axis[0], values > axis[-1])
+    if method == 'nearest':
+        lower = np.where(weight > 0.5, upper, lower)
+        upper = lower
+        weight = np.zeros(values.shape[0])
+        outside = np.zeros(values.shape[0], dtype=bool)
+    else:
+        weight = np.clip(weight, 0, 1)
+    outside = np.logical_or(outside, np.isnan(values))
+    if flip:
+        lower, upper = n - 1 - lower, n - 1 - upper
+    return lower, upper, weight, outside
+
+class SeparableInterpolator(object):
+    """
+        Tensor product ("linear" or "nearest") interpolation of data on a
+        grid with a 1-D coordinate axis per dimension.
+
+        Each dimension is interpolated on its own, one after the other,
+        from a binary search of its axis, so the source and target grids
+        are never expanded into point clouds.  Targets beyond the ends of
+        an axis are NaN with "linear".
+
+        >> i = SeparableInterpolator(data, [times, depths, lats, lons])
+        >> values = i.interpgrid(None, [5.], newlats, newlons)
+    """
+    def __init__(self, data, axes, method='linear'):
+        if method not in ('nearest', 'linear'):
+            raise ValueError("Separable interpolation is only available for 'nearest' and 'linear', not '%s'" % method)
+        data = np.ma.asarray(data)
+        assert len(axes) == data.ndim
+        self.data = np.ma.filled(data.astype(np.float64), np.nan)
+        self.axes = [None if a is None else np.asarray(a, dtype=np.float64).ravel() for a in axes]
+        for a, size in zip(self.axes, self.data.shape):
+            assert a is None or a.shape[0] == size
+        self.method = method
+
+    def interpgrid(self, *targets, **kwargs):
+        """
+            Interpolate onto the target values of each dimension (None
+            keeps a dimension as it is).  kwargs:
+            data -- array to use instead of the one the interpolator was
+                    created with
+        """
+        assert len(targets) == len(self.axes)
+        data = kwargs.get('data', None)
+        if data is None:
+            data = self.data
+        else:
+            data = np.ma.filled(np.ma.asarray(data).astype(np.float64), np.nan)
+        todo = [k for k, target in enumerate(targets) if target is not None]
+        # The dimensions that shrink the most go first
+        todo.sort(key=lambda k: np.size(targets[k]) / float(data.shape[k]))
+        for k in todo:
+            assert self.axes[k] is not None
+            lower, upper, weight, outside = _bracket(self.axes[k], targets[k], self.method)
+            shape = [1] * data.ndim
+            shape[k] = lower.shape[0]
+            values = np.take(data, lower, axis=k)
+            if np.any(weight > 0):
+                weight = weight.reshape(shape)
+                # Targets on a grid line do not pick up NaNs from the next one
+                values = np.where(weight > 0, values * (1 - weight) + np.take(data, upper, axis=k) * weight, values)
+            if np.any(outside):
+                values = np.where(outside.reshape(shape), np.nan, values)
+            data = values
+        return data
+
 class CfGeoInterpolator(object):
+    """
+        Interpolate data on CF style lon/lat(/z/t) coordinates onto other
+        coordinates with griddata.
+
+        For the "nearest" and "linear" methods the source geometry is
+        only worked out once per set of target coordinates and kept as
+        InterpolationWeights, so new data on the same coordinates can be
+        interpolated with a sparse product (see interpgrid's data kwarg).
+        Passing the same dict as `cache` to several interpolators shares
+        the weights between all of them, keyed by a digest of the source
+        and target points.  Precomputed InterpolationWeights (or the name
+        of a file they were saved to) can be passed as `weights`, and are
+        rejected with a ValueError if they do not belong to the source
+        and target points.
+
+        When the source and target coordinates are all 1-D axes the
+        interpolation is done per axis with a SeparableInterpolator
+        instead, and the point clouds are never built.
+    """
     def __init__(self, data, lon, lat, t=None, z=None, **kwargs):
-        method = kwargs.get('method', 'nearest')
-        coords = {'lat':lat, 'lon':lon, 'z':z, 't':t}
-        dimensions, ndshape = self._flatten_coords(**coords)
-        self.points = np.asarray(dimensions).T
+        self.weights = kwargs.get('weights', None)
+        if isinstance(self.weights, basestring):
+            self.weights = InterpolationWeights.load(self.weights)
+        method = kwargs.get('method', getattr(self.weights, 'method', 'nearest'))
+        self._coords = {'lat':lat, 'lon':lon, 'z':z, 't':t}
+        self._points = None
         self.data = data.flatten()
         self.method = method
-        self.numdim = self.points.shape[1]
-        assert self.data.shape[0] == self.points.shape[0]
+        self.cache = kwargs.get('cache', None)
+        if self.cache is None:
+            self.cache = dict()
+        self._separable = None
+        if method in ('nearest', 'linear'):
+            axes = self._separable_axes(lon, lat, t=t, z=z)
+            if axes is not None and data.shape == tuple(a.shape[0] for a in axes):
+                self._separable = SeparableInterpolator(data, axes, method=method)
+        if self.weights is not None:
+            # Precomputed weights are for the point cloud
+            self._separable = None
+        if self._separable is None:
+            assert self.data.shape[0] == self.points.shape[0]
+            self.numdim = self.points.shape[1]
+        else:
+            self.numdim = len(self._separable.axes)
 
-    def interpgrid(self, lon, lat, t=None, z=None, **kwargs):
+    def get_points(self):
+        """
+            The source coordinates as an (npoints, ndim) point cloud.
+        """
+        if self._points is None:
+            dimensions, ndshape = self._flatten_coords(**self._coords)
+            self._points = np.asarray(dimensions).T
+        return self._points
+
+    points = property(get_points, None)
+
+    def _separable_axes(self, lon, lat, t=None, z=None):
+        """
+            The 1-D axes in the order _flatten_coords lays the points out
+            in (t, z, lon, lat), or None when any of them is not 1-D.
+        """
+        axes = [a for a in (t, z) if a is not None] + [lon, lat]
+        if all(np.ndim(a) == 1 for a in axes):
+            return [np.asarray(a) for a in axes]
+        return None
+
+    def get_weights(self, lon, lat, t=None, z=None):
+        """
+            InterpolationWeights from the source points onto the target
+            coordinates, and the shape of the target grid.
+        """
         coords = {'lat':lat, 'lon':lon, 'z':z, 't':t}
         dimensions, ndshape = self._flatten_coords(**coords)
         dimensions = np.asarray(dimensions).T
-        #print self.points.shape, self.data.shape, dimensions.shape
-        #print np.histogram(self.data)
-        f = griddata(self.points, self.data, dimensions, method=self.method)
+        key = (self.method, _digest(self.points), _digest(dimensions))
+        if self.weights is not None:
+            if self.weights.key != key:
+                raise ValueError("The interpolation weights were computed for other grids")
+            return self.weights, ndshape
+        weights = self.cache.get(key)
+        if weights is None:
+            weights = InterpolationWeights(self.points, dimensions, method=self.method)
+            self.cache[key] = weights
+        return weights, ndshape
+
+    def interpgrid(self, lon, lat, t=None, z=None, **kwargs):
+        """
+            Interpolate onto the target coordinates.  kwargs:
+            data -- values on the source points to use instead of the ones
+                    the interpolator was created with
+        """
+        data = kwargs.get('data', None)
+        if data is None:
+            data = self.data
+        data = np.asarray(data).flatten()
+        if self._separable is not None:
+            targets = self._separable_axes(lon, lat, t=t, z=z)
+            if targets is not None and len(targets) == self.numdim:
+                data = data.reshape(self._separable.data.shape)
+                f = self._separable.interpgrid(*targets, data=data)
+                # Same layout as the point cloud path
+                ndshape = [lon.shape[0], lat.shape[0]] + [a.shape[0] for a in (z, t) if a is not None]
+                return np.squeeze( f.reshape( *ndshape[::-1] ) )
+        if self.method in ('nearest', 'linear'):
+            weights, ndshape = self.get_weights(lon, lat, t=t, z=z)
+            f = weights.apply(data)
+        else:
+            coords = {'lat':lat, 'lon':lon, 'z':z, 't':t}
+            dimensions, ndshape = self._flatten_coords(**coords)
+            dimensions = np.asarray(dimensions).T
+            f = griddata(self.points, data, dimensions, method=self.method)
         return np.squeeze( f.reshape( *ndshape ) )
 
     def _flatten_coords(self, **coords):
@@ -88,8 +402,8 @@ class CfGeoInterpolator(object):
             lat = lat.flatten()
 
         # Configure the z coords to provide cell by cell z value
-        if z == None:
-            if t == None:
+        if z is None:
+            if t is None:
                 dimensions = [lon, lat]
             else:
                 ndshape.append(t.shape[0])
@@ -97,7 +411,7 @@ class CfGeoInterpolator(object):
                 t, lon = np.meshgrid(t, lon, indexing='ij')
                 dimensions = [lon.flatten(), lat.flatten(), t.flatten()]
         elif len(z.shape) == 4:
-            assert t != None
+            assert t is not None
             ndshape.append(z.shape[1])
             ndshape.append(t.shape[0])
             lat = np.meshgrid(t, range(z.shape[1]), lat, indexing='ij')[-1]
@@ -106,7 +420,7 @@ class CfGeoInterpolator(object):
             dimensions = [lon.flatten(), lat.flatten(), z, t.flatten()]
         elif len(z.shape) ==  3:
             assert np.all(z.shape[1:] == latshape)
-            if t == None:
+            if t is None:
                 ndshape.append(z.shape[0])
                 lat = np.meshgrid(range(z.shape[0]), lat, indexing='ij')[-1]
                 lon = np.meshgrid(range(z.shape[0]), lon, indexing='ij')[-1]
@@ -120,7 +434,7 @@ class CfGeoInterpolator(object):
                 t, z = np.meshgrid(t, z.flatten(), indexing='ij')
                 dimensions = [lon.flatten(), lat.flatten(), z.flatten(), t.flatten()]
         elif len(z.shape) == 1:
-            if t == None:
+            if t is None:
                 ndshape.append(z.shape[0])
                 lat = np.meshgrid(z, lat, indexing='ij')[-1]
                 z, lon = np.meshgrid(z, lon, indexing='ij')
@@ -1,7 +1,9 @@
 import math
+import os, tempfile, shutil
 import unittest
 import numpy as np
-from paegan.utils.asainterpolate import GenInterpolator, CfGeoInterpolator, create_grid
+from scipy.interpolate import griddata, RegularGridInterpolator
+from paegan.utils.asainterpolate import GenInterpolator, CfGeoInterpolator, InterpolationWeights, create_grid
 
 class CfInterpolator(unittest.TestCase):
     def test_interpolator_2d(self):
@@ -107,6 +109,71 @@ class CfInterpolator(unittest.TestCase):
         data2 = i.interpgrid(lon, lat, z=z, t=t)
         assert np.all(data==data2)
 
+    def test_interpolator_weights_match_griddata(self):
+        lon, lat = create_grid(-70, -60, 40, 50, nx=30, ny=25)
+        lon, lat = np.meshgrid(lon, lat)
+        lon = lon + 0.05 * np.random.rand(*lon.shape)
+        newlon, newlat = create_grid(-71, -61, 41, 49, nx=20, ny=15)
+        for method in ['nearest', 'linear']:
+            cache = dict()
+            data = np.random.rand(25, 30)
+            data[3:5, 4:9] = np.nan
+            i = CfGeoInterpolator(data, lon, lat, method=method, cache=cache)
+            data2 = i.interpgrid(newlon, newlat)
+            dimensions, ndshape = i._flatten_coords(lon=newlon, lat=newlat, z=None, t=None)
+            expected = griddata(i.points, i.data, np.asarray(dimensions).T, method=method)
+            assert np.allclose(data2, np.squeeze(expected.reshape(*ndshape)), equal_nan=True)
+            # New data on the same grids reuses the weights
+            other = np.random.rand(25, 30)
+            i2 = CfGeoInterpolator(other, lon, lat, method=method, cache=cache)
+            assert np.allclose(i2.interpgrid(newlon, newlat), i.interpgrid(newlon, newlat, data=other), equal_nan=True)
+            assert len(cache) == 1
+
+    def test_interpolator_saved_weights(self):
+        lon, lat = create_grid(-70, -60, 40, 50, nx=30, ny=25)
+        lon, lat = np.meshgrid(lon, lat)
+        newlon, newlat = create_grid(-71, -61, 41, 49, nx=20, ny=15)
+        data = np.random.rand(25, 30)
+        i = CfGeoInterpolator(data, lon, lat, method='linear')
+        expected = i.interpgrid(newlon, newlat)
+        weights, ndshape = i.get_weights(newlon, newlat)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "weights.npz")
+            weights.save(filename)
+            # By object and by file name
+            loaded = InterpolationWeights.load(filename)
+            i = CfGeoInterpolator(data, lon, lat, weights=loaded)
+            assert i.method == 'linear'
+            assert np.allclose(i.interpgrid(newlon, newlat), expected, equal_nan=True)
+            i = CfGeoInterpolator(data, lon, lat, weights=filename)
+            assert np.allclose(i.interpgrid(newlon, newlat), expected, equal_nan=True)
+            # Weights for other grids are rejected
+            self.assertRaises(ValueError, i.interpgrid, newlon + 0.1, newlat)
+            self.assertRaises(ValueError, InterpolationWeights.load, filename, points=i.points[1:])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_interpolator_separable(self):
+        lon, lat = create_grid(-70, -60, 40, 50, nx=30, ny=25)
+        z = np.arange(10.)
+        data = np.random.rand(10, 30, 25)
+        newlon, newlat = create_grid(-71, -61, 41, 49, nx=20, ny=15)
+        newz = np.array([0.5, 3.25])
+        for method in ['nearest', 'linear']:
+            i = CfGeoInterpolator(data, lon, lat, z=z, method=method)
+            assert i._separable is not None and i._points is None
+            data2 = i.interpgrid(newlon, newlat, z=newz)
+            dimensions, ndshape = i._flatten_coords(lon=newlon, lat=newlat, z=newz, t=None)
+            expected = RegularGridInterpolator((z, lon, lat), data, method=method, bounds_error=False,
+                                               fill_value=np.nan)(np.asarray(dimensions)[[2, 0, 1]].T)
+            if method == 'nearest':
+                # Nearest snaps to the edge outside of the source grid
+                inside = np.isfinite(expected)
+                assert np.allclose(data2.ravel()[inside], expected[inside])
+            else:
+                assert np.allclose(data2.ravel(), expected, equal_nan=True)
+
 class GeneralInterpolator(unittest.TestCase):
     def test_interpolator_2d(self):
         lonbounds = [-70, -60]
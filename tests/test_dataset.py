@@ -1,5 +1,5 @@
 from paegan.cdm.dataset import CommonDataset
-import unittest, os, pytz
+import unittest, os, pytz, tempfile, shutil, netCDF4
 from datetime import datetime
 import numpy as np
 from shapely.geometry import Polygon, box
@@ -101,6 +101,58 @@ class DatasetTest(unittest.TestCase):
 
         pd.closenc()
 
+    @unittest.skipIf(not os.path.exists(os.path.join(data_path, "ocean_avg_synoptic_seg22.nc")),
+                     "Resource files are missing that are required to perform the tests.")
+    def test_cgrid_shared_coordinates(self):
+
+        datafile = os.path.join(data_path, "ocean_avg_synoptic_seg22.nc")
+        pd = CommonDataset.open(datafile)
+
+        # Variables on the same coordinates share one object
+        assert pd.gettimevar('u') is pd.gettimevar('v')
+        assert pd.getdepthvar('u') is pd.getdepthvar('v')
+        assert pd.getgridobj('u') is not pd.getgridobj('v')
+        assert pd.getgridobj('h') is pd.getgridobj('zeta')
+
+        # Restricting works on copies and leaves the original alone
+        grid = pd.getgridobj('h')
+        bbox = (np.nanmin(grid._xarray) + 0.1, np.nanmin(grid._yarray) + 0.1,
+                np.nanmax(grid._xarray) - 0.1, np.nanmax(grid._yarray) - 0.1)
+        test = pd.restrict_bbox(bbox)
+        assert np.isnan(test.getgridobj('h')._xarray).any()
+        assert test.getgridobj('h') is test.getgridobj('zeta')
+        assert not np.isnan(pd.getgridobj('h')._xarray).any()
+
+        pd.closenc()
+
+    @unittest.skipIf(not os.path.exists(os.path.join(data_path, "ocean_avg_synoptic_seg22.nc")),
+                     "Resource files are missing that are required to perform the tests.")
+    def test_cgrid_axis_layout(self):
+
+        datafile = os.path.join(data_path, "ocean_avg_synoptic_seg22.nc")
+        pd = CommonDataset.open(datafile)
+
+        layout = pd.get_axis_layout('u')
+        assert layout is pd.get_axis_layout('u')
+        assert layout.dims == ('ocean_time', 's_rho', 'eta_u', 'xi_u')
+        assert layout.time == (0,)
+        assert layout.z == (1,)
+        assert layout.x == (2, 3)
+        assert layout.names == pd.get_coord_names('u')
+
+        # Reading a bbox goes through the layout
+        grid = pd.getgridobj('h')
+        bbox = (np.nanmin(grid._xarray) + 0.1, np.nanmin(grid._yarray) + 0.1,
+                np.nanmax(grid._xarray) - 0.1, np.nanmax(grid._yarray) - 0.1)
+        values = pd.get_values('h', bbox=bbox)
+        assert values.ndim == 2 and values.size > 0
+
+        test = pd.restrict_vars('u')
+        assert test.get_axis_layout('u') is not layout
+        assert test.get_axis_layout('u') == layout
+
+        pd.closenc()
+
     @unittest.skipIf(not os.path.exists(os.path.join(data_path, "m201310100.out3.nc")),
                      "Resource files are missing that are required to perform the tests.")
     def test_cgrid_init_pom_depths(self):
@@ -306,3 +358,193 @@ class DatasetTest(unittest.TestCase):
         assert pd._datasettype == 'rgrid'
         values = pd.get_values(var="u", bbox=[-149, 59, -144, 61.5], timeinds=0)
         assert values.size > 0
+
+    @unittest.skipIf(not os.path.exists(os.path.join(data_path, "pws_L2_2012040100.nc")),
+                     "Resource files are missing that are required to perform the tests.")
+    def test_rgrid_get_values_at_points(self):
+        from paegan.location4d import Location4D
+        datafile = os.path.join(data_path, "pws_L2_2012040100.nc")
+        pd = CommonDataset.open(datafile)
+        starting = datetime(2012, 4, 1, 2, tzinfo=pytz.utc)
+        points = [Location4D(latitude=60.5 + i * 0.01, longitude=-147 + i * 0.02, depth=5, time=starting) for i in range(10)]
+        values = pd.get_values_at_points("u", points=points)
+        assert values.shape == (10,)
+        for i, point in enumerate(points):
+            assert values[i] == np.ravel(pd.get_values("u", point=point))[0]
+        pd.closenc()
+
+
+class RGridValuesOnGridTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tmpdir, "rgrid.nc")
+        nc = netCDF4.Dataset(self.datafile, 'w')
+        nc.createDimension('time', 4)
+        nc.createDimension('depth', 3)
+        nc.createDimension('lat', 20)
+        nc.createDimension('lon', 30)
+        time = nc.createVariable('time', 'f8', ('time',))
+        time.units = 'hours since 2012-01-01 00:00:00'
+        time[:] = np.arange(4)
+        nc.createVariable('depth', 'f8', ('depth',))[:] = [0, 10, 20]
+        nc.createVariable('lat', 'f8', ('lat',))[:] = 40 + 0.1 * np.arange(20)
+        nc.createVariable('lon', 'f8', ('lon',))[:] = -70 + 0.1 * np.arange(30)
+        u = nc.createVariable('u', 'f8', ('time', 'depth', 'lat', 'lon'))
+        u.coordinates = 'time depth lat lon'
+        t, z, y, x = np.meshgrid(np.arange(4), [0, 10, 20], 40 + 0.1 * np.arange(20),
+                                 -70 + 0.1 * np.arange(30), indexing='ij')
+        u[:] = 2 * t + 0.1 * z + 3 * y - x
+        v = nc.createVariable('v', 'f8', ('time', 'depth', 'lat', 'lon'))
+        v.coordinates = 'time depth lat lon'
+        v[:] = 2 * u[:]
+        h = nc.createVariable('h', 'f8', ('lat', 'lon'))
+        h.coordinates = 'lat lon'
+        h[:] = 3 * y[0, 0] - x[0, 0]
+        nc.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rgrid_values_on_grid_linear(self):
+        pd = CommonDataset.open(self.datafile)
+        assert pd._datasettype == 'rgrid'
+        lon = np.linspace(-69.9, -67.2, 7)
+        lat = np.linspace(40.05, 41.5, 5)
+        z = np.array([5., 15.])
+        t = [datetime(2012, 1, 1, 1, 30)]
+        values = pd.get_values_on_grid("u", lon, lat, z=z, t=t, method='linear')
+        assert values.shape == (1, 2, 5, 7)
+        z, y, x = np.meshgrid(z, lat, lon, indexing='ij')
+        assert np.allclose(values[0], 2 * 1.5 + 0.1 * z + 3 * y - x)
+        # Whole grid, nearest, gives back the data
+        coords = pd.sub_coords("u", bbox=(-180, -90, 180, 90))
+        values = pd.get_values_on_grid("u", coords.x, coords.y, z=coords.z, t=coords.time)
+        assert np.allclose(values, pd.get_values("u", bbox=(-180, -90, 180, 90)))
+        pd.closenc()
+
+    def test_rgrid_values_on_grid_time_semantics(self):
+        # Two hours between time steps, so time indexes and hours differ
+        with netCDF4.Dataset(self.datafile, 'a') as nc:
+            nc.variables['time'][:] = 2 * np.arange(4)
+        pd = CommonDataset.open(self.datafile)
+        lon = np.array([-69.5, -69.4])
+        lat = np.array([40.5, 40.6])
+        z = np.array([0., 10.])
+        zz, yy, xx = np.meshgrid(z, lat, lon, indexing='ij')
+        eastern = pytz.timezone('US/Eastern')
+
+        # Numbers are time indexes, datetimes are converted to UTC
+        for t in [[1.5], [datetime(2012, 1, 1, 3)], [datetime(2012, 1, 1, 3, tzinfo=pytz.utc)],
+                  [eastern.localize(datetime(2011, 12, 31, 22))]]:
+            values = pd.get_values_on_grid("u", lon, lat, z=z, t=t, method='linear')
+            assert np.allclose(values[0], 2 * 1.5 + 0.1 * zz + 3 * yy - xx)
+
+        # The same on the scattered path taken for 2-D targets
+        x2, y2 = np.meshgrid(lon, lat)
+        for t in [[2.2], [datetime(2012, 1, 1, 4, 20)], [eastern.localize(datetime(2011, 12, 31, 23, 20))]]:
+            separable = pd.get_values_on_grid("u", lon, lat, z=z, t=t)
+            scattered = pd.get_values_on_grid("u", x2, y2, z=z, t=t)
+            assert np.allclose(np.ravel(separable), np.ravel(2 * 2 + 0.1 * zz + 3 * yy - xx))
+            assert np.allclose(np.sort(np.ravel(scattered)), np.sort(np.ravel(separable)))
+        pd.closenc()
+
+    def test_rgrid_shared_coordinates(self):
+        pd = CommonDataset.open(self.datafile)
+
+        # Variables on the same coordinates share one object
+        assert pd.gettimevar('u') is pd.gettimevar('v')
+        assert pd.getdepthvar('u') is pd.getdepthvar('v')
+        assert pd.getgridobj('u') is pd.getgridobj('v')
+        assert pd.getgridobj('u') is pd.getgridobj('h')
+
+        # Restricting works on copies and leaves the original alone
+        grid = pd.getgridobj('u')
+        test = pd.restrict_bbox([-69.55, 40.42, -69.0, 41.0])
+        assert np.isnan(test.getgridobj('u')._xarray).any()
+        assert np.isnan(test.getgridobj('u')._yarray).any()
+        assert test.getgridobj('u') is test.getgridobj('v')
+        assert test.getgridobj('u') is not grid
+        assert pd.getgridobj('u') is grid
+        assert not np.isnan(grid._xarray).any()
+        assert not np.isnan(grid._yarray).any()
+
+        pd.closenc()
+
+    def test_rgrid_axis_layout(self):
+        pd = CommonDataset.open(self.datafile)
+
+        layout = pd.get_axis_layout('u')
+        assert layout is pd.get_axis_layout('u')
+        assert pd._layoutcache['u'] is layout
+        assert layout.dims == ('time', 'depth', 'lat', 'lon')
+        assert layout.shape == (4, 3, 20, 30)
+        assert layout.positions == {"time" : (0,), "z" : (1,), "y" : (2,), "x" : (3,)}
+        assert layout.names == {"tname" : "time", "zname" : "depth", "xname" : "lon", "yname" : "lat"}
+        assert layout.names == pd.get_coord_names('u')
+
+        h = pd.get_axis_layout('h')
+        assert h.dims == ('lat', 'lon')
+        assert h.positions == {"time" : None, "z" : None, "y" : (0,), "x" : (1,)}
+        assert h.names == {"tname" : None, "zname" : None, "xname" : "lon", "yname" : "lat"}
+
+        # Reading a bbox goes through the layout
+        values = pd.get_values('u', bbox=[-69.55, 40.42, -69.0, 41.0])
+        assert values.shape == (4, 3, 6, 6)
+
+        # Copies reuse the layouts, restricting the variables starts over
+        test = pd.restrict_bbox([-69.55, 40.42, -69.0, 41.0])
+        assert test.get_axis_layout('u') is layout
+        test = pd.restrict_vars('u')
+        assert test._layoutcache == {}
+        assert test.get_axis_layout('u') is not layout
+        assert test.get_axis_layout('u') == layout
+        assert 'h' in pd._layoutcache
+
+        pd.closenc()
+
+    def test_rgrid_get_values_at_points_max_cells(self):
+        from paegan.location4d import Location4D
+        pd = CommonDataset.open(self.datafile)
+        starting = datetime(2012, 1, 1, 2, tzinfo=pytz.utc)
+        # Two clusters at opposite corners of the grid, at the same time
+        points = [Location4D(latitude=40.0 + i * 0.1, longitude=-70.0 + i * 0.1, depth=10, time=starting) for i in range(3)]
+        points += [Location4D(latitude=41.9 - i * 0.1, longitude=-67.1 - i * 0.1, depth=i * 10, time=starting) for i in range(3)]
+        cells = []
+        get_data = pd._get_data
+        def counting(var, request, use_local=False):
+            cells.append(np.prod([len(r) for r in request]))
+            return get_data(var, request, use_local)
+        pd._get_data = counting
+        values = pd.get_values_at_points("u", points=points, max_cells=20)
+        assert values.shape == (6,)
+        assert len(cells) > 1
+        assert max(cells) <= 20
+        for i, point in enumerate(points):
+            assert values[i] == np.ravel(pd.get_values("u", point=point))[0]
+        # Positions sharing all of their indexes are read whole
+        cells[:] = []
+        values = pd.get_values_at_points("u", points=points[:1] * 3, max_cells=0)
+        assert cells == [1]
+        assert (values == np.ravel(pd.get_values("u", point=points[0]))[0]).all()
+        pd.closenc()
+
+    def test_save_current_as(self):
+        pd = CommonDataset.open(self.datafile)
+        sub = pd.restrict_bbox([-69.55, 40.42, -69.0, 41.0]).restrict_time(
+            [datetime(2012, 1, 1, 1), datetime(2012, 1, 1, 2)]).restrict_vars("u")
+        savefile = os.path.join(self.tmpdir, "subset.nc")
+        # Small blocks, so the copy takes several
+        sub.save_current_as(savefile, block_size=1000)
+        with netCDF4.Dataset(savefile) as nc:
+            assert [len(d) for d in nc.dimensions.values()] == [2, 3, 6, 6]
+            assert np.allclose(nc.variables["lon"][:], -69.5 + 0.1 * np.arange(6))
+            assert np.allclose(nc.variables["time"][:], [1, 2])
+            assert nc.variables["time"].units == 'hours since 2012-01-01 00:00:00'
+            assert nc.variables["u"].coordinates == 'time depth lat lon'
+            assert nc.variables["u"].filters()["zlib"]
+            assert nc.variables["u"].chunking() != 'contiguous'
+            assert "subset by Python tool 'paegan'" in nc.history
+            with netCDF4.Dataset(self.datafile) as src:
+                assert np.array_equal(nc.variables["u"][:], src.variables["u"][1:3, :, 5:11, 5:11])
+        pd.closenc()
@@ -1,5 +1,7 @@
 import math
 import unittest
+import numpy as np
+from paegan.external.greatcircle import GreatCircle
 from paegan.utils.asagreatcircle import AsaGreatCircle
 from paegan.utils.asamath import AsaMath
 from paegan.location4d import Location4D
@@ -40,3 +42,60 @@ class GreatCircleTest(unittest.TestCase):
         # We should have gone up and to the left
         assert new_pt.latitude > starting.latitude + 0.45
         assert new_pt.longitude < starting.longitude - 0.45
+
+    def test_great_distance_arrays(self):
+        rs = np.random.RandomState(0)
+        start_lats = rs.uniform(-80, 80, 500)
+        start_lons = rs.uniform(-180, 180, 500)
+        end_lats = np.clip(start_lats + rs.uniform(-10, 10, 500), -89, 89)
+        end_lons = start_lons + rs.uniform(-10, 10, 500)
+        end_lats[:5], end_lons[:5] = start_lats[:5], start_lons[:5]
+
+        gc = AsaGreatCircle.great_distance(start_lats=start_lats, start_lons=start_lons, end_lats=end_lats, end_lons=end_lons)
+        for i in range(500):
+            single = AsaGreatCircle.great_distance(start_point=Location4D(latitude=start_lats[i], longitude=start_lons[i]),
+                                                   end_point=Location4D(latitude=end_lats[i], longitude=end_lons[i]))
+            assert np.allclose(gc['distance'][i], single['distance'], rtol=0, atol=1e-6)
+            assert np.allclose(gc['azimuth'][i], single['azimuth'], rtol=0, atol=1e-9)
+            assert np.allclose(gc['reverse_azimuth'][i], single['reverse_azimuth'], rtol=0, atol=1e-9)
+
+        # The spherical approximation is within its documented error bound
+        hv = AsaGreatCircle.great_distance(start_lats=start_lats, start_lons=start_lons, end_lats=end_lats, end_lons=end_lons, method='haversine')
+        assert np.all(np.abs(hv['distance'] - gc['distance']) <= 0.0056 * gc['distance'])
+
+    def test_vinc_pt_array(self):
+        rmajor, rminor = 6378137.0, 6356752.3142
+        f = (rmajor - rminor) / rmajor
+        rs = np.random.RandomState(1)
+        lats = np.radians(rs.uniform(-80, 80, 200))
+        lons = np.radians(rs.uniform(-180, 180, 200))
+        azimuths = np.radians(rs.uniform(0, 360, 200))
+        distances = rs.uniform(0, 500000, 200)
+        distances[0] = 0
+        phi2, lembda2, alpha21 = GreatCircle.vinc_pt_array(f, rmajor, lats, lons, azimuths, distances)
+        for i in range(200):
+            single = GreatCircle.vinc_pt(f, rmajor, lats[i], lons[i], azimuths[i], distances[i])
+            assert np.allclose((phi2[i], lembda2[i], alpha21[i]), single, rtol=0, atol=1e-12)
+
+    def test_great_circle_arrays(self):
+        rs = np.random.RandomState(2)
+        lats = rs.uniform(-80, 80, 100)
+        lons = rs.uniform(-180, 180, 100)
+        azimuths = rs.uniform(0, 360, 100)
+        distances = rs.uniform(0, 50000, 100)
+        moved = AsaGreatCircle.great_circle(start_lats=lats, start_lons=lons, azimuth=azimuths, distance=distances)
+        spherical = AsaGreatCircle.great_circle(start_lats=lats, start_lons=lons, azimuth=azimuths, distance=distances, method='haversine')
+        for i in range(100):
+            single = AsaGreatCircle.great_circle(start_point=Location4D(latitude=lats[i], longitude=lons[i], depth=0), azimuth=azimuths[i], distance=distances[i])
+            assert abs(moved['latitude'][i] - single['latitude']) < 1e-10
+            assert abs(moved['longitude'][i] - single['longitude']) < 1e-10
+            assert abs(moved['reverse_azimuth'][i] - single['reverse_azimuth']) < 1e-10
+            assert abs(spherical['latitude'][i] - single['latitude']) < 0.01
+            assert abs(spherical['longitude'][i] - single['longitude']) < 0.01
+
+        # The spherical path lands at the haversine distance and azimuth
+        back = AsaGreatCircle.great_distance(start_lats=lats, start_lons=lons,
+                                             end_lats=spherical['latitude'], end_lons=spherical['longitude'],
+                                             method='haversine')
+        assert np.allclose(back['distance'], distances, rtol=0, atol=1e-4)
+        assert np.allclose(back['reverse_azimuth'], spherical['reverse_azimuth'], rtol=0, atol=1e-6)
@@ -0,0 +1,145 @@
+import unittest, os, tempfile, shutil, netCDF4
+import numpy as np
+from shapely.geometry import Point
+from paegan.cdm.gridvar import Gridobj
+from paegan.location4d import Location4D
+from paegan.utils.asagreatcircle import AsaGreatCircle
+
+class GridobjTest(unittest.TestCase):
+
+    def setUp(self):
+        # A small rotated curvilinear grid, similar to a ROMS rho grid
+        self.tmpdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tmpdir, "curvilinear.nc")
+        nc = netCDF4.Dataset(self.datafile, 'w')
+        nc.createDimension('eta_rho', 40)
+        nc.createDimension('xi_rho', 60)
+        j, i = np.mgrid[0:40, 0:60]
+        lon = nc.createVariable('lon_rho', 'f8', ('eta_rho', 'xi_rho'))
+        lon[:] = -76 + 0.02 * (i * np.cos(0.3) - j * np.sin(0.3))
+        lat = nc.createVariable('lat_rho', 'f8', ('eta_rho', 'xi_rho'))
+        lat[:] = 37 + 0.02 * (i * np.sin(0.3) + j * np.cos(0.3))
+        nc.close()
+        self.nc = netCDF4.Dataset(self.datafile)
+
+    def tearDown(self):
+        self.nc.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cgrid_near_xy_matches_brute_force(self):
+        grid = Gridobj(self.nc, "lon_rho", "lat_rho")
+        rs = np.random.RandomState(0)
+        for i in range(50):
+            point = Location4D(latitude=37 + rs.rand(), longitude=-76.3 + rs.rand() * 1.3)
+            yinds, xinds = grid.near_xy(point=point)
+            distance = AsaGreatCircle.great_distance(
+                start_lats=grid._yarray, start_lons=grid._xarray,
+                end_lats=point.latitude, end_lons=point.longitude)["distance"]
+            brute = np.where(distance == np.nanmin(distance))
+            assert np.array_equal(yinds, brute[0])
+            assert np.array_equal(xinds, brute[1])
+
+    def test_cgrid_near_xy_num(self):
+        grid = Gridobj(self.nc, "lon_rho", "lat_rho")
+        point = Location4D(latitude=37.3, longitude=-75.8)
+        yinds, xinds = grid.near_xy(point=point, num=4)
+        assert yinds.shape[0] == 4
+        closest = grid.near_xy(point=point)
+        assert yinds[0] == closest[0][0] and xinds[0] == closest[1][0]
+
+    def test_cgrid_window_from_bbox(self):
+        grid = Gridobj(self.nc, "lon_rho", "lat_rho")
+        grid._block_size = 8
+        # Some land
+        x = grid._xarray.copy()
+        x[10:14, 20:33] = np.nan
+        grid = grid._with_arrays(x, grid._yarray)
+        rs = np.random.RandomState(3)
+        for i in range(200):
+            x0, y0 = -76.3 + rs.rand() * 1.3, 37 + rs.rand()
+            bbox = [x0, y0, x0 + rs.rand() * 0.6, y0 + rs.rand() * 0.6]
+            with np.errstate(invalid='ignore'):
+                inds = np.where(np.logical_and(grid.get_xbool_from_bbox(bbox), grid.get_ybool_from_bbox(bbox)))
+            window = grid.window_from_bbox(bbox)
+            if inds[0].size == 0:
+                assert window is None
+            else:
+                assert window == (inds[0].min(), inds[0].max(), inds[1].min(), inds[1].max())
+
+    def test_cgrid_boundingpolygon(self):
+        grid = Gridobj(self.nc, "lon_rho", "lat_rho")
+        polygon = grid.boundingpolygon
+        assert polygon.is_valid
+        assert np.allclose(polygon.area, (39 * 0.02) * (59 * 0.02))
+        assert grid.boundingpolygon is polygon
+        prepared = grid.prepared_boundingpolygon
+        assert prepared.contains(polygon.centroid)
+        assert grid.prepared_boundingpolygon is prepared
+        # Restricted grids get their own polygon
+        assert grid._with_arrays(grid._xarray[5:, 5:], grid._yarray[5:, 5:]).boundingpolygon.area < polygon.area
+
+    def test_contains_points(self):
+        grid = Gridobj(self.nc, "lon_rho", "lat_rho")
+        rs = np.random.RandomState(4)
+        lons = -76.5 + rs.rand(300) * 1.7
+        lats = 36.8 + rs.rand(300) * 1.4
+        inside = grid.contains_points(lons, lats)
+        polygon = grid.boundingpolygon
+        assert inside.tolist() == [polygon.contains(Point(x, y)) for x, y in zip(lons, lats)]
+        assert 0 < inside.sum() < 300
+        # The convex hull of the same positions as an unstructured node set
+        assert np.array_equal(grid.contains_points(lons, lats, ncell=True), inside)
+
+    def test_ncell_nearest_neighbors(self):
+        # The curvilinear nodes, flattened into an unstructured node set
+        nc = netCDF4.Dataset(os.path.join(self.tmpdir, "ncell.nc"), 'w')
+        nc.createDimension('node', 40 * 60)
+        nc.createVariable('lon', 'f8', ('node',))[:] = self.nc.variables['lon_rho'][:].ravel()
+        nc.createVariable('lat', 'f8', ('node',))[:] = self.nc.variables['lat_rho'][:].ravel()
+        nc.close()
+        nc = netCDF4.Dataset(os.path.join(self.tmpdir, "ncell.nc"))
+        grid = Gridobj(nc, "lon", "lat")
+        rs = np.random.RandomState(2)
+        lons = -76.3 + rs.rand(20) * 1.3
+        lats = 37 + rs.rand(20)
+        inds, dists = grid.nearest_neighbors(lons, lats, num=5)
+        assert inds.shape == (20, 5)
+        for i in range(20):
+            distance = AsaGreatCircle.great_distance(
+                start_lats=grid._yarray, start_lons=grid._xarray,
+                end_lats=lats[i], end_lons=lons[i])["distance"]
+            assert np.array_equal(inds[i], np.argsort(distance, kind='mergesort')[:5])
+            assert np.allclose(dists[i], np.sort(distance)[:5])
+        point = Location4D(latitude=lats[0], longitude=lons[0])
+        yinds, xinds = grid.near_xy(point=point, num=5, ncell=True)
+        assert np.array_equal(xinds[0], inds[0])
+        nc.close()
+
+    def test_ncell_near_xy_matches_brute_force(self):
+        # The curvilinear nodes as an unstructured node set, with the first
+        # 50 nodes repeated at the end so some positions have ties
+        lon = self.nc.variables['lon_rho'][:].ravel()
+        lat = self.nc.variables['lat_rho'][:].ravel()
+        nc = netCDF4.Dataset(os.path.join(self.tmpdir, "ncell.nc"), 'w')
+        nc.createDimension('node', lon.size + 50)
+        nc.createVariable('lon', 'f8', ('node',))[:] = np.concatenate((lon, lon[:50]))
+        nc.createVariable('lat', 'f8', ('node',))[:] = np.concatenate((lat, lat[:50]))
+        nc.close()
+        nc = netCDF4.Dataset(os.path.join(self.tmpdir, "ncell.nc"))
+        grid = Gridobj(nc, "lon", "lat")
+        rs = np.random.RandomState(5)
+        points = [Location4D(latitude=37 + rs.rand(), longitude=-76.3 + rs.rand() * 1.3) for i in range(50)]
+        points.append(Location4D(latitude=lat[3], longitude=lon[3]))
+        for point in points:
+            yinds, xinds = grid.near_xy(point=point, ncell=True)
+            distance = AsaGreatCircle.great_distance(
+                start_lats=grid._yarray, start_lons=grid._xarray,
+                end_lats=point.latitude, end_lons=point.longitude)["distance"]
+            brute = np.where(distance == np.nanmin(distance))
+            assert np.array_equal(xinds[0], brute[0])
+            assert np.array_equal(yinds[0], brute[0])
+        assert np.array_equal(xinds[0], [3, lon.size + 3])
+        nc.close()
+
+if __name__ == '__main__':
+    unittest.main()
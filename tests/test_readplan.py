@@ -0,0 +1,60 @@
+import unittest
+import numpy as np
+from paegan.cdm.readplan import ReadPlanner
+
+def orthogonal(data, indarray):
+    """ What netCDF4 returns for var[indarray] """
+    picks, drop = [], []
+    for ind in indarray:
+        drop.append(np.ndim(ind) == 0)
+        picks.append(np.atleast_1d(ind))
+    return data[np.ix_(*picks)][tuple(0 if d else slice(None) for d in drop)]
+
+class ReadPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = np.arange(6 * 4 * 30 * 40).reshape(6, 4, 30, 40)
+
+    def test_contiguous_is_one_request(self):
+        planner = ReadPlanner()
+        indarray = [np.arange(6), np.arange(1, 3), np.arange(5, 25), np.arange(40)]
+        values = planner.read(self.data, indarray)
+        assert np.array_equal(values, orthogonal(self.data, indarray))
+        assert planner.requests == 1
+        assert planner.bytes == values.nbytes
+
+    def test_scattered_indexes(self):
+        rs = np.random.RandomState(0)
+        planner = ReadPlanner(gap=2, max_slabs=10)
+        for i in range(20):
+            indarray = [rs.randint(0, 6), rs.randint(0, 4, 3),
+                        rs.randint(0, 30, 12), rs.randint(0, 40, 7)]
+            values = planner.read(self.data, indarray)
+            assert np.array_equal(values, orthogonal(self.data, indarray))
+        assert planner.requests <= 20 * 10
+
+    def test_scattered_nodes_bounded(self):
+        # A scattered selection of nodes of an unstructured mesh
+        data = np.arange(2 * 200000).reshape(2, 200000)
+        indarray = [np.arange(2), np.sort(np.random.RandomState(1).choice(200000, 10000, replace=False))]
+        for max_slabs in [1, 16, 64]:
+            planner = ReadPlanner(max_slabs=max_slabs)
+            values = planner.read(data, indarray)
+            assert np.array_equal(values, orthogonal(data, indarray))
+            assert planner.requests <= max_slabs
+
+    def test_gap_tolerance(self):
+        indarray = [np.array([0]), np.array([0]), np.array([0, 3, 20]), np.arange(40)]
+        planner = ReadPlanner(gap=0)
+        planner.read(self.data, indarray)
+        assert planner.requests == 3
+        planner = ReadPlanner(gap=2)
+        planner.read(self.data, indarray)
+        assert planner.requests == 2
+
+    def test_out_of_range(self):
+        planner = ReadPlanner()
+        self.assertRaises(IndexError, planner.read, self.data, [0, 0, 0, np.array([40])])
+
+if __name__ == '__main__':
+    unittest.main()
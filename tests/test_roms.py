@@ -1,6 +1,7 @@
-import unittest, os, math, netCDF4
+import unittest, os, math, tempfile, shutil, logging, netCDF4
 import numpy as np
 from paegan.roms import roms as rm
+from paegan.logger import logger
 
 data_path = "/data/lm/tests"
 
@@ -64,6 +65,25 @@ class RomsTest(unittest.TestCase):
 
         assert np.allclose(r,result_test)
 
+    def test_uv_to_rho_vectorized(self):
+        rs = np.random.RandomState(0)
+        u = rs.rand(4, 3, 12, 14)
+        v = rs.rand(4, 3, 11, 15)
+        angle = rs.rand(12, 15)
+        out = np.empty((4, 3, 12, 15), dtype=complex)
+        uv = rm._uv_to_rho(u, v, angle, 15, 12, out=out)
+        assert uv is out
+        assert np.isnan(uv[..., 0, :]).all() and np.isnan(uv[..., :, -1]).all()
+        for i in range(4):
+            for j in range(3):
+                # One slice at a time, by hand
+                U = np.nan * np.ones((12, 15), dtype=complex)
+                U[1:-1, 1:-1] = rm.average_adjacents(u[i, j])[1:-1, :] + 1j * rm.average_adjacents(v[i, j], True)[:, 1:-1]
+                U = rm.rotate_complex_by_angle(U, angle)
+                assert np.allclose(uv[i, j], U, equal_nan=True)
+                assert np.allclose(rm._uv_to_rho(u[i, j], v[i, j], angle, 15, 12), U, equal_nan=True)
+        self.assertRaises(ValueError, rm._uv_to_rho, u, v, angle, 15, 12, out=np.empty((12, 15), dtype=complex))
+
     @unittest.skipIf(not os.path.exists(os.path.join(data_path, "ocean_avg_synoptic_seg22.nc")),
                      "Resource files are missing that are required to perform the tests.")
     def test_uv_size(self):
@@ -123,5 +143,110 @@ class RomsTest(unittest.TestCase):
         # Why does the right point now work!!!?!?!?!?!?!?
         #assert right_rho == uv_rho[101,102]
 
+class RegridRomsTest(unittest.TestCase):
+
+    def setUp(self):
+        # A small rotated ROMS file with u and v on their staggered grids
+        self.tmpdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tmpdir, "roms.nc")
+        nt, ns, ny, nx = 5, 3, 12, 15
+        nc = netCDF4.Dataset(self.datafile, 'w')
+        for dim, size in [('ocean_time', nt), ('s_rho', ns), ('eta_rho', ny), ('xi_rho', nx),
+                          ('eta_u', ny), ('xi_u', nx - 1), ('eta_v', ny - 1), ('xi_v', nx)]:
+            nc.createDimension(dim, size)
+        j, i = np.mgrid[0:ny, 0:nx]
+        nc.createVariable('lon_rho', 'f8', ('eta_rho', 'xi_rho'))[:] = -70 + 0.1 * i + 0.02 * j
+        nc.createVariable('lat_rho', 'f8', ('eta_rho', 'xi_rho'))[:] = 40 + 0.1 * j - 0.01 * i
+        nc.createVariable('s_rho', 'f8', ('s_rho',))[:] = np.linspace(-0.9, -0.1, ns)
+        time = nc.createVariable('ocean_time', 'f8', ('ocean_time',))
+        time.units = 'seconds since 2012-01-01 00:00:00'
+        time[:] = np.arange(nt) * 3600.
+        nc.createVariable('mask_rho', 'f8', ('eta_rho', 'xi_rho'))[:] = 1
+        nc.createVariable('angle', 'f8', ('eta_rho', 'xi_rho'))[:] = 0.2
+        rs = np.random.RandomState(0)
+        for name, dims, coordinates in [('zeta', ('ocean_time', 'eta_rho', 'xi_rho'), 'lon_rho lat_rho ocean_time'),
+                                        ('temp', ('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), 'lon_rho lat_rho s_rho ocean_time'),
+                                        ('u', ('ocean_time', 's_rho', 'eta_u', 'xi_u'), 'lon_u lat_u s_rho ocean_time'),
+                                        ('v', ('ocean_time', 's_rho', 'eta_v', 'xi_v'), 'lon_v lat_v s_rho ocean_time')]:
+            var = nc.createVariable(name, 'f8', dims)
+            var.coordinates = coordinates
+            var[:] = rs.rand(*[len(nc.dimensions[d]) for d in dims])
+        nc.close()
+        self.lon = np.linspace(-69.8, -68.9, 7)
+        self.lat = np.linspace(40.2, 40.9, 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_streaming_regrid(self):
+        whole = os.path.join(self.tmpdir, "whole.nc")
+        streamed = os.path.join(self.tmpdir, "streamed.nc")
+        rm.regrid_roms(whole, self.datafile, self.lon, self.lat)
+        rm.regrid_roms(streamed, self.datafile, self.lon, self.lat, block=2)
+        with netCDF4.Dataset(whole) as a:
+            with netCDF4.Dataset(streamed) as b:
+                for key in ['zeta', 'temp']:
+                    assert np.allclose(np.ma.filled(a.variables[key][:], np.nan),
+                                       np.ma.filled(b.variables[key][:], np.nan), equal_nan=True)
+                assert b.variables['temp'].shape == (5, 3, 6, 7)
+                assert b.variables['temp'].coordinates == "ocean_time s_new lat_new lon_new"
+                # The vectors are rotated onto the rho grid a time step at a time
+                u = b.variables['u'][:]
+                v = b.variables['v'][:]
+                assert u.shape == v.shape == (5, 3, 6, 7)
+                with netCDF4.Dataset(self.datafile) as nc:
+                    uv = np.asarray([rm._uv_to_rho(nc.variables['u'][3, k], nc.variables['v'][3, k],
+                                                   nc.variables['angle'][:], 15, 12) for k in range(3)])
+                    interpolator = rm.CfGeoInterpolator(uv.real, nc.variables['lon_rho'][:], nc.variables['lat_rho'][:],
+                                                        z=nc.variables['s_rho'][:])
+                    expected = interpolator.interpgrid(self.lon, self.lat, z=nc.variables['s_rho'][:])
+                assert np.allclose(np.ma.filled(u[3], np.nan), expected, equal_nan=True)
+
+    def test_regrid_between_time_steps(self):
+        # New times between the hourly source steps, and one past the end
+        t = np.array([1000., 5000., 9000., 20000.])
+        whole = os.path.join(self.tmpdir, "whole.nc")
+        streamed = os.path.join(self.tmpdir, "streamed.nc")
+        rm.regrid_roms(whole, self.datafile, self.lon, self.lat, t=t)
+        rm.regrid_roms(streamed, self.datafile, self.lon, self.lat, t=t, block=1)
+        with netCDF4.Dataset(whole) as a:
+            with netCDF4.Dataset(streamed) as b:
+                for key in ['zeta', 'temp', 'u', 'v']:
+                    assert np.allclose(np.ma.filled(a.variables[key][:], np.nan),
+                                       np.ma.filled(b.variables[key][:], np.nan), equal_nan=True)
+                zeta = np.ma.filled(a.variables['zeta'][:], np.nan)
+        # Each new time takes the closest source step
+        with netCDF4.Dataset(self.datafile) as nc:
+            for n, step in enumerate([0, 1, 2, 4]):
+                interpolator = rm.CfGeoInterpolator(nc.variables['zeta'][step], nc.variables['lon_rho'][:],
+                                                    nc.variables['lat_rho'][:])
+                expected = interpolator.interpgrid(self.lon, self.lat)
+                assert np.allclose(zeta[n], expected, equal_nan=True)
+
+    def test_parallel_regrid(self):
+        streamed = os.path.join(self.tmpdir, "streamed.nc")
+        parallel = os.path.join(self.tmpdir, "parallel.nc")
+        rm.regrid_roms(streamed, self.datafile, self.lon, self.lat, block=2)
+        progress = []
+        handler = logging.Handler(level=logging.PROGRESS)
+        handler.emit = progress.append
+        logger.addHandler(handler)
+        level = logger.level
+        logger.setLevel(logging.PROGRESS)
+        try:
+            rm.regrid_roms(parallel, self.datafile, self.lon, self.lat, block=2, processes=2)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        with netCDF4.Dataset(streamed) as a:
+            with netCDF4.Dataset(parallel) as b:
+                for key in ['zeta', 'temp', 'u', 'v']:
+                    assert np.allclose(np.ma.filled(a.variables[key][:], np.nan),
+                                       np.ma.filled(b.variables[key][:], np.nan), equal_nan=True)
+        # zeta, temp and u/v in blocks of 2 of the 5 time steps
+        progress = [r.msg for r in progress if r.levelno == logging.PROGRESS]
+        assert len(progress) == 9
+        assert progress[-1][0] == 100
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,4 +1,4 @@
-import unittest, os, netCDF4, pytz
+import unittest, os, netCDF4, pytz, tempfile, shutil
 from datetime import timedelta, datetime, tzinfo
 from paegan.cdm.timevar import Timevar
 import numpy as np
@@ -93,6 +93,62 @@ class TimevarTest(unittest.TestCase):
 
         ds.close()
 
+    def test_timevar_nearest_index(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            datafile = os.path.join(tmpdir, "hourly.nc")
+            nc = netCDF4.Dataset(datafile, 'w')
+            nc.createDimension('time', 1000)
+            time = nc.createVariable('time', 'f8', ('time',))
+            time.units = "hours since 2000-01-01 00:00:00"
+            time[:] = np.arange(1000)
+            nc.close()
+
+            tvar = Timevar(datafile)
+            assert tvar.epoch_seconds[0] == (datetime(2000,1,1) - datetime(1970,1,1)).total_seconds()
+
+            rs = np.random.RandomState(0)
+            hours = rs.uniform(-10, 1010, 100)
+            dates = [datetime(2000,1,1) + timedelta(hours=h) for h in hours]
+            assert (tvar.nearest_index(dates) == np.clip(np.round(hours), 0, 999)).all()
+            assert (tvar.nearest_index(dates, select='before') == np.clip(np.floor(hours), -1, 999)).all()
+            assert (tvar.nearest_index(dates, select='after') == np.clip(np.ceil(hours), 0, 1000)).all()
+
+            # Equally close to two timesteps goes to the first one
+            assert tvar.nearest_index(datetime(2000,1,1,5,30))[0] == 5
+            assert tvar.nearest_index(datetime(2000,1,1,5,30, tzinfo=pytz.utc))[0] == 5
+            assert tvar.nearest(datetime(2000,1,1,5,40)) == datetime(2000,1,1,6, tzinfo=pytz.utc)
+
+            # Subsets keep their units and skip the NaN timesteps
+            tvar[:10] = np.nan
+            assert tvar.nearest_index(datetime(2000,1,1,2))[0] == 10
+            shuffled = tvar[rs.permutation(1000)]
+            assert shuffled[shuffled.nearest_index(datetime(2000,1,1,20))[0]] == 20
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_timevar_bounds_index(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            datafile = os.path.join(tmpdir, "hourly.nc")
+            nc = netCDF4.Dataset(datafile, 'w')
+            nc.createDimension('time', 48)
+            time = nc.createVariable('time', 'f8', ('time',))
+            time.units = "hours since 2000-01-01 00:00:00"
+            time[:] = np.arange(48)
+            nc.close()
+
+            tvar = Timevar(datafile)
+            assert tvar.bounds_index(datetime(2000,1,1,3), datetime(2000,1,1,7,30)) == slice(3, 8)
+            assert tvar.bounds_index(datetime(2000,1,3,3), datetime(2000,1,3,7)) == slice(48, 48)
+
+            # With NaNs from a restriction the axis is masked instead
+            tvar[:5] = np.nan
+            inds = tvar.bounds_index(datetime(2000,1,1,3), datetime(2000,1,1,7,30))
+            assert (inds == [5, 6, 7]).all()
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_timevar_ncom_hour_values_dap(self):
 
         datafile = "http://edac-dap3.northerngulfinstitute.org/thredds/dodsC/US_East/ncom_relo_useast_u_2011080200/ncom_relo_useast_u_2011080200_t072.nc"
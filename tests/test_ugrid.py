@@ -0,0 +1,147 @@
+import unittest, os, tempfile, shutil, netCDF4, datetime
+import numpy as np
+from paegan.cdm.dataset import CommonDataset, _is_remote
+from paegan.cdm.grids.u_grid import UGridDataset
+from paegan.cdm.meshvar import Meshobj
+
+class UGridDatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        # A jittered triangulated square, numbered from one and stored as
+        # (three, nele) the way FVCOM does, with UGRID metadata
+        self.tmpdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tmpdir, "mesh.nc")
+        rs = np.random.RandomState(0)
+        n = 30
+        j, i = np.mgrid[0:n, 0:n]
+        lon = -70 + 0.01 * (i + 0.3 * rs.rand(n, n))
+        lat = 42 + 0.01 * (j + 0.3 * rs.rand(n, n))
+        node = (j * n + i)[:-1, :-1].ravel()
+        faces = np.concatenate((np.column_stack((node, node + 1, node + n + 1)),
+                                np.column_stack((node, node + n + 1, node + n))))
+
+        nc = netCDF4.Dataset(self.datafile, 'w')
+        nc.createDimension('node', n * n)
+        nc.createDimension('nele', faces.shape[0])
+        nc.createDimension('three', 3)
+        nc.createDimension('time', 2)
+        mesh = nc.createVariable('mesh', 'i4')
+        mesh.cf_role = 'mesh_topology'
+        mesh.topology_dimension = 2
+        mesh.node_coordinates = 'x y'
+        mesh.face_node_connectivity = 'nv'
+        mesh.face_dimension = 'nele'
+        x = nc.createVariable('x', 'f8', ('node',))
+        x[:] = lon.ravel()
+        y = nc.createVariable('y', 'f8', ('node',))
+        y[:] = lat.ravel()
+        nv = nc.createVariable('nv', 'i4', ('three', 'nele'))
+        nv.start_index = 1
+        nv[:] = faces.T + 1
+        time = nc.createVariable('time', 'f8', ('time',))
+        time.units = 'hours since 2012-01-01 00:00:00'
+        time[:] = [0, 1]
+        temp = nc.createVariable('temp', 'f8', ('time', 'node'))
+        temp.mesh = 'mesh'
+        temp.location = 'node'
+        temp[:] = np.asarray([3 * lon.ravel() + 5 * lat.ravel(), 3 * lon.ravel() + 5 * lat.ravel() + 1])
+        # A face variable without face_coordinates, which are optional
+        fvar = nc.createVariable('fvar', 'f8', ('time', 'nele'))
+        fvar.mesh = 'mesh'
+        fvar.location = 'face'
+        fvar[:] = np.asarray([np.arange(faces.shape[0]), np.arange(faces.shape[0]) + 0.5])
+        nc.close()
+
+        self.lon, self.lat, self.faces = lon.ravel(), lat.ravel(), faces
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_open_ugrid(self):
+        pd = CommonDataset.open(self.datafile)
+        assert isinstance(pd, UGridDataset)
+        assert isinstance(pd.getgridobj('temp'), Meshobj)
+        assert pd.getgridobj('temp') is pd.getmeshobj()
+        pd.closenc()
+
+    def test_read_planner(self):
+        pd = CommonDataset.open(self.datafile)
+        assert pd.readplanner.max_slabs == UGridDataset.max_slabs
+        pd.closenc()
+        pd = CommonDataset.open(self.datafile, max_slabs=8)
+        assert pd.readplanner.max_slabs == 8
+        nodes = np.arange(0, 900, 7)
+        values = pd._get_data('temp', [np.arange(2), nodes])
+        assert np.array_equal(values[1], pd.nc.variables['temp'][1, nodes])
+        assert pd.readplanner.requests <= 8
+        # Copies read through the same planner
+        assert pd.restrict_vars('temp').readplanner is pd.readplanner
+        pd.closenc()
+        assert _is_remote("http://example.com/thredds/dodsC/fvcom")
+        assert not _is_remote(self.datafile)
+
+    def test_locate(self):
+        pd = CommonDataset.open(self.datafile)
+        mesh = pd.getmeshobj()
+        rs = np.random.RandomState(1)
+        lons = -70 + 0.31 * rs.rand(500)
+        lats = 42 + 0.31 * rs.rand(500)
+        faces, nodes, weights = mesh.locate(lons, lats)
+        found = faces >= 0
+        assert found.sum() > 400
+        assert np.array_equal(nodes[found], self.faces[faces[found]])
+        assert np.allclose(weights[found].sum(axis=1), 1)
+        assert (weights[found] > -1e-9).all()
+        # The weights give back the position
+        assert np.allclose((weights[found] * self.lon[nodes[found]]).sum(axis=1), lons[found])
+        assert np.allclose((weights[found] * self.lat[nodes[found]]).sum(axis=1), lats[found])
+        assert (nodes[~found] == -1).all()
+        pd.closenc()
+
+    def test_contains_points(self):
+        pd = CommonDataset.open(self.datafile)
+        lons = np.asarray([-69.95, -69.5, -70.1, -69.71])
+        lats = np.asarray([42.03, 42.1, 42.1, 42.0])
+        inside = pd.contains_points(lons, lats)
+        faces = pd.getmeshobj().locate(lons, lats)[0]
+        assert np.array_equal(inside, faces >= 0)
+        assert inside.tolist() == [True, False, False, False]
+        pd.closenc()
+
+    def test_bbox(self):
+        pd = CommonDataset.open(self.datafile)
+        mesh = pd.getmeshobj()
+        bbox = [-69.93, 42.05, -69.85, 42.12]
+        brute = np.where((self.lon >= bbox[0]) & (self.lon <= bbox[2]) &
+                         (self.lat >= bbox[1]) & (self.lat <= bbox[3]))[0]
+        assert np.array_equal(mesh.nodes_in_bbox(bbox), brute)
+        inds, inds = pd.get_xyind_from_bbox('temp', bbox)
+        assert np.array_equal(inds[0], brute)
+        faces = mesh.faces_in_bbox(bbox)
+        assert set(brute).issubset(set(self.faces[faces].ravel()))
+        pd.closenc()
+
+    def test_linear_values_at_points(self):
+        pd = CommonDataset.open(self.datafile)
+        lons = np.asarray([-69.95, -69.87, -69.81, -60.0])
+        lats = np.asarray([42.03, 42.11, 42.2, 42.1])
+        times = [datetime.datetime(2012, 1, 1, 1)] * 4
+        values = pd.get_values_at_points('temp', lons=lons, lats=lats, times=times, method='linear')
+        assert np.allclose(values[:3], 3 * lons[:3] + 5 * lats[:3] + 1)
+        assert values.mask[3]
+        pd.closenc()
+
+    def test_face_values_at_points(self):
+        pd = CommonDataset.open(self.datafile)
+        lons = np.asarray([-69.95, -69.87, -60.0])
+        lats = np.asarray([42.03, 42.11, 42.1])
+        times = [datetime.datetime(2012, 1, 1, 1)] * 3
+        faces = pd.getmeshobj().locate(lons, lats)[0]
+        values = pd.get_values_at_points('fvar', lons=lons, lats=lats, times=times, method='linear')
+        assert values.shape == (3,)
+        assert np.allclose(values[:2], faces[:2] + 0.5)
+        assert values.mask[2]
+        pd.closenc()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest, os, tempfile, shutil, netCDF4
+import numpy as np
+from collections import OrderedDict
+import paegan.cdm.writer as pw
+
+class WriterSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.tmpdir, "written.nc")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_session(self):
+        data = np.arange(20 * 6, dtype=np.float64).reshape(20, 6)
+        with pw.WriterSession.new(self.datafile, buffer_size=4 * 6 * 8) as session:
+            session.add_coordinates(OrderedDict([("time", 20), ("x", 6)]))
+            session.create_variable("temp", np.float64, ("time", "x"))
+            session.add_variable("x", np.arange(6), ("x",))
+            session.add_attribute("units", "degC", var="temp")
+            session.add_attribute("_FillValue", -1., var="temp")
+            session.add_attributes({"title" : "test"})
+            # Nothing is defined before the first write
+            assert len(session.nc.dimensions) == 0
+            for start in range(0, 20, 3):
+                session.write("temp", data[start:start + 3], start=start)
+            assert session.nc.variables["temp"].units == "degC"
+            # Consecutive slabs are written once they fill the buffer
+            assert session._buffer is not None
+            session.add_attribute("history", "written")
+        with netCDF4.Dataset(self.datafile) as nc:
+            assert np.array_equal(nc.variables["temp"][:], data)
+            assert np.array_equal(nc.variables["x"][:], np.arange(6))
+            assert nc.title == "test"
+            assert nc.history == "written"
+
+    def test_functions(self):
+        nc = pw.new(self.datafile)
+        pw.add_coordinates(nc, OrderedDict([("time", 4)]))
+        pw.add_variable(nc, "time", np.arange(4.), ("time",))
+        pw.add_attribute(nc, "units", "hours since 2012-01-01", var="time")
+        pw.add_attributes(nc, {"title" : "test"})
+        pw.add_scalar(nc, "depth", np.array(5.))
+        v = pw.create_variable(nc, "temp", np.float64, ("time",))
+        v[:] = 1
+        nc.close()
+        with netCDF4.Dataset(self.datafile) as nc:
+            assert np.array_equal(nc.variables["time"][:], np.arange(4.))
+            assert nc.variables["time"].units == "hours since 2012-01-01"
+            assert nc.variables["depth"][:] == 5
+            assert (nc.variables["temp"][:] == 1).all()
+            assert nc.title == "test"
+
+    def test_chunk_shape(self):
+        shape = (8760, 20, 200, 300)
+        assert pw.chunk_shape(shape, np.float32, "map") == (1, 1, 200, 300)
+        assert pw.chunk_shape(shape, np.float32, "timeseries")[0] == 8760
+        for preset in ["map", "timeseries", "balanced"]:
+            chunks = pw.chunk_shape(shape, np.float32, preset)
+            assert np.prod(chunks) * 4 <= pw.CHUNK_SIZE
+            assert all(1 <= c <= n for c, n in zip(chunks, shape))
+        assert pw.chunk_shape((10, 20), np.float64, "balanced") == (10, 20)
+        assert pw.chunk_shape((10, 20), np.float64, (None, 5)) == (10, 5)
+        self.assertRaises(ValueError, pw.chunk_shape, shape, np.float32, "rows")
+        self.assertRaises(ValueError, pw.chunk_shape, shape, np.float32, (1, 2))
+
+    def test_chunks_and_quantization(self):
+        data = np.random.RandomState(0).rand(50, 30, 40)
+        with pw.WriterSession.new(self.datafile) as session:
+            session.add_coordinates(OrderedDict([("time", None), ("y", 30), ("x", 40)]))
+            session.create_variable("temp", np.float64, ("time", "y", "x"), compress=True,
+                                    chunks="timeseries", chunk_size=2**14, least_significant_digit=2)
+            session.add_variable("salt", data, ("time", "y", "x"), chunks=(10, None, None))
+            session.write("temp", data, start=0)
+        with netCDF4.Dataset(self.datafile) as nc:
+            assert nc.variables["temp"].chunking() == list(pw.chunk_shape((0, 30, 40), np.float64, "timeseries", chunk_size=2**14))
+            assert nc.variables["temp"].filters()["zlib"]
+            assert nc.variables["salt"].chunking() == [10, 30, 40]
+            assert np.abs(nc.variables["temp"][:] - data).max() <= 0.005
+            assert np.array_equal(nc.variables["salt"][:], data)
+
+    def test_append_and_resume(self):
+        data = np.random.RandomState(0).rand(10, 3, 4)
+
+        def setup(writer):
+            writer.add_coordinates(OrderedDict([("time", None), ("y", 3), ("x", 4)]))
+            writer.create_variable("time", np.float64, ("time",))
+            writer.create_variable("temp", np.float64, ("time", "y", "x"), chunks="map")
+            writer.add_attribute("units", "degC", var="temp")
+
+        writer = pw.AppendWriter.open(self.datafile, steps=4)
+        setup(writer)
+        for i in range(9):
+            writer.append({"time" : i, "temp" : data[i]})
+        assert len(writer) == 9
+        assert writer.complete_steps == 8
+        # A crash part way through writing the next slab
+        writer.nc.variables["temp"][8:10] = -1
+        writer.nc.close()
+
+        writer = pw.AppendWriter.open(self.datafile, steps=4)
+        setup(writer)
+        assert len(writer) == 8
+        for i in range(8, 10):
+            step = {"temp" : data[i]}
+            if i == 8:
+                step["time"] = i
+            writer.append(step)
+        self.assertRaises(KeyError, writer.append, {"salt" : data[0]})
+        writer.close()
+
+        with netCDF4.Dataset(self.datafile) as nc:
+            assert nc.complete_steps == 10
+            assert np.array_equal(nc.variables["temp"][:], data)
+            assert nc.variables["time"][:9].tolist() == range(9)
+            assert nc.variables["time"][9] is np.ma.masked
+            assert nc.variables["temp"].units == "degC"
+
+    def test_resume_after_partial_slab(self):
+        data = np.random.RandomState(1).rand(12, 3, 4)
+        writer = pw.AppendWriter.open(self.datafile, steps=4)
+        writer.add_coordinates(OrderedDict([("time", None), ("y", 3), ("x", 4)]))
+        writer.create_variable("time", np.float64, ("time",))
+        writer.create_variable("temp", np.float64, ("time", "y", "x"))
+        writer.create_variable("salt", np.float64, ("time", "y", "x"))
+        for i in range(8):
+            writer.append({"time" : i, "temp" : data[i], "salt" : data[i]})
+        # A crash after some of the variables of the third slab were written
+        writer.nc.variables["time"][8:12] = range(8, 12)
+        writer.nc.variables["temp"][8:12] = data[8:12]
+        writer.nc.close()
+
+        writer = pw.AppendWriter.open(self.datafile, steps=4)
+        assert len(writer) == 8
+        # The producer writes fewer steps this time
+        writer.append({"time" : 8, "temp" : data[8], "salt" : data[8]})
+        writer.close()
+
+        with netCDF4.Dataset(self.datafile) as nc:
+            assert nc.complete_steps == 9
+            assert len(nc.dimensions["time"]) == 12
+            assert nc.variables["time"][:9].tolist() == range(9)
+            assert np.array_equal(nc.variables["temp"][:9], data[:9])
+            assert np.array_equal(nc.variables["salt"][:9], data[:9])
+            for key in ["time", "temp", "salt"]:
+                assert nc.variables[key][9:].mask.all()
+
+if __name__ == '__main__':
+    unittest.main()